@@ -0,0 +1,117 @@
+import hashlib
+import os
+import pickle
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+from game import Game
+
+CHECKPOINT_FILENAME = 'predictor.ckpt'
+# Bump this when the state of predictors changes, to invalidate old
+# checkpoints.
+CHECKPOINT_VERSION = 5
+
+
+class CheckpointHeader(NamedTuple):
+    """Describe the predictor & the games of a checkpoint."""
+    version: int
+    class_name: str
+    params: dict
+    n_games: int
+    last_game_id: int
+    digest: str
+    # Hash of the initial ratings file of the class, if it has one.
+    initial_ratings_digest: Optional[str]
+
+
+def games_digest(games: Sequence[Game]) -> str:
+    """Return a hash of games, independent of the orders of roster sets."""
+    sha = hashlib.sha1()
+
+    for game in games:
+        rosters = tuple(tuple(sorted(roster)) for roster in game.rosters)
+        full_rosters = tuple(tuple(sorted(full_roster))
+                             for full_roster in game.full_rosters)
+        sha.update(repr((game.match_id, game.stage, str(game.start_time),
+                         game.teams, game.match_format, game.game_id,
+                         game.game_number, game.map_name, game.score, rosters,
+                         full_rosters)).encode())
+
+    return sha.hexdigest()
+
+
+def initial_ratings_digest(class_: type) -> Optional[str]:
+    """Return a hash of the file the class reads its initial ratings from,
+    or None if it has none."""
+    filename = getattr(class_, 'INITIAL_RATINGS_FILENAME', None)
+    if filename is None:
+        return None
+
+    with open(filename, 'rb') as ratings_file:
+        return hashlib.sha1(ratings_file.read()).hexdigest()
+
+
+def save_checkpoint(predictor, games: Sequence[Game],
+                    params: dict = None,
+                    filename: str = CHECKPOINT_FILENAME) -> None:
+    """Save a predictor constructed with params & trained on games."""
+    header = CheckpointHeader(
+        version=CHECKPOINT_VERSION, class_name=type(predictor).__name__,
+        params={} if params is None else params, n_games=len(games),
+        last_game_id=games[-1].game_id if games else None,
+        digest=games_digest(games),
+        initial_ratings_digest=initial_ratings_digest(type(predictor)))
+
+    # Write the header first, so that a stale checkpoint is rejected
+    # without unpickling the predictor.
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as checkpoint_file:
+        pickle.dump(header, checkpoint_file, protocol=5)
+        pickle.dump(predictor, checkpoint_file, protocol=5)
+    os.replace(temp_filename, filename)
+
+
+def load_checkpoint(filename: str = CHECKPOINT_FILENAME
+                    ) -> Optional[Tuple[CheckpointHeader, object]]:
+    """Return the header & the predictor of a checkpoint, or None if there
+    is no usable one."""
+    try:
+        with open(filename, 'rb') as checkpoint_file:
+            header = pickle.load(checkpoint_file)
+            if (not isinstance(header, CheckpointHeader) or
+                    header.version != CHECKPOINT_VERSION):
+                return None
+            return header, pickle.load(checkpoint_file)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        return None
+
+
+def resume(class_: type, games: Sequence[Game], params: dict = None,
+           filename: str = CHECKPOINT_FILENAME, save: bool = True):
+    """Return a predictor of class_ constructed with params & trained on
+    games. Start from the checkpoint if it was trained on a prefix of the
+    games with the same class, params & initial ratings, else from scratch.
+    Save a new checkpoint afterwards unless save is False."""
+    params = {} if params is None else params
+    predictor = class_(**params)
+    n = 0
+    checkpoint = load_checkpoint(filename)
+
+    if checkpoint is not None:
+        header, checkpoint_predictor = checkpoint
+        n_games = header.n_games
+        if (header.class_name == class_.__name__ and
+                header.params == params and
+                header.initial_ratings_digest ==
+                initial_ratings_digest(class_) and
+                n_games <= len(games) and
+                (n_games == 0 or
+                 games[n_games - 1].game_id == header.last_game_id) and
+                header.digest == games_digest(games[:header.n_games])):
+            predictor = checkpoint_predictor
+            n = header.n_games
+
+    predictor.train_games(games[n:])
+    if save and (n < len(games) or checkpoint is None):
+        save_checkpoint(predictor, games, params=params, filename=filename)
+
+    return predictor
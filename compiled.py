@@ -0,0 +1,306 @@
+from datetime import datetime
+import json
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, Iterator, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+from game import Game
+
+ROSTER_SIZE = 6
+# Arrays start at multiples of this many bytes in a buffer.
+ALIGNMENT = 8
+
+VOCABS = ('teams', 'players', 'stages', 'formats', 'maps')
+# Arrays with one row per game.
+GAME_ARRAYS = ('team_ids', 'rosters', 'scores', 'drawable', 'format_codes',
+               'stage_codes', 'map_codes', 'match_ids', 'game_ids',
+               'game_numbers', 'start_times')
+ARRAYS = GAME_ARRAYS + ('full_roster_offsets', 'full_roster_ids',
+                        'match_starts')
+
+
+class ArraySpec(NamedTuple):
+    """Describe where an array lives in a buffer."""
+    name: str
+    dtype: str
+    shape: Tuple[int, ...]
+    offset: int
+
+
+class SharedGames(NamedTuple):
+    """A picklable handle to compiled games in shared memory."""
+    shm_name: str
+    meta: dict
+
+
+class CompiledGames(object):
+    """Played games in columnar NumPy arrays, with teams, players, stages,
+    formats & maps encoded as indices into vocabularies.
+
+    Rosters are a (games, 2, 6) matrix padded with -1, and full rosters are
+    ragged, game i team j holding full_roster_ids[full_roster_offsets[2i + j]:
+    full_roster_offsets[2i + j + 1]]. Games of the same match are contiguous,
+    match k being games match_starts[k]:match_starts[k + 1].
+
+    All the arrays can live in one buffer, so that they can be put in
+    shared memory or memory-mapped from a file."""
+
+    def __init__(self, arrays: Dict[str, np.ndarray],
+                 vocabs: Dict[str, List[str]], buffer=None) -> None:
+        super().__init__()
+
+        self.vocabs = vocabs
+        self.teams = vocabs['teams']
+        self.players = vocabs['players']
+        self.stages = vocabs['stages']
+        self.formats = vocabs['formats']
+        self.maps = vocabs['maps']
+
+        self.team_ids = arrays['team_ids']
+        self.rosters = arrays['rosters']
+        self.scores = arrays['scores']
+        self.drawable = arrays['drawable']
+        self.format_codes = arrays['format_codes']
+        self.stage_codes = arrays['stage_codes']
+        self.map_codes = arrays['map_codes']
+        self.match_ids = arrays['match_ids']
+        self.game_ids = arrays['game_ids']
+        self.game_numbers = arrays['game_numbers']
+        self.start_times = arrays['start_times']
+        self.full_roster_offsets = arrays['full_roster_offsets']
+        self.full_roster_ids = arrays['full_roster_ids']
+        self.match_starts = arrays['match_starts']
+
+        # The SharedMemory or memmap backing the arrays, if any.
+        self.buffer = buffer
+
+    @classmethod
+    def compile(cls, games: Sequence[Game]) -> 'CompiledGames':
+        """Compile played games, in order."""
+        vocabs = {name: [] for name in VOCABS}
+        codes = {name: {} for name in VOCABS}
+
+        def encode(vocab: str, value: str) -> int:
+            code = codes[vocab].get(value)
+            if code is None:
+                code = codes[vocab][value] = len(vocabs[vocab])
+                vocabs[vocab].append(value)
+            return code
+
+        n = len(games)
+        rosters = np.full((n, 2, ROSTER_SIZE), -1, dtype=np.int32)
+        full_roster_ids = []
+        full_roster_offsets = [0]
+
+        for i, game in enumerate(games):
+            if game.score is None:
+                raise ValueError(f'Game {game.match_id} is not played yet')
+
+            for j in range(2):
+                roster = sorted(game.rosters[j])
+                rosters[i, j, :len(roster)] = [encode('players', name)
+                                               for name in roster]
+                full_roster_ids.extend(encode('players', name)
+                                       for name in sorted(game.full_rosters[j]))
+                full_roster_offsets.append(len(full_roster_ids))
+
+        match_ids = np.array([game.match_id for game in games], dtype=np.int64)
+        match_starts = np.flatnonzero(np.diff(match_ids, prepend=-1) != 0)
+
+        arrays = {
+            'team_ids': np.array([[encode('teams', team) for team in game.teams]
+                                  for game in games],
+                                 dtype=np.int16).reshape(n, 2),
+            'rosters': rosters,
+            'scores': np.array([game.score for game in games],
+                               dtype=np.int16).reshape(n, 2),
+            'drawable': np.array([game.drawable for game in games],
+                                 dtype=bool),
+            'format_codes': np.array([encode('formats', game.match_format)
+                                      for game in games], dtype=np.int16),
+            'stage_codes': np.array([encode('stages', game.stage)
+                                     for game in games], dtype=np.int16),
+            'map_codes': np.array([encode('maps', game.map_name)
+                                   for game in games], dtype=np.int16),
+            'match_ids': match_ids,
+            'game_ids': np.array([game.game_id for game in games],
+                                 dtype=np.int64),
+            'game_numbers': np.array([game.game_number for game in games],
+                                     dtype=np.int16),
+            'start_times': np.array([game.start_time for game in games],
+                                    dtype='datetime64[s]'),
+            'full_roster_offsets': np.array(full_roster_offsets,
+                                            dtype=np.int64),
+            'full_roster_ids': np.array(full_roster_ids, dtype=np.int32),
+            'match_starts': np.append(match_starts, n).astype(np.int64),
+        }
+
+        return cls(arrays, vocabs)
+
+    def __len__(self) -> int:
+        return len(self.match_ids)
+
+    def __iter__(self) -> Iterator[Game]:
+        """Decode the games one by one, so that they can be trained on like
+        a list of games."""
+        columns = zip(self.team_ids.tolist(), self.rosters.tolist(),
+                      self.scores.tolist(), self.format_codes.tolist(),
+                      self.stage_codes.tolist(), self.map_codes.tolist(),
+                      self.match_ids.tolist(), self.game_ids.tolist(),
+                      self.game_numbers.tolist(),
+                      self.start_times.astype(datetime).tolist())
+        offsets = self.full_roster_offsets.tolist()
+        full_roster_ids = self.full_roster_ids.tolist()
+        players = self.players
+
+        for i, (team_ids, rosters, score, format_code, stage_code, map_code,
+                match_id, game_id, game_number, start_time) in enumerate(
+                    columns):
+            full_rosters = tuple(
+                frozenset(players[k]
+                          for k in full_roster_ids[offsets[j]:offsets[j + 1]])
+                for j in (2 * i, 2 * i + 1))
+
+            yield Game(teams=(self.teams[team_ids[0]],
+                              self.teams[team_ids[1]]),
+                       match_format=self.formats[format_code],
+                       match_id=match_id, stage=self.stages[stage_code],
+                       start_time=start_time, game_id=game_id,
+                       game_number=game_number, map_name=self.maps[map_code],
+                       score=tuple(score),
+                       rosters=tuple(tuple(players[k] for k in roster if k >= 0)
+                                     for roster in rosters),
+                       full_rosters=full_rosters)
+
+    def game(self, i: int) -> Game:
+        """Decode a single game."""
+        return next(iter(self[i:i + 1]))
+
+    def __getitem__(self, key: slice) -> 'CompiledGames':
+        """Return a view of a contiguous range of games."""
+        start, stop, step = key.indices(len(self))
+        if step != 1:
+            raise ValueError('Only contiguous slices are supported')
+
+        offsets = self.full_roster_offsets[2 * start:2 * stop + 1]
+        starts = self.match_starts
+        match_starts = starts[(starts > start) & (starts < stop)]
+        arrays = {name: getattr(self, name)[start:stop]
+                  for name in GAME_ARRAYS}
+        arrays.update({
+            'full_roster_offsets': offsets - offsets[0],
+            'full_roster_ids': self.full_roster_ids[offsets[0]:offsets[-1]],
+            'match_starts': np.concatenate([[0], match_starts - start,
+                                            [stop - start]]).astype(np.int64),
+        })
+
+        return CompiledGames(arrays, self.vocabs, buffer=self.buffer)
+
+    def meta(self) -> dict:
+        """Return a JSON-serializable description of the vocabularies &
+        the buffer layout."""
+        return {'vocabs': self.vocabs,
+                'arrays': [spec._asdict() for spec in self._layout()]}
+
+    def buffer_size(self) -> int:
+        spec = self._layout()[-1]
+        return spec.offset + np.dtype(spec.dtype).itemsize * int(
+            np.prod(spec.shape))
+
+    def share(self) -> 'CompiledGames':
+        """Return a copy in a new shared memory block. Other processes can
+        attach to it with the handle, the owner should close() & unlink()
+        it when done."""
+        shm = SharedMemory(create=True, size=max(self.buffer_size(), 1))
+        meta = self.meta()
+        self._copy_to(shm.buf, meta)
+
+        return self._from_buffer(shm.buf, meta, buffer=shm)
+
+    @property
+    def handle(self) -> SharedGames:
+        if not isinstance(self.buffer, SharedMemory):
+            raise ValueError('The games are not in shared memory')
+        return SharedGames(shm_name=self.buffer.name, meta=self.meta())
+
+    @classmethod
+    def attach(cls, handle: SharedGames) -> 'CompiledGames':
+        """Attach to compiled games shared by another process."""
+        shm = SharedMemory(name=handle.shm_name)
+        return cls._from_buffer(shm.buf, handle.meta, buffer=shm)
+
+    def save(self, filename: str) -> None:
+        """Save to a file which can be memory-mapped by load()."""
+        header = json.dumps(self.meta()).encode()
+        data_offset = -(-(8 + len(header)) // ALIGNMENT) * ALIGNMENT
+        buffer = bytearray(self.buffer_size())
+        self._copy_to(memoryview(buffer), self.meta())
+
+        with open(filename, 'wb') as file:
+            file.write(len(header).to_bytes(8, 'little'))
+            file.write(header)
+            file.write(bytes(data_offset - 8 - len(header)))
+            file.write(buffer)
+
+    @classmethod
+    def load(cls, filename: str, mmap: bool = True) -> 'CompiledGames':
+        """Load compiled games saved by save(), memory-mapped read-only
+        unless mmap is False."""
+        with open(filename, 'rb') as file:
+            header_size = int.from_bytes(file.read(8), 'little')
+            meta = json.loads(file.read(header_size))
+            data_offset = -(-(8 + header_size) // ALIGNMENT) * ALIGNMENT
+
+            if not mmap:
+                file.seek(data_offset)
+                return cls._from_buffer(bytearray(file.read()), meta)
+
+        data = np.memmap(filename, dtype=np.uint8, mode='r',
+                         offset=data_offset)
+        return cls._from_buffer(data, meta, buffer=data)
+
+    def close(self) -> None:
+        """Release the shared memory, if any. The arrays are unusable
+        afterwards."""
+        if isinstance(self.buffer, SharedMemory):
+            for name in ARRAYS:
+                setattr(self, name, None)
+            self.buffer.close()
+
+    def unlink(self) -> None:
+        if isinstance(self.buffer, SharedMemory):
+            self.buffer.unlink()
+
+    def _layout(self) -> List[ArraySpec]:
+        specs = []
+        offset = 0
+
+        for name in ARRAYS:
+            array = getattr(self, name)
+            specs.append(ArraySpec(name=name, dtype=array.dtype.str,
+                                   shape=array.shape, offset=offset))
+            offset += array.nbytes
+            offset = -(-offset // ALIGNMENT) * ALIGNMENT
+
+        return specs
+
+    def _copy_to(self, buffer, meta: dict) -> None:
+        for spec in map(self._spec, meta['arrays']):
+            array = np.ndarray(spec.shape, dtype=spec.dtype, buffer=buffer,
+                               offset=spec.offset)
+            array[...] = getattr(self, spec.name)
+
+    @classmethod
+    def _from_buffer(cls, data, meta: dict, **kws) -> 'CompiledGames':
+        arrays = {}
+        for spec in map(cls._spec, meta['arrays']):
+            arrays[spec.name] = np.ndarray(spec.shape, dtype=spec.dtype,
+                                           buffer=data, offset=spec.offset)
+
+        return cls(arrays, meta['vocabs'], **kws)
+
+    @staticmethod
+    def _spec(spec: dict) -> ArraySpec:
+        return ArraySpec(name=spec['name'], dtype=spec['dtype'],
+                         shape=tuple(spec['shape']), offset=spec['offset'])
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from collections.abc import MutableMapping
+from typing import Callable, Dict, Tuple
+
+# Marks a key deleted in the changes of a CowDict.
+_DELETED = object()
+
+
+class CowDict(MutableMapping):
+    """A copy-on-write dict, which can be forked in O(changes).
+
+    The contents are frozen layers, shared with forks, under a private dict
+    of changes. Forking freezes the changes into a new layer, so that both
+    sides write to new changes. Like a defaultdict, missing keys get
+    default_factory() if it's given. Values are shared too, so they should
+    be replaced instead of mutated."""
+
+    # Flatten the layers when there are more than this many.
+    MAX_LAYERS = 8
+
+    def __init__(self, layers: Tuple[Dict, ...] = (),
+                 default_factory: Callable = None,
+                 dict_type: type = dict) -> None:
+        super().__init__()
+
+        self.layers = layers
+        self.changes = {}
+        self.default_factory = default_factory
+        # The type of the plain copies, without default_factory.
+        self.dict_type = dict_type
+
+    @classmethod
+    def wrap(cls, d: Dict) -> 'CowDict':
+        """Return a CowDict over d, which must not be mutated afterwards."""
+        if isinstance(d, CowDict):
+            return d
+        return cls(layers=(d,),
+                   default_factory=getattr(d, 'default_factory', None),
+                   dict_type=type(d))
+
+    def fork(self) -> 'CowDict':
+        if self.changes:
+            self.layers = (self.changes,) + self.layers
+            self.changes = {}
+        if len(self.layers) > self.MAX_LAYERS:
+            self.layers = (dict(self.items()),)
+
+        return CowDict(layers=self.layers,
+                       default_factory=self.default_factory,
+                       dict_type=self.dict_type)
+
+    def __reduce__(self):
+        # Pickle flattened, deletions included.
+        return CowDict, ((dict(self.items()),), self.default_factory,
+                         self.dict_type)
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _DELETED:
+            if self.default_factory is None:
+                raise KeyError(key)
+            value = self.changes[key] = self.default_factory()
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is _DELETED else value
+
+    def __contains__(self, key) -> bool:
+        return self._lookup(key) is not _DELETED
+
+    def __setitem__(self, key, value) -> None:
+        self.changes[key] = value
+
+    def __delitem__(self, key) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.changes[key] = _DELETED
+
+    def __iter__(self):
+        # Keep the insertion order, oldest layer first.
+        seen = {}
+        for layer in reversed((self.changes,) + self.layers):
+            for key, value in layer.items():
+                seen[key] = value
+        return (key for key, value in seen.items() if value is not _DELETED)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def clear(self) -> None:
+        self.layers = ()
+        self.changes = {}
+
+    def copy(self) -> Dict:
+        """Return a plain copy, of the type of the wrapped dict."""
+        if self.default_factory is None:
+            return self.dict_type(self.items())
+        return defaultdict(self.default_factory, self.items())
+
+    def _lookup(self, key):
+        if key in self.changes:
+            return self.changes[key]
+
+        for layer in self.layers:
+            if key in layer:
+                return layer[key]
+
+        return _DELETED
@@ -1,66 +1,298 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from csv import (reader as csv_reader,
                  writer as csv_writer,
                  DictReader,
                  DictWriter)
 from datetime import datetime
+import hashlib
+from itertools import islice
+import json
+import os
+import pickle
 from pprint import pprint
-from typing import Dict, List, NamedTuple, Set, Tuple
+import sys
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+from urllib.parse import urlencode
 
 from game import Game, TEAMS
+from game_store import (CSVGame, GameStore, GAMES_CSV, join_names, merge_rows,
+                        split_names)
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-GAMES_CSV = 'games.csv'
 AVAILABILITIES_CSV = 'availabilities.csv'
 RATINGS_CSV = 'ratings.csv'
+RATINGS_LONG_CSV = 'ratings_long.csv'
+RATINGS_LONG_FIELDS = ('stage', 'match_number', 'name', 'mu', 'sigma')
+# What was exported to the long csv file is kept next to it, with this suffix.
+RATINGS_LONG_STATE_SUFFIX = '.state'
+FETCH_STATE_JSON = 'fetch_state.json'
+HTTP_CACHE_DIR = 'http_cache'
+# Small enough pages that a full fetch runs them concurrently.
+MATCHES_PAGE_SIZE = 100
+# Parsed games are cached next to the csv file, with this suffix.
+GAMES_CACHE_SUFFIX = '.cache'
+# Bump this when the parsed games change, to invalidate old caches.
+GAMES_CACHE_VERSION = 3
 BASE_URL = 'https://api.overwatchleague.com/'
 
 
 Availabilities = Dict[Tuple[str, int], Dict[str, Set[str]]]
 
 
-class CSVGame(NamedTuple):
-    """Describe a single game in a CSV file."""
-    match_id: int
-    stage: str
-    start_time: datetime
-    team1: str
-    team2: str
-    match_format: str
+class RoundedRating(NamedTuple):
+    """A rating as exported, rounded to integers."""
+    mu: int
+    sigma: int
+
+
+RatingsHistory = Dict[Tuple[str, int], Dict[str, RoundedRating]]
+
+
+class FetchClient(object):
+    """Fetch JSON from the API over a pooled session.
+
+    Requests run concurrently in at most max_workers threads, are retried
+    with exponential backoff, and are cached on disk with their ETag &
+    Last-Modified headers, so that unchanged responses are not downloaded
+    again."""
+
+    # Transient statuses worth retrying.
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url: str = BASE_URL, max_workers: int = 8,
+                 retries: int = 5, backoff_factor: float = 0.5,
+                 timeout: float = 10.0,
+                 cache_dir: str = HTTP_CACHE_DIR) -> None:
+        super().__init__()
+
+        self.base_url = base_url
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=self.RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_connections=max_workers,
+                              pool_maxsize=max_workers, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self) -> 'FetchClient':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.session.close()
+
+    def get(self, path: str, params: dict = None):
+        """GET a path relative to the base url, and return its JSON."""
+        url = self.base_url + path
+        cache_filename = self._cache_filename(url, params)
+        cached = self._read_cache(cache_filename)
+
+        headers = {}
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        response = self.session.get(url, params=params, headers=headers,
+                                    timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            return cached['body']
+        response.raise_for_status()
+
+        body = response.json()
+        self._write_cache(cache_filename, {
+            'url': url,
+            'params': params,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'body': body,
+        })
+
+        return body
+
+    def get_many(self, paths: Iterable[str], params: dict = None) -> List:
+        """Same as get(), but for many paths concurrently."""
+        return list(self.executor.map(lambda path: self.get(path, params),
+                                      paths))
+
+    def get_pages(self, path: str, params: dict = None) -> List:
+        """GET all the pages of a paginated path, and return the
+        concatenated content. The first page tells the number of pages,
+        the others are fetched concurrently."""
+        params = {} if params is None else params
+        first_page = self.get(path, params)
+        pages = [first_page] + list(self.executor.map(
+            lambda page: self.get(path, {**params, 'page': page}),
+            range(1, first_page.get('totalPages', 1))))
+
+        return [item for page in pages for item in page['content']]
+
+    def _cache_filename(self, url: str, params: dict = None) -> str:
+        if self.cache_dir is None:
+            return None
 
-    game_id: int = None
-    game_number: int = None
-    map_name: str = None
-    score1: int = None
-    score2: int = None
-    roster1: str = None
-    roster2: str = None
-    full_roster1: str = None
-    full_roster2: str = None
+        query = urlencode(sorted((params or {}).items()))
+        key = hashlib.sha1(f'{url}?{query}'.encode()).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
 
+    def _read_cache(self, cache_filename: str):
+        if cache_filename is None or not os.path.exists(cache_filename):
+            return None
 
-def join_names(names: List[str]) -> str:
-    return '|'.join(sorted(names))
+        try:
+            with open(cache_filename) as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None  # A broken cache entry is just a miss.
 
+    def _write_cache(self, cache_filename: str, entry: dict) -> None:
+        if cache_filename is None:
+            return
 
-def split_names(names_str: str) -> List[str]:
-    return set(names_str.split('|'))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_filename = cache_filename + '.tmp'
+        with open(temp_filename, 'w') as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(temp_filename, cache_filename)
 
 
-def fetch_games() -> List[CSVGame]:
-    url = BASE_URL + 'match'
-    params = {'size': 1000}
-    result = requests.get(url, params).json()
+def fetch_games(client: FetchClient = None) -> List[CSVGame]:
+    with nullcontext(client) if client else FetchClient() as client:
+        raw_matches = fetch_match_details(
+            [raw_match['id'] for raw_match in fetch_raw_matches(client)],
+            client)
 
     games = []
-    for raw_match in result['content']:
+    for raw_match in raw_matches:
         games += parse_match(raw_match)
     games.sort(key=lambda game: game.start_time)
 
     return fill_availabilities(games)
 
 
+def fetch_raw_matches(client: FetchClient = None,
+                      page_size: int = MATCHES_PAGE_SIZE) -> List[dict]:
+    """Fetch the summaries of all the matches, one page per request."""
+    with nullcontext(client) if client else FetchClient() as client:
+        return client.get_pages('match', {'size': page_size})
+
+
+def fetch_match_details(match_ids: Iterable[int],
+                        client: FetchClient = None) -> List[dict]:
+    """Fetch the matches with their games & players, in the same order."""
+    with nullcontext(client) if client else FetchClient() as client:
+        return client.get_many([f'match/{match_id}'
+                                for match_id in match_ids])
+
+
+def sync_games(csv_filename: str = GAMES_CSV,
+               state_filename: str = FETCH_STATE_JSON,
+               client: FetchClient = None,
+               full: bool = False) -> List[CSVGame]:
+    """Same as fetch_games() followed by save_games(), but only fetch the
+    details of the matches which are new, unfinished or changed since the
+    last sync, and only append the changed rows to the journal of the
+    games. The state of each match summary is kept in a json file.
+
+    With full, fetch every match again & rewrite the games, which repairs
+    a store out of sync with its state."""
+    state = load_fetch_state(state_filename)
+    store = GameStore(csv_filename)
+    csv_rows = list(store.csv_games())
+    csv_matches = defaultdict(list)
+    for game in map(typed_csv_game, csv_rows):
+        csv_matches[game.match_id].append(game)
+
+    with nullcontext(client) if client else FetchClient() as client:
+        raw_matches = fetch_raw_matches(client)
+        new_state = {}
+        changed_ids = []
+
+        for raw_match in raw_matches:
+            match_id = raw_match['id']
+            match_state = {'state': raw_match['state'],
+                           'hash': match_hash(raw_match)}
+            new_state[match_id] = match_state
+
+            if (full or state.get(match_id) != match_state or
+                    match_state['state'] != 'CONCLUDED' or
+                    match_id not in csv_matches):
+                changed_ids.append(match_id)
+
+        details = fetch_match_details(changed_ids, client)
+
+    parsed_matches = {raw_match['id']: parse_match(raw_match)
+                      for raw_match in details}
+    games = []
+    for match_id in new_state:
+        if match_id in parsed_matches:
+            csv_matches.pop(match_id, None)
+            games += parsed_matches[match_id]
+        else:
+            games += csv_matches.pop(match_id)
+
+    # Keep the matches which are not returned anymore.
+    for match_games in csv_matches.values():
+        games += match_games
+    games.sort(key=lambda game: game.start_time)
+    games = fill_availabilities(games)
+
+    # Rows are merged by start time, so rewrite the file when a match has
+    # moved or lost games, which appending cannot express.
+    rows = list(map(untyped_csv_game, games))
+    stored_rows = set(csv_rows)
+    new_rows = [row for row in rows if row not in stored_rows]
+    if not full and sorted(merge_rows(csv_rows, new_rows)) == sorted(rows):
+        store.append(new_rows)
+    else:
+        store.rewrite(rows)
+
+    # Save the state last, so that it never covers games not saved.
+    save_fetch_state(new_state, state_filename)
+
+    return games
+
+
+def match_hash(raw_match: dict) -> str:
+    payload = json.dumps(raw_match, sort_keys=True).encode()
+    return hashlib.sha1(payload).hexdigest()
+
+
+def load_fetch_state(state_filename: str = FETCH_STATE_JSON
+                     ) -> Dict[int, Dict[str, str]]:
+    """Load {match_id: {'state': state, 'hash': hash}}, empty if there is no
+    state yet."""
+    if not os.path.exists(state_filename):
+        return {}
+
+    with open(state_filename) as state_file:
+        state = json.load(state_file)
+
+    return {int(match_id): match_state
+            for match_id, match_state in state.items()}
+
+
+def save_fetch_state(state: Dict[int, Dict[str, str]],
+                     state_filename: str = FETCH_STATE_JSON) -> None:
+    with open(state_filename, 'w') as state_file:
+        json.dump({str(match_id): match_state
+                   for match_id, match_state in sorted(state.items())},
+                  state_file, indent=2)
+
+
 def parse_match(raw_match) -> List[CSVGame]:
     if None in raw_match['competitors'] or 'abbreviatedName' not in raw_match['competitors'][0]:
         return []  # The competitors have not been decided, don't parse it.
@@ -153,52 +385,100 @@ def parse_game(raw_game, base_game: CSVGame, team1_id: int,
 
 
 def save_games(games: List[CSVGame], csv_filename: str = GAMES_CSV) -> None:
-    with open(csv_filename, 'w', newline='') as csv_file:
-        writer = csv_writer(csv_file)
-        writer.writerow(CSVGame._fields)  # Write headers.
-        writer.writerows(games)
+    """Replace the games of a csv file & its journal."""
+    GameStore(csv_filename).rewrite(games)
+
+
+def load_csv_games(csv_filename: str = GAMES_CSV) -> List[CSVGame]:
+    """Load the raw rows of a csv file merged with its journal, empty if
+    there is no file yet. Only match ids & start times are converted."""
+    return list(map(typed_csv_game, GameStore(csv_filename).csv_games()))
+
+
+def typed_csv_game(csv_game: CSVGame) -> CSVGame:
+    return csv_game._replace(
+        match_id=int(csv_game.match_id),
+        start_time=datetime.strptime(csv_game.start_time,
+                                     '%Y-%m-%d %H:%M:%S'))
 
 
-def load_games(csv_filename: str = GAMES_CSV) -> Tuple[List[Game], List[Game]]:
-    """Load past & future games from a csv file."""
+def untyped_csv_game(csv_game: CSVGame) -> CSVGame:
+    """Return a row as read back from a csv file, all strings."""
+    return CSVGame._make('' if value is None else str(value)
+                         for value in csv_game)
+
+
+def load_games(csv_filename: str = GAMES_CSV,
+               use_cache: bool = True) -> Tuple[List[Game], List[Game]]:
+    """Load past & future games from a csv file & its journal. The parsed
+    games are cached in a sidecar file, used as long as both files are
+    unchanged."""
+    if not use_cache:
+        return parse_games(csv_filename)
+
+    cache_filename = csv_filename + GAMES_CACHE_SUFFIX
+    key = games_cache_key(csv_filename)
+    games = read_games_cache(cache_filename, key)
+
+    if games is None:
+        games = parse_games(csv_filename)
+        write_games_cache(cache_filename, key, games)
+
+    return games
+
+
+def games_cache_key(csv_filename: str) -> tuple:
+    """Return the cache version, and the size, mtime & hash of a csv file &
+    of its journal."""
+    key = [GAMES_CACHE_VERSION]
+    for filename in (csv_filename, GameStore(csv_filename).journal_filename):
+        if not os.path.exists(filename):
+            key.append(None)
+            continue
+
+        stat = os.stat(filename)
+        with open(filename, 'rb') as key_file:
+            digest = hashlib.sha1(key_file.read()).hexdigest()
+        key.append((stat.st_size, stat.st_mtime_ns, digest))
+
+    return tuple(key)
+
+
+def read_games_cache(cache_filename: str, key: tuple):
+    """Return the cached games if the cache matches the key, else None."""
+    try:
+        with open(cache_filename, 'rb') as cache_file:
+            if pickle.load(cache_file) != key:
+                return None
+            return pickle.load(cache_file)
+    except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+        # A missing or broken cache is just a miss.
+        return None
+
+
+def write_games_cache(cache_filename: str, key: tuple, games) -> None:
+    # Write the key first, so that a stale cache is rejected without
+    # unpickling the games.
+    temp_filename = cache_filename + '.tmp'
+    try:
+        with open(temp_filename, 'wb') as cache_file:
+            pickle.dump(key, cache_file, protocol=5)
+            pickle.dump(games, cache_file, protocol=5)
+        os.replace(temp_filename, cache_filename)
+    except OSError:
+        pass  # Caching is optional, e.g. in a read-only directory.
+
+
+def parse_games(csv_filename: str = GAMES_CSV) -> Tuple[List[Game], List[Game]]:
+    """Parse past & future games from a csv file & its journal."""
     past_games = []
     future_games = []
 
-    with open(csv_filename, newline='') as csv_file:
-        reader = csv_reader(csv_file)
-        next(reader, None)  # Skip the header line.
-
-        for csv_game in map(CSVGame._make, reader):
-            match_id = int(csv_game.match_id)
-            stage = csv_game.stage
-            start_time = datetime.strptime(csv_game.start_time,
-                                           '%Y-%m-%d %H:%M:%S')
-            teams = (csv_game.team1, csv_game.team2)
-            match_format = csv_game.match_format
-            full_rosters = (split_names(csv_game.full_roster1),
-                            split_names(csv_game.full_roster2))
-
-            if csv_game.game_id:
-                game_id = int(csv_game.game_id)
-                game_number = int(csv_game.game_number)
-                map_name = csv_game.map_name
-                score = (int(csv_game.score1), int(csv_game.score2))
-                rosters = (split_names(csv_game.roster1),
-                           split_names(csv_game.roster2))
-
-                game = Game(match_id=match_id, stage=stage,
-                            start_time=start_time, teams=teams,
-                            match_format=match_format, game_id=game_id,
-                            game_number=game_number, map_name=map_name,
-                            score=score, rosters=rosters,
-                            full_rosters=full_rosters)
-                past_games.append(game)
-            else:
-                game = Game(match_id=match_id, stage=stage,
-                            start_time=start_time, teams=teams,
-                            match_format=match_format,
-                            full_rosters=full_rosters)
-                future_games.append(game)
+    for game in GameStore(csv_filename).games():
+        if game.score is not None:
+            past_games.append(game)
+        else:
+            future_games.append(game)
 
     return past_games, future_games
 
@@ -285,6 +565,137 @@ def save_ratings_history(history, mu, sigma, csv_filename: str = RATINGS_CSV):
             writer.writerow(row)
 
 
+def append_ratings_history(history,
+                           csv_filename: str = RATINGS_LONG_CSV) -> int:
+    """Append the ratings of a history to a long csv file, one row per
+    (stage, match_number, name), skipping the rows already exported with
+    the same values. Return the number of rows appended.
+
+    Only the ratings of the last stage still change, so a sidecar file
+    keeps their exported values, and a digest of the earlier ones, which
+    are skipped as long as they match. The csv file is only read back when
+    the sidecar does not match it."""
+    history = round_ratings_history(history)
+    state_filename = csv_filename + RATINGS_LONG_STATE_SUFFIX
+    n_closed, exported = load_ratings_long_state(history, csv_filename,
+                                                 state_filename)
+    rows = []
+
+    for (stage, match_number), ratings in islice(history.items(), n_closed,
+                                                 None):
+        exported_ratings = exported.get((stage, match_number), {})
+
+        for name, rounded in ratings.items():
+            if exported_ratings.get(name) != rounded:
+                rows.append((stage, match_number, name, *rounded))
+
+    is_new = not os.path.exists(csv_filename)
+    with open(csv_filename, 'a', newline='') as csv_file:
+        writer = csv_writer(csv_file)
+        if is_new:
+            writer.writerow(RATINGS_LONG_FIELDS)  # Write headers.
+        writer.writerows(rows)
+
+    save_ratings_long_state(history, csv_filename, state_filename)
+
+    return len(rows)
+
+
+def round_ratings_history(history) -> RatingsHistory:
+    return OrderedDict(
+        (match_key, {name: RoundedRating(mu=round(rating.mu),
+                                         sigma=round(rating.sigma))
+                     for name, rating in ratings.items()})
+        for match_key, ratings in history.items())
+
+
+def count_closed_keys(history: RatingsHistory) -> int:
+    """Return the number of match keys before the last stage of a history,
+    whose ratings do not change anymore."""
+    last_stage = next(reversed(history))[0] if history else None
+    for n_closed, (stage, _) in enumerate(history):
+        if stage == last_stage:
+            return n_closed
+    return 0
+
+
+def ratings_digest(history: RatingsHistory, n_keys: int) -> str:
+    """Return a digest of the ratings of the first n_keys match keys."""
+    digest = hashlib.sha1()
+    for match_key, ratings in islice(history.items(), n_keys):
+        digest.update(repr((match_key, sorted(ratings.items()))).encode())
+    return digest.hexdigest()
+
+
+def load_ratings_long_state(history: RatingsHistory, csv_filename: str,
+                            state_filename: str
+                            ) -> Tuple[int, RatingsHistory]:
+    """Return the number of match keys of history known to be exported,
+    and the exported ratings of the next ones."""
+    if not os.path.exists(csv_filename):
+        return 0, {}
+
+    try:
+        with open(state_filename) as state_file:
+            state = json.load(state_file)
+        in_sync = (state['size'] == os.path.getsize(csv_filename) and
+                   state['n_closed'] <= len(history) and
+                   state['digest'] == ratings_digest(history,
+                                                     state['n_closed']))
+    except (OSError, ValueError, KeyError, TypeError):
+        in_sync = False
+
+    if not in_sync:
+        # Compare with all of the exported rows instead.
+        return 0, load_ratings_long(csv_filename)
+
+    exported = {(stage, match_number): {
+                    name: RoundedRating(*rounded)
+                    for name, rounded in ratings.items()}
+                for stage, match_number, ratings in state['open']}
+    return state['n_closed'], exported
+
+
+def save_ratings_long_state(history: RatingsHistory, csv_filename: str,
+                            state_filename: str) -> None:
+    n_closed = count_closed_keys(history)
+    state = {
+        'size': os.path.getsize(csv_filename),
+        'n_closed': n_closed,
+        'digest': ratings_digest(history, n_closed),
+        'open': [[stage, match_number, ratings]
+                 for (stage, match_number), ratings in islice(
+                     history.items(), n_closed, None)],
+    }
+    with open(state_filename, 'w') as state_file:
+        json.dump(state, state_file)
+
+
+def load_ratings_long(csv_filename: str = RATINGS_LONG_CSV) -> RatingsHistory:
+    """Load a long csv file as a history, ordered by the first appearance
+    of each (stage, match_number). Later rows replace earlier ones."""
+    history = OrderedDict()
+    if not os.path.exists(csv_filename):
+        return history
+
+    with open(csv_filename, newline='') as csv_file:
+        reader = csv_reader(csv_file)
+        next(reader, None)  # Skip the header line.
+
+        for stage, match_number, name, mu, sigma in reader:
+            ratings = history.setdefault((stage, int(match_number)), {})
+            ratings[name] = RoundedRating(mu=int(mu), sigma=int(sigma))
+
+    return history
+
+
+def pivot_ratings_history(mu, sigma, long_filename: str = RATINGS_LONG_CSV,
+                          csv_filename: str = RATINGS_CSV) -> None:
+    """Write the wide csv file of save_ratings_history() from a long csv
+    file."""
+    save_ratings_history(load_ratings_long(long_filename), mu=mu, sigma=sigma,
+                         csv_filename=csv_filename)
+
+
 if __name__ == '__main__':
-    games = fetch_games()
-    save_games(games)
+    sync_games(full='--full' in sys.argv)
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import NamedTuple, Set, Tuple
+from typing import FrozenSet, NamedTuple, Tuple
 
 DRAWABLE_MAPS = set([
     'hanamura', 'horizon-lunar-colony', 'temple-of-anubis', 'volskaya',
@@ -33,8 +33,10 @@ TEAM_DIVISIONS = {
     'WAS': 'ATL'
 }
 
+# Rosters are sorted tuples & full rosters frozensets, so that both are
+# hashable and iterate in a fixed order.
 Roster = Tuple[str, str, str, str, str, str]
-FullRoster = Set[str]
+FullRoster = FrozenSet[str]
 
 
 class Game(NamedTuple):
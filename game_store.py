@@ -0,0 +1,248 @@
+from collections import OrderedDict
+from csv import reader as csv_reader, writer as csv_writer
+from datetime import datetime
+from heapq import merge
+from itertools import groupby
+import os
+import time
+from typing import Callable, Iterable, Iterator, List, NamedTuple
+
+from game import Game
+
+GAMES_CSV = 'games.csv'
+JOURNAL_SUFFIX = '.journal'
+
+
+class CSVGame(NamedTuple):
+    """Describe a single game in a CSV file."""
+    match_id: int
+    stage: str
+    start_time: datetime
+    team1: str
+    team2: str
+    match_format: str
+
+    game_id: int = None
+    game_number: int = None
+    map_name: str = None
+    score1: int = None
+    score2: int = None
+    roster1: str = None
+    roster2: str = None
+    full_roster1: str = None
+    full_roster2: str = None
+
+
+def join_names(names: List[str]) -> str:
+    return '|'.join(sorted(names))
+
+
+def split_names(names_str: str) -> List[str]:
+    return set(names_str.split('|'))
+
+
+def csv_game_to_game(csv_game: CSVGame) -> Game:
+    """Convert a row read from a csv file to a game, which is a future game
+    if it has no game id."""
+    match_id = int(csv_game.match_id)
+    stage = csv_game.stage
+    start_time = datetime.strptime(csv_game.start_time, '%Y-%m-%d %H:%M:%S')
+    teams = (csv_game.team1, csv_game.team2)
+    match_format = csv_game.match_format
+    full_rosters = (frozenset(split_names(csv_game.full_roster1)),
+                    frozenset(split_names(csv_game.full_roster2)))
+
+    if not csv_game.game_id:
+        return Game(match_id=match_id, stage=stage, start_time=start_time,
+                    teams=teams, match_format=match_format,
+                    full_rosters=full_rosters)
+
+    game_id = int(csv_game.game_id)
+    game_number = int(csv_game.game_number)
+    map_name = csv_game.map_name
+    score = (int(csv_game.score1), int(csv_game.score2))
+    # Sorted, so that ratings are summed in the same order in every process.
+    rosters = (tuple(sorted(split_names(csv_game.roster1))),
+               tuple(sorted(split_names(csv_game.roster2))))
+
+    return Game(match_id=match_id, stage=stage, start_time=start_time,
+                teams=teams, match_format=match_format, game_id=game_id,
+                game_number=game_number, map_name=map_name, score=score,
+                rosters=rosters, full_rosters=full_rosters)
+
+
+def match_key(csv_game: CSVGame):
+    return csv_game.match_id
+
+
+def start_time_key(csv_game: CSVGame) -> str:
+    # The '%Y-%m-%d %H:%M:%S' format sorts chronologically as a string.
+    return csv_game.start_time
+
+
+class GameStore(object):
+    """A games csv file plus an append-only journal of newer rows.
+
+    Rows are appended to the journal as games finish, and merged into the
+    csv file once the journal has compact_every rows. Readers stream the
+    games of both in chronological order, a row replacing an earlier one
+    of the same game, and the played games of a match replacing its
+    unplayed row. Appended rows are expected to keep the start times of
+    their matches."""
+
+    def __init__(self, csv_filename: str = GAMES_CSV,
+                 journal_filename: str = None,
+                 compact_every: int = 1000) -> None:
+        super().__init__()
+
+        self.csv_filename = csv_filename
+        if journal_filename is None:
+            journal_filename = csv_filename + JOURNAL_SUFFIX
+        self.journal_filename = journal_filename
+        self.compact_every = compact_every
+        self._journal_rows = None
+
+    def append(self, csv_games: Iterable[CSVGame]) -> None:
+        """Append rows to the journal, compacting it when it is long
+        enough."""
+        csv_games = list(csv_games)
+        journal_rows = self.journal_rows
+        with open(self.journal_filename, 'a', newline='') as journal_file:
+            csv_writer(journal_file).writerows(csv_games)
+        self._journal_rows = journal_rows + len(csv_games)
+
+        if self._journal_rows >= self.compact_every:
+            self.compact()
+
+    @property
+    def journal_rows(self) -> int:
+        """The number of rows in the journal, only counted on first use, so
+        other writers of the journal are not seen."""
+        if self._journal_rows is None:
+            self._journal_rows = len(self._journal())
+        return self._journal_rows
+
+    def compact(self) -> None:
+        """Merge the journal into the csv file."""
+        self.rewrite(self.csv_games())
+
+    def rewrite(self, csv_games: Iterable[CSVGame]) -> None:
+        """Replace all the rows with csv_games, leaving an empty journal."""
+        temp_filename = self.csv_filename + '.tmp'
+        with open(temp_filename, 'w', newline='') as csv_file:
+            writer = csv_writer(csv_file)
+            writer.writerow(CSVGame._fields)  # Write headers.
+            writer.writerows(csv_games)
+        os.replace(temp_filename, self.csv_filename)
+
+        # Replaced rather than truncated, so that follow() sees a new file.
+        temp_filename = self.journal_filename + '.tmp'
+        open(temp_filename, 'w').close()
+        os.replace(temp_filename, self.journal_filename)
+        self._journal_rows = 0
+
+    def csv_games(self) -> Iterator[CSVGame]:
+        """Stream the merged rows in chronological order. Only the journal
+        & the rows of one start time are held in memory."""
+        return merge_rows(self._csv_rows(), self._journal())
+
+    def games(self) -> Iterator[Game]:
+        """Stream past & future games in chronological order."""
+        return map(csv_game_to_game, self.csv_games())
+
+    def past_games(self) -> Iterator[Game]:
+        return (game for game in self.games() if game.score is not None)
+
+    def future_games(self) -> Iterator[Game]:
+        return (game for game in self.games() if game.score is None)
+
+    def follow(self, poll_interval: float = 1.0,
+               stop: Callable[[], bool] = None) -> Iterator[Game]:
+        """Yield the games appended to the journal from now on, polling it
+        every poll_interval seconds until stop() returns True."""
+        position = self._journal_size()
+        inode = self._journal_inode()
+        pending = b''
+
+        while stop is None or not stop():
+            if (self._journal_inode() != inode or
+                    self._journal_size() < position):
+                # Compacted, follow the new journal from its start.
+                position = 0
+                inode = self._journal_inode()
+                pending = b''
+
+            if inode is not None:
+                with open(self.journal_filename, 'rb') as journal_file:
+                    journal_file.seek(position)
+                    pending += journal_file.read()
+                    position = journal_file.tell()
+
+            # Only parse complete lines, the rest may be half written.
+            lines = pending.splitlines(keepends=True)
+            if lines and not lines[-1].endswith(b'\n'):
+                pending = lines.pop()
+            else:
+                pending = b''
+
+            if lines:
+                for row in csv_reader(line.decode() for line in lines):
+                    yield csv_game_to_game(CSVGame._make(row))
+            else:
+                time.sleep(poll_interval)
+
+    def _csv_rows(self) -> Iterator[CSVGame]:
+        if not os.path.exists(self.csv_filename):
+            return
+
+        with open(self.csv_filename, newline='') as csv_file:
+            reader = csv_reader(csv_file)
+            next(reader, None)  # Skip the header line.
+            yield from map(CSVGame._make, reader)
+
+    def _journal(self) -> List[CSVGame]:
+        if not os.path.exists(self.journal_filename):
+            return []
+
+        with open(self.journal_filename, newline='') as journal_file:
+            return [CSVGame._make(row) for row in csv_reader(journal_file)]
+
+    def _journal_size(self) -> int:
+        if not os.path.exists(self.journal_filename):
+            return 0
+        return os.path.getsize(self.journal_filename)
+
+    def _journal_inode(self):
+        if not os.path.exists(self.journal_filename):
+            return None
+        return os.stat(self.journal_filename).st_ino
+
+
+def merge_rows(csv_games: Iterable[CSVGame],
+               journal: List[CSVGame]) -> Iterator[CSVGame]:
+    """Merge chronological rows with the rows of a journal, see
+    GameStore."""
+    journal = sorted(journal, key=start_time_key)
+    rows = merge(csv_games, journal, key=start_time_key)
+
+    for _, same_time_rows in groupby(rows, key=start_time_key):
+        matches = OrderedDict()
+        for csv_game in same_time_rows:
+            matches.setdefault(match_key(csv_game), []).append(csv_game)
+
+        for match_rows in matches.values():
+            yield from merge_match_rows(match_rows)
+
+
+def merge_match_rows(csv_games: List[CSVGame]) -> List[CSVGame]:
+    """Merge the rows of a match, older first. Later rows replace earlier
+    ones of the same game, and played games replace the unplayed row."""
+    games = OrderedDict()
+    for csv_game in csv_games:
+        games[csv_game.game_id] = csv_game
+
+    played = [csv_game for game_id, csv_game in games.items() if game_id]
+    if not played:
+        return list(games.values())
+
+    return sorted(played, key=lambda csv_game: int(csv_game.game_number))
@@ -1,23 +1,120 @@
 from collections import defaultdict, deque, OrderedDict
-from functools import cmp_to_key
-from itertools import chain
+from functools import lru_cache
 import json
-from math import log, sqrt
-from random import choices, random
-from typing import Dict, List, Sequence, Set, Tuple
+from math import log, prod, sqrt
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
 
 import numpy as np
-from scipy.optimize import fmin
+from scipy.special import ndtr
 from trueskill import calc_draw_margin, Rating, TrueSkill
 
-from game import FullRoster, Game, Roster, TEAMS, TEAM_DIVISIONS
-from fetcher import (load_games,
+from game import FullRoster, Game, Roster, TEAMS
+from checkpoint import resume
+from compiled import CompiledGames
+from cow import CowDict
+from fetcher import (append_ratings_history,
+                     load_games,
                      save_ratings_history)
+from ratings import rate_two_teams_at, RatingStore
+from simulator import (RatingDynamics, StageEnumerator, StageSimulator,
+                       TEAM_ORDER)
 
 
 PScores = Dict[Tuple[int, int], float]
 
 
+# Match format => drawable flags of the maps & wins needed.
+MATCH_FORMATS = {
+    'preseason': ((True, False, True, False), 4),
+    'regular': ((True, False, True, False), 4),
+    'best-of-5': ((False, False, False, False, False), 3),
+    'best-of-7': ((False, False, False, False, False, False, False), 4),
+}
+
+
+def bo_score_grid(p_undrawable: np.ndarray, p_drawable: np.ndarray,
+                  drawables: Sequence[bool], max_wins: int) -> np.ndarray:
+    """Given (pairs, 2) arrays of win/draw probabilities on undrawable &
+    drawable maps, return a (pairs, max_wins + 1, max_wins + 1) grid of the
+    probabilities of BO match scores, indexed [pair, score1, score2]."""
+    p_undrawable = np.asarray(p_undrawable, dtype=float).reshape(-1, 2)
+    p_drawable = np.asarray(p_drawable, dtype=float).reshape(-1, 2)
+    grid = np.zeros((len(p_undrawable), max_wins + 1, max_wins + 1))
+    grid[:, 0, 0] = 1.0
+
+    for drawable in drawables:
+        p = p_drawable if drawable else p_undrawable
+        p_win = p[:, 0, None, None]
+        p_draw = p[:, 1, None, None]
+        p_loss = 1.0 - p_win - p_draw
+
+        # Only unfinished matches go on, finished ones stay in the last row
+        # or column.
+        unfinished = grid[:, :max_wins, :max_wins].copy()
+        grid[:, :max_wins, :max_wins] = unfinished * p_draw if drawable else 0
+        grid[:, 1:, :max_wins] += unfinished * p_win
+        grid[:, :max_wins, 1:] += unfinished * p_loss
+
+    # Add a tie-breaker game if needed.
+    p_win = p_undrawable[:, 0, None]
+    p_loss = 1.0 - p_win - p_undrawable[:, 1, None]
+    scores = np.arange(max_wins)
+    tied = grid[:, scores, scores].copy()
+    grid[:, scores, scores] = 0.0
+    grid[:, scores + 1, scores] += tied * p_win
+    grid[:, scores, scores + 1] += tied * p_loss
+
+    return grid
+
+
+@lru_cache()
+def bo_scores(drawables: Tuple[bool, ...],
+              max_wins: int) -> List[Tuple[int, int]]:
+    """Return all the possible scores of a BO match."""
+    p = np.full(2, 1.0 / 3.0)
+    grid = bo_score_grid(p, p, drawables, max_wins)[0]
+
+    return list(zip(*(scores.tolist() for scores in np.nonzero(grid))))
+
+
+@lru_cache()
+def load_initial_ratings(filename: str) -> Dict[str, Tuple[float, float]]:
+    """Load {name: (mu, sigma)} once per file."""
+    with open(filename) as json_file:
+        ratings = json.load(json_file)
+
+    return {name: (rating['mu'], rating['sigma'])
+            for name, rating in ratings.items()}
+
+
+def score_point(score: Tuple[int, int],
+                prediction: Tuple[float, float]) -> Tuple[float, bool]:
+    """Return the prediction point of an undrawable prediction for a game
+    which isn't a draw, and whether it picked the winner."""
+    p_win, p_draw = prediction
+    p_win = max(0.0, min(p_win, 1.0))
+    p_draw = max(0.0, min(p_draw, 1.0))
+    p_loss = 1.0 - p_win - p_draw
+
+    if score[0] > score[1]:
+        p = p_win
+        correct = p_win > p_loss
+    else:
+        p = p_loss
+        correct = p_win < p_loss
+
+    return log(2.0 * p), correct
+
+
+def roster_fingerprint(rosters) -> Optional[tuple]:
+    """Return a hashable form of a roster pair. Rosters of games are sorted
+    tuples & frozensets already, and are kept as is."""
+    if rosters is None:
+        return None
+    return tuple(roster if isinstance(roster, (tuple, frozenset))
+                 else frozenset(roster) for roster in rosters)
+
+
 class Predictor(object):
     """Base class for all OWL predictors."""
 
@@ -28,7 +125,7 @@ class Predictor(object):
         # Track recent used rosters.
         self.roster_queues = defaultdict(
             lambda: deque(maxlen=roster_queue_size))
-        self.last_full_rosters = defaultdict(set)
+        self.last_full_rosters = defaultdict(frozenset)
 
         # Season standings.
         self.wins = defaultdict(int)
@@ -49,6 +146,8 @@ class Predictor(object):
         self.stage_title_losses = defaultdict(int)
         self.playoff_wins = defaultdict(int)
         self.playoff_losses = defaultdict(int)
+        # Iterations used by the last stage prediction, 0 if it was exact.
+        self.stage_iters = 0
 
         # Match standings.
         self.match_id = None
@@ -65,6 +164,83 @@ class Predictor(object):
         self.points = []
         self.corrects = []
 
+        # Cached predictions, dropped when either team is trained or the
+        # rating of any player they read is written.
+        self.prediction_cache = {}
+        # name => keys of the cached predictions reading it.
+        self.prediction_cache_keys = defaultdict(set)
+
+    def __getstate__(self):
+        # Forks keep their dicts copy-on-write, save them as plain ones.
+        state = {name: value.copy() if isinstance(value, CowDict) else value
+                 for name, value in self.__dict__.items()}
+
+        # Lambdas can't be pickled, keep plain dicts instead.
+        state['roster_queues'] = dict(self.roster_queues)
+        state['match_history'] = {stage: dict(history) for stage, history
+                                  in self.match_history.items()}
+        # Don't keep the caches.
+        state['prediction_cache'] = {}
+        state['prediction_cache_keys'] = defaultdict(set)
+
+        return state
+
+    def __setstate__(self, state) -> None:
+        self.__dict__.update(state)
+
+        self.roster_queues = defaultdict(
+            lambda: deque(maxlen=self.roster_queue_size),
+            state['roster_queues'])
+        self.match_history = defaultdict(
+            lambda: defaultdict(list),
+            {stage: defaultdict(list, history)
+             for stage, history in state['match_history'].items()})
+
+    def fork(self) -> 'Predictor':
+        """Return an independent copy, which shares the unchanged state with
+        this predictor copy-on-write, so that many what-if scenarios can be
+        forked.
+
+        The fork reads the dicts of this predictor through CowDicts, and this
+        predictor keeps plain shallow copies of them, so that only forks pay
+        for the copy-on-write lookups. Forks of forks share their layers."""
+        fork = object.__new__(type(self))
+        fork.__dict__.update(self.__dict__)
+
+        for name, value in self.__dict__.items():
+            if name in ('score', 'prediction_cache', 'prediction_cache_keys'):
+                continue
+
+            if isinstance(value, (CowDict, RatingStore)):
+                setattr(fork, name, value.fork())
+            elif isinstance(value, dict):
+                setattr(fork, name, CowDict.wrap(value))
+                setattr(self, name, value.copy())
+            elif isinstance(value, list):
+                setattr(fork, name, value.copy())
+
+        fork.prediction_cache = {}
+        fork.prediction_cache_keys = defaultdict(set)
+
+        self._own_mutable_state()
+        fork._own_mutable_state()
+
+        return fork
+
+    def _own_mutable_state(self) -> None:
+        """Copy the shared values which are mutated in place by training."""
+        if self.score is not None:
+            self.score = dict(self.score)
+            self.scores[self.match_id] = self.score
+
+        for team, roster_queue in self.roster_queues.items():
+            self.roster_queues[team] = roster_queue.copy()
+
+        if self.stage is not None:
+            self.match_history[self.stage] = defaultdict(
+                list, {team: match_ids.copy() for team, match_ids
+                       in self.match_history[self.stage].items()})
+
     @property
     def stage_finished(self):
         return sum(self.stage_title_losses.values()) == 3
@@ -80,45 +256,74 @@ class Predictor(object):
         """Given two teams, return win/draw probabilities of them."""
         raise NotImplementedError
 
+    def predict_many(self, pairs: Sequence[Tuple[str, str]],
+                     rosters: Sequence[Tuple[Roster, Roster]] = None,
+                     full_rosters: Sequence[Tuple[FullRoster,
+                                                  FullRoster]] = None,
+                     drawable: bool = False) -> np.ndarray:
+        """Given team pairs, return a (pairs, 2) array of win/draw
+        probabilities of them."""
+        if rosters is None:
+            rosters = [None] * len(pairs)
+        if full_rosters is None:
+            full_rosters = [None] * len(pairs)
+
+        predictions = [self.predict(teams, rosters=roster_pair,
+                                    full_rosters=full_roster_pair,
+                                    drawable=drawable)
+                       for teams, roster_pair, full_roster_pair
+                       in zip(pairs, rosters, full_rosters)]
+
+        return np.array(predictions, dtype=float).reshape(-1, 2)
+
+    def predict_both(self, teams: Tuple[str, str],
+                     rosters: Tuple[Roster, Roster] = None,
+                     full_rosters: Tuple[FullRoster, FullRoster] = None
+                     ) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+        """Given two teams, return win/draw probabilities of them on
+        undrawable & drawable maps. Subclasses can override this to share
+        the work of both."""
+        return tuple(self.predict(teams, rosters=rosters,
+                                  full_rosters=full_rosters,
+                                  drawable=drawable)
+                     for drawable in (False, True))
+
     def train(self, game: Game) -> float:
         """Given a game result, train the underlying model.
         Return the prediction point for this game before training."""
-        point, correct = self.evaluate(game)
+        undrawable, drawable = self.predict_both(game.teams,
+                                                 rosters=game.rosters)
+        point, correct = self.evaluate(game, prediction=undrawable)
         self.points.append(point)
         self.corrects.append(correct)
 
         self._update_rosters(game)
         self._update_standings(game)
-        self._update_draws(game)
+        self._update_draws(game, prediction=drawable)
 
         self._train(game)
+        self._invalidate_predictions(game.teams)
 
         return point
 
-    def evaluate(self, game: Game) -> Tuple[float, bool]:
+    def evaluate(self, game: Game,
+                 prediction: Tuple[float, float] = None
+                 ) -> Tuple[float, bool]:
         """Return the prediction point for this game.
-        Assume it will not draw."""
+        Assume it will not draw. prediction is the undrawable prediction
+        if it's already known."""
         if game.score[0] == game.score[1]:
             return 0.0, False
 
-        p_win, p_draw = self.predict(game.teams, rosters=game.rosters,
-                                     drawable=False)
-        p_win = max(0.0, min(p_win, 1.0))
-        p_draw = max(0.0, min(p_draw, 1.0))
-        p_loss = 1.0 - p_win - p_draw
-
-        if game.score[0] > game.score[1]:
-            p = p_win
-            correct = p_win > p_loss
-        else:
-            p = p_loss
-            correct = p_win < p_loss
+        if prediction is None:
+            prediction = self.predict(game.teams, rosters=game.rosters,
+                                      drawable=False)
 
-        return log(2.0 * p), correct
+        return score_point(game.score, prediction)
 
-    def train_games(self, games: Sequence[Game]) -> float:
-        """Given a sequence of games, train the underlying model.
-        Return the prediction point for all the games."""
+    def train_games(self, games: Iterable[Game]) -> float:
+        """Given a sequence of games or CompiledGames, train the underlying
+        model. Return the prediction point for all the games."""
         total_point = 0.0
 
         for game in games:
@@ -127,22 +332,33 @@ class Predictor(object):
 
         return total_point
 
+    def train_ratings(self, games: CompiledGames) -> float:
+        """Train the model on compiled games, only as far as the points,
+        corrects & draws need, which is enough for tuning. Return the
+        prediction point for all the games. Subclasses can read the index
+        arrays of the games instead of decoding them, by default they are
+        fully trained on."""
+        return self.train_games(games)
+
     def predict_match_score(self, match: Game) -> PScores:
         """Predict the scores of a given match."""
-        if match.match_format in ('preseason', 'regular'):
-            drawables = [True, False, True, False]
-            max_wins = 4
-        elif match.match_format in ('best-of-5'):
-            drawables = [False, False, False, False, False]
-            max_wins = 3
-        elif match.match_format in ('best-of-7'):
-            drawables = [False, False, False, False, False, False, False]
-            max_wins = 4
-        else:
+        if match.match_format not in MATCH_FORMATS:
             raise NotImplementedError
-        return self._predict_bo_score(match.teams, rosters=match.rosters,
-                                      full_rosters=match.full_rosters,
-                                      drawables=drawables, max_wins=max_wins)
+        drawables, max_wins = MATCH_FORMATS[match.match_format]
+
+        self._drop_stale_predictions()
+        key = self._prediction_key(match.teams, match.rosters,
+                                   match.full_rosters, match.match_format)
+        p_scores = self.prediction_cache.get(key)
+        if p_scores is None:
+            p_scores = self._predict_bo_score(match.teams,
+                                              rosters=match.rosters,
+                                              full_rosters=match.full_rosters,
+                                              drawables=drawables,
+                                              max_wins=max_wins)
+            self._cache_prediction(key, p_scores)
+
+        return p_scores.copy()
 
     def predict_match(self, match: Game) -> Tuple[float, float]:
         """Predict the win probability & diff expectation of a given match."""
@@ -157,10 +373,98 @@ class Predictor(object):
 
         return p_win, e_diff
 
-    def predict_stage(self, matches: Sequence[Game]):
+    def predict_matches(self,
+                        matches: Sequence[Game]) -> List[Tuple[float, float]]:
+        """Same as predict_match(), but for many matches at once."""
+        predictions = [None] * len(matches)
+
+        for match in matches:
+            if match.match_format not in MATCH_FORMATS:
+                raise NotImplementedError
+
+        for match_format, (drawables, max_wins) in MATCH_FORMATS.items():
+            indices = [i for i, match in enumerate(matches)
+                       if match.match_format == match_format]
+            if len(indices) == 0:
+                continue
+
+            pairs = [matches[i].teams for i in indices]
+            rosters = [matches[i].rosters for i in indices]
+            full_rosters = [matches[i].full_rosters for i in indices]
+            grid = bo_score_grid(
+                self.predict_many(pairs, rosters=rosters,
+                                  full_rosters=full_rosters, drawable=False),
+                self.predict_many(pairs, rosters=rosters,
+                                  full_rosters=full_rosters, drawable=True),
+                drawables, max_wins)
+
+            scores = np.arange(max_wins + 1)
+            p_wins = np.tril(grid, k=-1).sum(axis=(1, 2))
+            e_diffs = (grid * (scores[:, None] - scores)).sum(axis=(1, 2))
+
+            for i, p_win, e_diff in zip(indices, p_wins.tolist(),
+                                        e_diffs.tolist()):
+                predictions[i] = (p_win, e_diff)
+
+        return predictions
+
+    def _cached_predict(self, teams: Tuple[str, str],
+                        rosters: Tuple[Roster, Roster] = None,
+                        full_rosters: Tuple[FullRoster, FullRoster] = None,
+                        drawable: bool = False) -> Tuple[float, float]:
+        """Same as predict(), but cached until either team is trained or
+        a rating it reads is written."""
+        self._drop_stale_predictions()
+        key = self._prediction_key(teams, rosters, full_rosters, drawable)
+        prediction = self.prediction_cache.get(key)
+        if prediction is None:
+            prediction = self.predict(teams, rosters=rosters,
+                                      full_rosters=full_rosters,
+                                      drawable=drawable)
+            self._cache_prediction(key, prediction)
+
+        return prediction
+
+    def _prediction_key(self, teams: Tuple[str, str],
+                        rosters: Tuple[Roster, Roster],
+                        full_rosters: Tuple[FullRoster, FullRoster],
+                        kind) -> tuple:
+        """Return a cache key of a prediction. kind is the match format,
+        whether it's drawable, or ('p_win', match format) for the win
+        probabilities of _p_wins()."""
+        return (tuple(teams), roster_fingerprint(rosters),
+                roster_fingerprint(full_rosters), kind)
+
+    def _cache_prediction(self, key: tuple, prediction) -> None:
+        self.prediction_cache[key] = prediction
+        for name in self._prediction_names(*key[:3]):
+            self.prediction_cache_keys[name].add(key)
+
+    def _prediction_names(self, teams: Tuple[str, str],
+                          rosters: Tuple[Roster, Roster],
+                          full_rosters: Tuple[FullRoster, FullRoster]
+                          ) -> Set[str]:
+        """Return the names of the teams & players whose ratings a
+        prediction reads."""
+        return set(teams)
+
+    def _invalidate_predictions(self, names: Iterable[str]) -> None:
+        for name in names:
+            for key in self.prediction_cache_keys.pop(name, ()):
+                self.prediction_cache.pop(key, None)
+
+    def clear_predictions(self) -> None:
+        self.prediction_cache.clear()
+        self.prediction_cache_keys.clear()
+
+    def _drop_stale_predictions(self) -> None:
+        """Drop the cached predictions reading ratings written behind the
+        back of train(). Subclasses with ratings should override this."""
+        pass
+
+    def predict_stage(self, matches: Sequence[Game], **kws):
         matches = [match for match in matches if match.stage == self.stage and
                    match.match_format == 'regular']
-        prediction = self._predict_stage(matches)
 
         # Normalize 0% and 100% for predictions.
         wins = {team: (self.stage_wins[team], self.stage_map_diffs[team])
@@ -180,11 +484,22 @@ class Predictor(object):
         min_8th_wins = list(sorted(min_wins.values()))[-8]
         max_9th_wins = list(sorted(max_wins.values()))[-9]
 
+        eliminated = {team for team in TEAMS
+                      if max_wins[team] < min_8th_wins}
+        qualified = {team for team in TEAMS
+                     if min_wins[team] > max_9th_wins}
+        settled_teams = eliminated | {
+            team for team in qualified
+            if self.stage_title_losses[team] > 0 or self.stage_finished}
+
+        prediction = self._predict_stage(matches, settled_teams=settled_teams,
+                                         **kws)
+
         for team, (p_title, p_top1) in prediction.items():
-            if max_wins[team] < min_8th_wins:
+            if team in eliminated:
                 p_title = False
                 p_top1 = False
-            elif min_wins[team] > max_9th_wins:
+            elif team in qualified:
                 p_title = True
 
                 if self.stage_title_losses[team] > 0:
@@ -196,9 +511,24 @@ class Predictor(object):
 
         return prediction
 
-    def _predict_stage(self, matches: Sequence[Game], iters=100000):
-        # This implementation is just stupid and doesn't work during the stage
-        # playoffs. Avoid it at all costs.
+    def _predict_stage(self, matches: Sequence[Game], iters=100000,
+                       seed=None, workers=1, half_width=None,
+                       settled_teams=(), max_exact_states=50000,
+                       dynamic=False):
+        """Enumerate the outcomes exactly when their product of score lines
+        is at most max_exact_states, else simulate. The enumeration costs
+        about 8x more with each match of the regular format (12 score
+        lines), and the default covers 4 matches, which take about as long
+        as the 100000 default iterations.
+
+        If dynamic is True, simulate with ratings updated along the
+        sampled results of each iteration, instead of frozen ones. This
+        costs about 4-6x as much, and widens the distributions as ratings
+        drift with the results, e.g. a title probability of 0.17 became
+        0.25 in the middle of stage 4. Without drift, i.e. with no tau &
+        certain ratings, both simulate the same distributions."""
+        # This implementation doesn't work during the stage playoffs. Avoid
+        # it at all costs.
         full_rosters = self.last_full_rosters.copy()
         for match in matches:
             for team, full_roster in zip(match.teams, match.full_rosters):
@@ -212,96 +542,32 @@ class Predictor(object):
         p_wins_ft4 = self._p_wins(full_rosters=full_rosters,
                                   match_format='best-of-7')
 
-        title_count = {team: 0 for team in TEAMS}
-        top1_count = {team: 0 for team in TEAMS}
-
-        for _ in range(iters):
-            wins = self.stage_wins.copy()
-            map_diffs = self.stage_map_diffs.copy()
-            head_to_head_map_diffs = self.stage_head_to_head_map_diffs.copy()
-
-            for match, scores, cum_weights in zip(matches,
-                                                  scores_list,
-                                                  cum_weights_list):
-                team1, team2 = match.teams
-                score1, score2 = choices(scores, cum_weights=cum_weights)[0]
-
-                if score1 > score2:
-                    wins[team1] += 1
-                elif score1 < score2:
-                    wins[team2] += 1
-
-                map_diff = score1 - score2
-                map_diffs[team1] += map_diff
-                map_diffs[team2] -= map_diff
-
-                head_to_head_map_diffs[(team1, team2)] += map_diff
-                head_to_head_map_diffs[(team2, team1)] -= map_diff
-
-            # Determine the seeds.
-            teams = self._stage_standings(wins, map_diffs,
-                                          head_to_head_map_diffs,
-                                          p_wins_regular)
-
-            # Seed 0.
-            seeds = [teams[0]]
-            teams = teams[1:]
-
-            # Seed 1.
-            for i, team in enumerate(teams):
-                if TEAM_DIVISIONS[team] != TEAM_DIVISIONS[seeds[0]]:
-                    del teams[i]
-                    seeds.append(team)
-                    break
-
-            # Seed 2-7.
-            seeds += teams[:6]
-
-            for team in seeds:
-                title_count[team] += 1
-
-            # Determine top 1 teams.
-            # First round.
-            if random() < p_wins_ft3[(seeds[0], seeds[7])]:
-                seeds[7] = None
-            else:
-                seeds[0] = None
-            if random() < p_wins_ft3[(seeds[1], seeds[6])]:
-                seeds[6] = None
-            else:
-                seeds[1] = None
-            if random() < p_wins_ft3[(seeds[2], seeds[5])]:
-                seeds[5] = None
-            else:
-                seeds[2] = None
-            if random() < p_wins_ft3[(seeds[3], seeds[4])]:
-                seeds[4] = None
-            else:
-                seeds[3] = None
-            seeds = [team for team in seeds if team is not None]
-
-            # Semi-finals.
-            if random() < p_wins_ft4[(seeds[0], seeds[3])]:
-                seeds[3] = None
-            else:
-                seeds[0] = None
-            if random() < p_wins_ft4[(seeds[1], seeds[2])]:
-                seeds[2] = None
-            else:
-                seeds[1] = None
-            seeds = [team for team in seeds if team is not None]
-
-            # Finals.
-            if random() < p_wins_ft4[(seeds[0], seeds[1])]:
-                seeds[1] = None
-            else:
-                seeds[0] = None
-            seeds = [team for team in seeds if team is not None]
-
-            top1_count[seeds[0]] += 1
-
-        return {team: (title_count[team] / iters, top1_count[team] / iters)
-                for team in TEAMS}
+        # Enumerate all the outcomes if there are few enough.
+        if (not dynamic and
+                prod(len(scores) for scores in scores_list) <=
+                max_exact_states):
+            enumerator = StageEnumerator(self.stage_wins, self.stage_map_diffs,
+                                         self.stage_head_to_head_map_diffs,
+                                         matches, scores_list,
+                                         cum_weights_list, p_wins_regular,
+                                         p_wins_ft3, p_wins_ft4)
+            self.stage_iters = 0
+
+            return enumerator.run()
+
+        simulator = StageSimulator(self.stage_wins, self.stage_map_diffs,
+                                   self.stage_head_to_head_map_diffs,
+                                   matches, scores_list, cum_weights_list,
+                                   p_wins_regular, p_wins_ft3, p_wins_ft4,
+                                   dynamics=self._rating_dynamics(
+                                       full_rosters, matches)
+                                   if dynamic else None)
+        counts = simulator.run(iters, seed=seed, workers=workers,
+                               half_width=half_width,
+                               settled_teams=settled_teams)
+        self.stage_iters = counts.iters
+
+        return counts.probabilities()
 
     # def predict_season(self, matches: Sequence[Game]):
     #     matches = [match for match in matches
@@ -487,54 +753,18 @@ class Predictor(object):
     def _predict_bo_score(self, teams: Tuple[str, str],
                           rosters: Tuple[Roster, Roster],
                           full_rosters: Tuple[FullRoster, FullRoster],
-                          drawables: List[bool], max_wins: int) -> PScores:
+                          drawables: Sequence[bool], max_wins: int) -> PScores:
         """Predict the scores of a given BO match."""
-        p_scores = defaultdict(float)
-        p_finished_scores = defaultdict(float)
-        p_scores[(0, 0)] = 1.0
-
-        p_undrawable = self.predict(teams, rosters=rosters,
-                                    full_rosters=full_rosters, drawable=False)
-        p_drawable = self.predict(teams, rosters=rosters,
-                                  full_rosters=full_rosters, drawable=True)
-
-        for drawable in drawables:
-            p_win, p_draw = p_drawable if drawable else p_undrawable
-            p_loss = 1.0 - p_win - p_draw
-            new_p_scores = defaultdict(float)
-
-            for (score1, score2), p in p_scores.items():
-                if score1 + 1 == max_wins:
-                    p_finished_scores[(score1 + 1, score2)] += p * p_win
-                else:
-                    new_p_scores[(score1 + 1, score2)] += p * p_win
-                if score2 + 1 == max_wins:
-                    p_finished_scores[(score1, score2 + 1)] += p * p_loss
-                else:
-                    new_p_scores[(score1, score2 + 1)] += p * p_loss
-                if drawable:
-                    new_p_scores[(score1, score2)] += p * p_draw
-
-            p_scores = new_p_scores
-
-        # Add a tie-breaker game if needed.
-        p_win, p_draw = p_undrawable
-        new_p_scores = defaultdict(float)
-
-        for (score1, score2), p in p_scores.items():
-            if score1 == score2:
-                new_p_scores[(score1 + 1, score2)] += p * p_win
-                new_p_scores[(score1, score2 + 1)] += p * p_loss
-            else:
-                new_p_scores[(score1, score2)] += p
+        p_undrawable = self._cached_predict(teams, rosters=rosters,
+                                            full_rosters=full_rosters,
+                                            drawable=False)
+        p_drawable = self._cached_predict(teams, rosters=rosters,
+                                          full_rosters=full_rosters,
+                                          drawable=True)
+        grid = bo_score_grid(p_undrawable, p_drawable, drawables, max_wins)[0]
 
-        p_scores = new_p_scores
-
-        # Merge finished scores back.
-        for scores, p in p_finished_scores.items():
-            p_scores[scores] += p
-
-        return p_scores
+        return {(score1, score2): grid[score1, score2].item()
+                for score1, score2 in bo_scores(tuple(drawables), max_wins)}
 
     def _update_rosters(self, game: Game) -> None:
         for team, roster, full_roster in zip(game.teams, game.rosters,
@@ -640,10 +870,13 @@ class Predictor(object):
 
             self.score[winner] += 1
 
-    def _update_draws(self, game: Game) -> None:
+    def _update_draws(self, game: Game,
+                      prediction: Tuple[float, float] = None) -> None:
         if game.drawable:
-            _, p_draw = self.predict(game.teams, rosters=game.rosters,
-                                     drawable=True)
+            if prediction is None:
+                prediction = self.predict(game.teams, rosters=game.rosters,
+                                          drawable=True)
+            _, p_draw = prediction
             self.expected_draws += p_draw
         if game.score[0] == game.score[1]:
             self.real_draws += 1.0
@@ -669,22 +902,47 @@ class Predictor(object):
         return scores_list, cum_weights_list
 
     def _p_wins(self, full_rosters: Dict[str, FullRoster], match_format: str):
-        p_wins = {}
-
-        for team1 in TEAMS:
-            for team2 in TEAMS:
-                if team1 == team2:
-                    continue
-
-                team_pair = (team1, team2)
-                full_roster_pair = (full_rosters[team1], full_rosters[team2])
-
-                match = Game(teams=team_pair, match_format=match_format,
-                             full_rosters=full_roster_pair)
-                p_win, _ = self.predict_match(match)
-                p_wins[team_pair] = p_win
-
-        return p_wins
+        if match_format not in MATCH_FORMATS:
+            raise NotImplementedError
+        drawables, max_wins = MATCH_FORMATS[match_format]
+
+        self._drop_stale_predictions()
+        team_pairs = [(team1, team2) for team1 in TEAMS for team2 in TEAMS
+                      if team1 != team2]
+        full_roster_pairs = [(full_rosters[team1], full_rosters[team2])
+                             for team1, team2 in team_pairs]
+        keys = [self._prediction_key(teams, None, full_roster_pair,
+                                     ('p_win', match_format))
+                for teams, full_roster_pair in zip(team_pairs,
+                                                   full_roster_pairs)]
+
+        # Only predict the pairs which aren't cached.
+        missing = [i for i, key in enumerate(keys)
+                   if key not in self.prediction_cache]
+        if missing:
+            pairs = [team_pairs[i] for i in missing]
+            pairs_full_rosters = [full_roster_pairs[i] for i in missing]
+            p_undrawable = self.predict_many(pairs,
+                                             full_rosters=pairs_full_rosters,
+                                             drawable=False)
+            p_drawable = self.predict_many(pairs,
+                                           full_rosters=pairs_full_rosters,
+                                           drawable=True)
+
+            # Team 1 wins when score1 > score2, below the diagonal.
+            grid = bo_score_grid(p_undrawable, p_drawable, drawables,
+                                 max_wins)
+            p_wins = np.tril(grid, k=-1).sum(axis=(1, 2))
+            for i, p_win in zip(missing, p_wins.tolist()):
+                self._cache_prediction(keys[i], p_win)
+
+        return {teams: self.prediction_cache[key]
+                for teams, key in zip(team_pairs, keys)}
+
+    def _rating_dynamics(self, full_rosters: Dict[str, FullRoster],
+                         matches: Sequence[Game]) -> RatingDynamics:
+        """Return the rating state to simulate matches dynamically."""
+        raise NotImplementedError
 
     def _p_playoff_series_wins(self, full_rosters: Dict[str, FullRoster]):
         p_wins = {}
@@ -696,54 +954,6 @@ class Predictor(object):
 
         return p_wins
 
-    def _stage_standings(self, wins, map_diffs, head_to_head_map_diffs,
-                         p_wins_regular):
-        def cmp_team(team1, team2):
-            if wins[team1] < wins[team2]:
-                return -1
-            elif wins[team1] > wins[team2]:
-                return 1
-            elif map_diffs[team1] < map_diffs[team2]:
-                return -1
-            elif map_diffs[team1] > map_diffs[team2]:
-                return 1
-            elif head_to_head_map_diffs[(team1, team2)] < 0:
-                return -1
-            elif head_to_head_map_diffs[(team1, team2)] > 0:
-                return 1
-            elif random() < p_wins_regular[(team1, team2)]:
-                return 1
-            else:
-                return -1
-
-        return list(sorted(TEAMS, key=cmp_to_key(cmp_team), reverse=True))
-
-    def _season_standings(self, wins, map_diffs, head_to_head_map_diffs,
-                          head_to_head_diffs, p_wins_regular):
-        def cmp_team(team1, team2):
-            if wins[team1] < wins[team2]:
-                return -1
-            elif wins[team1] > wins[team2]:
-                return 1
-            elif map_diffs[team1] < map_diffs[team2]:
-                return -1
-            elif map_diffs[team1] > map_diffs[team2]:
-                return 1
-            elif head_to_head_map_diffs[(team1, team2)] < 0:
-                return -1
-            elif head_to_head_map_diffs[(team1, team2)] > 0:
-                return 1
-            elif head_to_head_diffs[(team1, team2)] < 0:
-                return -1
-            elif head_to_head_diffs[(team1, team2)] > 0:
-                return 1
-            elif random() < p_wins_regular[(team1, team2)]:
-                return 1
-            else:
-                return -1
-
-        return list(sorted(TEAMS, key=cmp_to_key(cmp_team), reverse=True))
-
 
 class SimplePredictor(Predictor):
     """A simple predictor based on map differentials."""
@@ -789,7 +999,8 @@ class TrueSkillPredictor(Predictor):
 
     def __init__(self, mu: float = 2500.0, sigma: float = 2500.0 / 3.0,
                  beta: float = 2500.0 / 2.0, tau: float = 25.0 / 3.0,
-                 draw_probability: float = 0.06, **kws) -> None:
+                 draw_probability: float = 0.06,
+                 rate_engine: str = 'trueskill', **kws) -> None:
         super().__init__(**kws)
 
         self.mu = mu
@@ -797,12 +1008,28 @@ class TrueSkillPredictor(Predictor):
         self.beta = beta
         self.tau = tau
         self.draw_probability = draw_probability
+        # 'trueskill' for env.rate(), 'native' for the closed-form update.
+        if rate_engine not in ('trueskill', 'native'):
+            raise ValueError(f'Unknown rate engine: {rate_engine}')
+        self.rate_engine = rate_engine
 
-        self.env_drawable = TrueSkill(mu=mu, sigma=sigma, beta=beta, tau=tau,
-                                      draw_probability=draw_probability)
-        self.env_undrawable = TrueSkill(mu=mu, sigma=sigma, beta=beta, tau=tau,
-                                        draw_probability=0.0)
+        self.env_drawable, self.env_undrawable = self._create_envs()
         self.ratings = self._create_rating_jar()
+        # (team size, drawable) => draw margin.
+        self.draw_margins = {}
+
+    def __getstate__(self):
+        state = super().__getstate__()
+
+        # TrueSkill environments can't be pickled, create them again.
+        del state['env_drawable']
+        del state['env_undrawable']
+
+        return state
+
+    def __setstate__(self, state) -> None:
+        super().__setstate__(state)
+        self.env_drawable, self.env_undrawable = self._create_envs()
 
     def _train(self, game: Game) -> None:
         """Given a game result, train the underlying model.
@@ -815,11 +1042,71 @@ class TrueSkillPredictor(Predictor):
         else:
             ranks = [1, 0]  # Team 2 wins.
 
-        env = self.env_drawable if game.drawable else self.env_undrawable
-        teams_ratings = env.rate(self._teams_ratings(game.teams,
-                                                     rosters=game.rosters),
-                                 ranks=ranks)
-        self._update_teams_ratings(game, teams_ratings)
+        teams_names = self._teams_names(game.teams, rosters=game.rosters)
+        self._rate(*(self.ratings.indices_of(names) for names in teams_names),
+                   ranks=ranks, drawable=game.drawable)
+
+        self._update_teams_ratings(game)
+
+    def _rate(self, indices1: List[int], indices2: List[int],
+              ranks: List[int], drawable: bool) -> None:
+        """Update the ratings at the indices of two teams after a game."""
+        env = self.env_drawable if drawable else self.env_undrawable
+
+        if self.rate_engine == 'native':
+            size = len(indices1) + len(indices2)
+            rate_two_teams_at(self.ratings, indices1, indices2, ranks=ranks,
+                              env=env,
+                              draw_margin=self._draw_margin(size, drawable))
+        else:
+            names = self.ratings.names
+            teams_names = ([names[i] for i in indices1],
+                           [names[i] for i in indices2])
+            teams_ratings = env.rate(
+                [[self.ratings[name] for name in names]
+                 for names in teams_names], ranks=ranks)
+            for names, ratings in zip(teams_names, teams_ratings):
+                for name, rating in zip(names, ratings):
+                    self.ratings[name] = rating
+
+    def train_ratings(self, games: CompiledGames) -> float:
+        total_point = 0.0
+        sums_at = self.ratings.sums_at
+        # Most ratings change, don't bother evicting the predictions one by
+        # one.
+        self.clear_predictions()
+
+        for indices1, indices2, score, drawable in zip(
+                *self._compiled_indices(games), games.scores.tolist(),
+                games.drawable.tolist()):
+            undrawable, drawable_prediction = self._predictions_from_sums(
+                sums_at(indices1), sums_at(indices2))
+
+            if score[0] == score[1]:
+                point, correct = 0.0, False
+                ranks = [0, 0]
+                self.real_draws += 1.0
+            else:
+                point, correct = score_point(score, undrawable)
+                ranks = [0, 1] if score[0] > score[1] else [1, 0]
+            self.points.append(point)
+            self.corrects.append(correct)
+            total_point += point
+            if drawable:
+                self.expected_draws += drawable_prediction[1]
+
+            self._rate(indices1, indices2, ranks=ranks, drawable=drawable)
+
+        return total_point
+
+    def _compiled_indices(self, games: CompiledGames
+                          ) -> Tuple[List[List[int]], List[List[int]]]:
+        """Return the rating indices of both teams of each compiled game."""
+        indices = self.ratings.indices_of(games.teams)
+        team_ids = games.team_ids.tolist()
+
+        return ([[indices[team_id1]] for team_id1, _ in team_ids],
+                [[indices[team_id2]] for _, team_id2 in team_ids])
 
     def predict(self, teams: Tuple[str, str],
                 rosters: Tuple[Roster, Roster] = None,
@@ -828,15 +1115,15 @@ class TrueSkillPredictor(Predictor):
         """Given two teams, return win/draw probabilities of them."""
         env = self.env_drawable if drawable else self.env_undrawable
 
-        team1_ratings, team2_ratings = self._teams_ratings(
-            teams, rosters=rosters, full_rosters=full_rosters)
-        size = len(team1_ratings) + len(team2_ratings)
+        names1, names2 = self._teams_names(teams, rosters=rosters,
+                                           full_rosters=full_rosters)
+        sum_mu1, sum_sigma1, size1 = self.ratings.sums(names1)
+        sum_mu2, sum_sigma2, size2 = self.ratings.sums(names2)
+        size = size1 + size2
 
-        delta_mu = (sum(r.mu for r in team1_ratings) -
-                    sum(r.mu for r in team2_ratings))
-        draw_margin = calc_draw_margin(env.draw_probability, size, env=env)
-        sum_sigma = sum(r.sigma**2 for r in chain(team1_ratings,
-                                                  team2_ratings))
+        delta_mu = sum_mu1 - sum_mu2
+        draw_margin = self._draw_margin(size, drawable)
+        sum_sigma = sum_sigma1 + sum_sigma2
         denom = sqrt(size * env.beta**2 + sum_sigma)
 
         p_win = env.cdf((delta_mu - draw_margin) / denom)
@@ -844,17 +1131,167 @@ class TrueSkillPredictor(Predictor):
 
         return p_win, p_not_loss - p_win
 
-    def _teams_ratings(self, teams: Tuple[str, str],
-                       rosters: Tuple[Roster, Roster] = None,
-                       full_rosters: Tuple[FullRoster, FullRoster] = None):
-        return [self.ratings[teams[0]]], [self.ratings[teams[1]]]
+    def predict_both(self, teams: Tuple[str, str],
+                     rosters: Tuple[Roster, Roster] = None,
+                     full_rosters: Tuple[FullRoster, FullRoster] = None
+                     ) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+        """Same as predict() for both kinds of maps, summing the ratings
+        once."""
+        names1, names2 = self._teams_names(teams, rosters=rosters,
+                                           full_rosters=full_rosters)
+
+        return self._predictions_from_sums(self.ratings.sums(names1),
+                                           self.ratings.sums(names2))
+
+    def _predictions_from_sums(
+            self, sums1: Tuple[float, float, int],
+            sums2: Tuple[float, float, int]
+            ) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+        """Return the undrawable & drawable predictions of two teams, given
+        their sums of mu & sigma^2 and sizes."""
+        env = self.env_drawable
+        sum_mu1, sum_sigma1, size1 = sums1
+        sum_mu2, sum_sigma2, size2 = sums2
+        size = size1 + size2
+
+        delta_mu = sum_mu1 - sum_mu2
+        sum_sigma = sum_sigma1 + sum_sigma2
+        denom = sqrt(size * env.beta**2 + sum_sigma)
+        predictions = []
+
+        for drawable in (False, True):
+            draw_margin = self._draw_margin(size, drawable)
+            p_win = env.cdf((delta_mu - draw_margin) / denom)
+            p_not_loss = env.cdf((delta_mu + draw_margin) / denom)
+            predictions.append((p_win, p_not_loss - p_win))
+
+        return tuple(predictions)
+
+    def predict_many(self, pairs: Sequence[Tuple[str, str]],
+                     rosters: Sequence[Tuple[Roster, Roster]] = None,
+                     full_rosters: Sequence[Tuple[FullRoster,
+                                                  FullRoster]] = None,
+                     drawable: bool = False) -> np.ndarray:
+        """Given team pairs, return a (pairs, 2) array of win/draw
+        probabilities of them."""
+        env = self.env_drawable if drawable else self.env_undrawable
+
+        if rosters is None:
+            rosters = [None] * len(pairs)
+        if full_rosters is None:
+            full_rosters = [None] * len(pairs)
+
+        # Sums of mu & sigma^2 and sizes of each team, once per roster.
+        teams_stats = {}
+        stats = np.zeros((len(pairs), 2, 3))
+
+        for i, (teams, roster_pair, full_roster_pair) in enumerate(
+                zip(pairs, rosters, full_rosters)):
+            for j, team in enumerate(teams):
+                roster = None if roster_pair is None else roster_pair[j]
+                full_roster = (None if full_roster_pair is None
+                               else full_roster_pair[j])
+                key = (team,
+                       None if roster is None else frozenset(roster),
+                       None if full_roster is None else frozenset(full_roster))
+
+                if key not in teams_stats:
+                    teams_stats[key] = self.ratings.sums(self._team_names(
+                        team, roster=roster, full_roster=full_roster))
+                stats[i, j] = teams_stats[key]
+
+        delta_mus = stats[:, 0, 0] - stats[:, 1, 0]
+        sum_sigmas = stats[:, :, 1].sum(axis=1)
+        sizes = stats[:, :, 2].sum(axis=1)
+        draw_margins = np.array([self._draw_margin(size, drawable)
+                                 for size in sizes.astype(int).tolist()])
+        denoms = np.sqrt(sizes * env.beta**2 + sum_sigmas)
+
+        p_wins = ndtr((delta_mus - draw_margins) / denoms)
+        p_not_losses = ndtr((delta_mus + draw_margins) / denoms)
+
+        return np.stack([p_wins, p_not_losses - p_wins], axis=1)
+
+    def _drop_stale_predictions(self) -> None:
+        written = self.ratings.pop_written()
+        if written is None:
+            self.clear_predictions()
+        elif written and self.prediction_cache:
+            names = self.ratings.names
+            self._invalidate_predictions(names[i] for i in written)
+
+    def _prediction_names(self, teams: Tuple[str, str],
+                          rosters: Tuple[Roster, Roster],
+                          full_rosters: Tuple[FullRoster, FullRoster]
+                          ) -> Set[str]:
+        return set(teams).union(*self._teams_names(
+            teams, rosters=rosters, full_rosters=full_rosters))
+
+    def _draw_margin(self, size: int, drawable: bool) -> float:
+        key = (size, drawable)
+        if key not in self.draw_margins:
+            env = self.env_drawable if drawable else self.env_undrawable
+            self.draw_margins[key] = calc_draw_margin(env.draw_probability,
+                                                      size, env=env)
+
+        return self.draw_margins[key]
+
+    def _rating_dynamics(self, full_rosters: Dict[str, FullRoster],
+                         matches: Sequence[Game]) -> RatingDynamics:
+        stats = np.array([self.ratings.sums(self._team_names(
+            team, full_roster=full_rosters.get(team))) for team in TEAM_ORDER])
+        sizes = stats[:, 2].astype(int)
+        match_formats = [MATCH_FORMATS[match.match_format]
+                         for match in matches]
+        draw_margins = {
+            (size1 + size2, drawable): self._draw_margin(size1 + size2,
+                                                         drawable)
+            for size1 in set(sizes.tolist()) for size2 in set(sizes.tolist())
+            for drawable in (False, True)}
+
+        return RatingDynamics(sum_mu=stats[:, 0], sum_sigma2=stats[:, 1],
+                              sizes=sizes, beta=self.env_drawable.beta,
+                              tau=self.env_drawable.tau,
+                              draw_margins=draw_margins,
+                              match_formats=match_formats)
+
+    def _teams_names(self, teams: Tuple[str, str],
+                     rosters: Tuple[Roster, Roster] = None,
+                     full_rosters: Tuple[FullRoster, FullRoster] = None):
+        if rosters is None:
+            rosters = (None, None)
+        if full_rosters is None:
+            full_rosters = (None, None)
+
+        return tuple(self._team_names(team, roster=roster,
+                                      full_roster=full_roster)
+                     for team, roster, full_roster
+                     in zip(teams, rosters, full_rosters))
+
+    def _team_names(self, team: str, roster: Roster = None,
+                    full_roster: FullRoster = None) -> Sequence[str]:
+        """Return the names of the ratings playing for a team."""
+        return [team]
+
+    def _update_teams_ratings(self, game: Game) -> None:
+        """Update whatever derives from the ratings of the teams of a
+        game, after they are rated."""
+        pass
 
-    def _update_teams_ratings(self, game: Game, teams_ratings):
-        for team, ratings in zip(game.teams, teams_ratings):
-            self.ratings[team] = ratings[0]
+    def _create_envs(self) -> Tuple[TrueSkill, TrueSkill]:
+        """Return the TrueSkill environments for drawable & undrawable
+        maps."""
+        env_drawable = TrueSkill(mu=self.mu, sigma=self.sigma, beta=self.beta,
+                                 tau=self.tau,
+                                 draw_probability=self.draw_probability)
+        env_undrawable = TrueSkill(mu=self.mu, sigma=self.sigma,
+                                   beta=self.beta, tau=self.tau,
+                                   draw_probability=0.0)
+        return env_drawable, env_undrawable
 
     def _create_rating_jar(self):
-        return defaultdict(lambda: self.env_drawable.create_rating())
+        return RatingStore(mu=self.env_drawable.mu,
+                           sigma=self.env_drawable.sigma)
 
 
 class PlayerTrueSkillPredictor(TrueSkillPredictor):
@@ -866,39 +1303,131 @@ class PlayerTrueSkillPredictor(TrueSkillPredictor):
     def __init__(self, **kws):
         super().__init__(**kws)
 
-        ratings = json.load(open(self.INITIAL_RATINGS_FILENAME))
-        for name, rating in ratings.items():
-            self.ratings[name] = Rating(mu=rating['mu'], sigma=rating['sigma'])
+        # Team ratings are aggregated from player ratings, and kept apart.
+        self.team_ratings = {}
+
+        ratings = load_initial_ratings(self.INITIAL_RATINGS_FILENAME)
+        for name, (mu, sigma) in ratings.items():
+            rating = Rating(mu=mu, sigma=sigma)
+            if name in TEAMS:
+                self.team_ratings[name] = rating
+            else:
+                self.ratings[name] = rating
 
         self.best_rosters = {}
+        # team => {roster: (min rating, bitmask)} of the distinct rosters in
+        # the queue, newest first. Inner dicts are replaced, never mutated.
+        self.roster_index = {}
+        # team => {name: bit} of the players in its indexed rosters.
+        self.player_bits = {}
         self.ratings_history = OrderedDict()
 
-    def save_ratings_history(self):
-        save_ratings_history(self.ratings_history,
-                             mu=self.env_drawable.mu,
-                             sigma=self.env_drawable.sigma)
+    def _own_mutable_state(self) -> None:
+        super()._own_mutable_state()
 
-    def _teams_ratings(self, teams: Tuple[str, str],
-                       rosters: Tuple[Roster, Roster] = None,
-                       full_rosters: Tuple[FullRoster, FullRoster] = None):
-        if rosters is None:
-            # No rosters provided, use the best rosters.
-            rosters = [self._best_roster(team, full_roster)
-                       for team, full_roster in zip(teams, full_rosters)]
-
-        return ([self.ratings[name] for name in rosters[0]],
-                [self.ratings[name] for name in rosters[1]])
-
-    def _update_teams_ratings(self, game: Game, teams_ratings) -> None:
-        for team, roster, full_roster, ratings in zip(game.teams, game.rosters,
-                                                      game.full_rosters,
-                                                      teams_ratings):
-            for name, rating in zip(roster, ratings):
-                self.ratings[name] = rating
+        for match_key, ratings in self.ratings_history.items():
+            if match_key[0] == self.stage:
+                self.ratings_history[match_key] = ratings.copy()
+
+    def save_ratings_history(self, wide: bool = False):
+        """Append new ratings to the long csv file, and also write the wide
+        one if wide is True."""
+        append_ratings_history(self.ratings_history)
+        if wide:
+            save_ratings_history(self.ratings_history,
+                                 mu=self.env_drawable.mu,
+                                 sigma=self.env_drawable.sigma)
+
+    def _team_names(self, team: str, roster: Roster = None,
+                    full_roster: FullRoster = None) -> Sequence[str]:
+        if roster is None:
+            # No roster provided, use the best roster.
+            roster = self._best_roster(team, full_roster)
+
+        return roster
+
+    def _prediction_names(self, teams: Tuple[str, str],
+                          rosters: Tuple[Roster, Roster],
+                          full_rosters: Tuple[FullRoster, FullRoster]
+                          ) -> Set[str]:
+        """Without rosters, the best rosters depend on the ratings of all
+        the players of the indexed rosters & the full rosters."""
+        names = set(teams)
+
+        for i, team in enumerate(teams):
+            if rosters is not None and rosters[i] is not None:
+                names.update(rosters[i])
+            else:
+                names.update(self.player_bits.get(team, ()))
+                if full_rosters is not None:
+                    names.update(full_rosters[i])
+
+        return names
 
-            self.ratings[team] = self._record_team_ratings(
+    def _update_rosters(self, game: Game) -> None:
+        super()._update_rosters(game)
+
+        for team in game.teams:
+            index = self.roster_index.get(team, {})
+            rosters = list(dict.fromkeys(self.roster_queues[team]))
+            new_rosters = [roster for roster in rosters
+                           if roster not in index and roster]
+            if new_rosters:
+                min_ratings = self._min_roster_ratings(new_rosters).tolist()
+                index = {**index, **{
+                    roster: (min_rating, self._roster_mask(team, roster,
+                                                           add=True))
+                    for roster, min_rating in zip(new_rosters, min_ratings)}}
+            self.roster_index[team] = {roster: index[roster]
+                                       for roster in rosters if roster}
+
+    def _compiled_indices(self, games: CompiledGames
+                          ) -> Tuple[List[List[int]], List[List[int]]]:
+        indices = np.array(self.ratings.indices_of(games.players) + [-1])
+        # Padding -1s pick the trailing -1.
+        rosters = indices[games.rosters].tolist()
+
+        return ([[i for i in roster1 if i >= 0] for roster1, _ in rosters],
+                [[i for i in roster2 if i >= 0] for _, roster2 in rosters])
+
+    def _update_teams_ratings(self, game: Game) -> None:
+        self._refresh_roster_index(
+            {name for roster in game.rosters for name in roster})
+
+        for team, full_roster in zip(game.teams, game.full_rosters):
+            self.team_ratings[team] = self._record_team_ratings(
                 team, full_roster=full_roster)
 
+    def _refresh_roster_index(self, names: Set[str]) -> None:
+        """Update the min ratings of the indexed rosters with any of the
+        given players, whose ratings changed."""
+        for team, index in self.roster_index.items():
+            rosters = [roster for roster in index
+                       if not names.isdisjoint(roster)]
+            if rosters:
+                min_ratings = self._min_roster_ratings(rosters).tolist()
+                self.roster_index[team] = {**index, **{
+                    roster: (min_rating, index[roster][1])
+                    for roster, min_rating in zip(rosters, min_ratings)}}
+
+    def _roster_mask(self, team: str, names: Iterable[str],
+                     add: bool = False) -> int:
+        """Return the bitmask of the players of a team, interning new ones
+        if add is True, else leaving them out."""
+        bits = self.player_bits.get(team, {})
+        new_names = [name for name in names if name not in bits]
+        if add and new_names:
+            bits = {**bits, **{name: len(bits) + i
+                               for i, name in enumerate(new_names)}}
+            self.player_bits[team] = bits
+
+        mask = 0
+        for name in names:
+            bit = bits.get(name)
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
     def _record_team_ratings(self, team: str,
                              full_roster: FullRoster) -> Rating:
         match_number = len(self.match_history[self.stage][team])
@@ -909,7 +1438,7 @@ class PlayerTrueSkillPredictor(TrueSkillPredictor):
         ratings = self.ratings_history[match_key]
 
         # Record player ratings.
-        for name in full_roster:
+        for name in sorted(full_roster):
             ratings[name] = self.ratings[name]
 
         # Update the best roster.
@@ -921,20 +1450,21 @@ class PlayerTrueSkillPredictor(TrueSkillPredictor):
         ratings[team] = rating
         return rating
 
-    def _best_roster(self, team: str, full_roster: Set[str]):
-        rosters = sorted(self.roster_queues[team],
-                         key=lambda roster: self._min_roster_rating(roster),
-                         reverse=True)
+    def _best_roster(self, team: str, full_roster: FullRoster):
         best_roster = None
+        best_rating = -np.inf
+        available = self._roster_mask(team, full_roster)
 
-        for roster in rosters:
-            if all(name in full_roster for name in roster):
+        # The best recent roster available, the newest one on ties.
+        for roster, (rating, mask) in self.roster_index.get(team,
+                                                            {}).items():
+            if rating > best_rating and (mask & available) == mask:
                 best_roster = roster
-                break
+                best_rating = rating
 
         if best_roster is None:
-            # Just pick the best 6.
-            sorted_members = sorted(full_roster,
+            # Just pick the best 6, breaking ties by names.
+            sorted_members = sorted(sorted(full_roster),
                                     key=lambda name: self._min_rating(name),
                                     reverse=True)
             best_roster = tuple(sorted_members[:6])
@@ -942,47 +1472,21 @@ class PlayerTrueSkillPredictor(TrueSkillPredictor):
         return best_roster
 
     def _roster_rating(self, roster: Roster) -> Tuple[float, float]:
-        sum_mu = sum(self.ratings[name].mu for name in roster)
-        sum_sigma = sqrt(sum(self.ratings[name].sigma**2 for name in roster))
+        sum_mu, sum_sigma, _ = self.ratings.sums(roster)
 
         mu = sum_mu / 6.0
-        sigma = sum_sigma / 6.0
+        sigma = sqrt(sum_sigma) / 6.0
         return Rating(mu=mu, sigma=sigma)
 
-    def _min_roster_rating(self, roster: Roster) -> float:
-        rating = self._roster_rating(roster)
-        return rating.mu - 3.0 * rating.sigma
+    def _min_roster_ratings(self, rosters: Sequence[Roster]) -> np.ndarray:
+        sum_mus, sum_sigmas = self.ratings.roster_sums(rosters)
+        return sum_mus / 6.0 - 3.0 * np.sqrt(sum_sigmas) / 6.0
 
     def _min_rating(self, name: str) -> float:
         rating = self.ratings[name]
         return rating.mu - 3.0 * rating.sigma
 
 
-def optimize_beta(class_=PlayerTrueSkillPredictor, maxfun=100) -> None:
-    games, _ = load_games()
-
-    def f(x):
-        predictor = class_(beta=x[0])
-        return -predictor.train_games(games)
-
-    args = fmin(f, [2500.0 / 6.0], maxfun=maxfun)
-    avg_point = -f(args) / len(games)
-    print(f'beta = {args[0]:.0f}, avg(point) = {avg_point:.4f}')
-
-
-def optimize_draw_probability(class_=PlayerTrueSkillPredictor,
-                              maxfun=100) -> None:
-    games, _ = load_games()
-
-    def f(x):
-        predictor = class_(draw_probability=x[0])
-        predictor.train_games(games)
-        return (predictor.expected_draws - predictor.real_draws)**2
-
-    args = fmin(f, [0.06], maxfun=maxfun)
-    print(f'draw_probability = {args[0]:.3f}')
-
-
 def compare_methods() -> None:
     games, _ = load_games()
     classes = [
@@ -1001,15 +1505,18 @@ def compare_methods() -> None:
 def predict_stage():
     past_games, future_matches = load_games()
 
-    predictor = PlayerTrueSkillPredictor()
-    predictor.train_games(past_games)
+    predictor = resume(PlayerTrueSkillPredictor, past_games)
 
-    p_stage = predictor.predict_stage(future_matches)
+    p_stage = predictor.predict_stage(future_matches, iters=1000000,
+                                      half_width=0.0025)
     # p_season = predictor.predict_season(future_matches)
     teams = sorted(p_stage.keys(), key=lambda team: p_stage[team][-1],
                    reverse=True)
 
-    print(predictor.base_stage)
+    if predictor.stage_iters:
+        print(f'{predictor.base_stage} ({predictor.stage_iters} iterations)')
+    else:
+        print(f'{predictor.base_stage} (exact)')
     print(f'      Title   Top1  Roster')
     for team in teams:
         p_title, p_top1 = p_stage[team]
@@ -1043,8 +1550,7 @@ def predict_stage():
 def save_ratings():
     past_games, future_matches = load_games()
 
-    predictor = PlayerTrueSkillPredictor()
-    predictor.train_games(past_games)
+    predictor = resume(PlayerTrueSkillPredictor, past_games)
     predictor.save_ratings_history()
 
 
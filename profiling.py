@@ -0,0 +1,193 @@
+from collections import defaultdict
+from fnmatch import fnmatchcase
+from functools import wraps
+import importlib
+import inspect
+import json
+import sys
+from time import perf_counter
+from typing import Callable, Dict, List, NamedTuple
+
+import numpy as np
+
+PROFILE_JSON = 'profile.json'
+PROFILE_FOLDED = 'profile.folded'
+
+# (module, name pattern) of the instrumented functions. Methods are
+# instrumented on every class of the module which defines them.
+FUNCTION_TARGETS = [
+    ('fetcher', 'load_games'),
+    ('render', 'render_*'),
+]
+METHOD_TARGETS = [
+    ('predictor', 'train'),
+    ('predictor', 'predict'),
+    ('predictor', 'predict_both'),
+    ('predictor', 'predict_match'),
+    ('predictor', '_predict_bo_score'),
+    ('predictor', '_predict_stage'),
+]
+
+
+class Timing(NamedTuple):
+    """Call count & times of an instrumented function, in seconds."""
+    calls: int
+    total: float
+    mean: float
+    p50: float
+    p99: float
+
+
+class Profiler(object):
+    """Time the calls of the hot functions of training & rendering.
+
+    Nothing is instrumented until enable(), which wraps the target
+    functions in place, and disable() puts the originals back, so that
+    there is no overhead when profiling is off. Times are kept per function,
+    and per call stack for flame graphs."""
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        # 'outer;inner' call stacks => time spent in inner itself.
+        self.self_times: Dict[str, float] = defaultdict(float)
+        # [name, time spent in children] of the running calls.
+        self._stack = []
+        # (namespace, name, original) of the wrapped functions.
+        self._patches = []
+
+    def __enter__(self) -> 'Profiler':
+        self.enable()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.disable()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._patches)
+
+    def enable(self) -> None:
+        if self.enabled:
+            return
+
+        for module_name, pattern in FUNCTION_TARGETS:
+            module = importlib.import_module(module_name)
+            for name, function in list(vars(module).items()):
+                if (inspect.isfunction(function) and
+                        function.__module__ == module_name and
+                        fnmatchcase(name, pattern)):
+                    wrapper = self.wrap(f'{module_name}.{name}', function)
+                    self._patch_everywhere(function, wrapper)
+
+        for module_name, method_name in METHOD_TARGETS:
+            module = importlib.import_module(module_name)
+            for class_ in vars(module).values():
+                if (inspect.isclass(class_) and
+                        class_.__module__ == module_name and
+                        method_name in vars(class_)):
+                    method = vars(class_)[method_name]
+                    self._patch(class_, method_name, self.wrap(
+                        f'{class_.__name__}.{method_name}', method))
+
+    def disable(self) -> None:
+        for namespace, name, original in reversed(self._patches):
+            setattr(namespace, name, original)
+        self._patches = []
+
+    def reset(self) -> None:
+        # Wrappers hold on to their lists, so empty them in place.
+        for durations in self.durations.values():
+            durations.clear()
+        self.self_times.clear()
+
+    def wrap(self, name: str, function: Callable) -> Callable:
+        """Return function timed under name."""
+        stack = self._stack
+        durations = self.durations[name]
+        self_times = self.self_times
+
+        @wraps(function)
+        def wrapper(*args, **kws):
+            frame = [name, 0.0]
+            stack.append(frame)
+            start = perf_counter()
+            try:
+                return function(*args, **kws)
+            finally:
+                elapsed = perf_counter() - start
+                stack.pop()
+                durations.append(elapsed)
+                path = ';'.join([outer for outer, _ in stack] + [name])
+                self_times[path] += elapsed - frame[1]
+                if stack:
+                    stack[-1][1] += elapsed
+
+        return wrapper
+
+    def report(self) -> Dict[str, Timing]:
+        """Return the timings of the called functions, slowest first."""
+        timings = {}
+        for name, durations in self.durations.items():
+            if not durations:
+                continue
+            p50, p99 = np.percentile(durations, [50, 99]).tolist()
+            total = sum(durations)
+            timings[name] = Timing(calls=len(durations), total=total,
+                                   mean=total / len(durations), p50=p50,
+                                   p99=p99)
+
+        return dict(sorted(timings.items(),
+                           key=lambda item: item[1].total, reverse=True))
+
+    def print_report(self) -> None:
+        print(f'{"function":<36}{"calls":>9}{"total s":>10}{"mean ms":>10}'
+              f'{"p50 ms":>10}{"p99 ms":>10}')
+        for name, timing in self.report().items():
+            print(f'{name:<36}{timing.calls:>9}{timing.total:>10.3f}'
+                  f'{timing.mean * 1e3:>10.3f}{timing.p50 * 1e3:>10.3f}'
+                  f'{timing.p99 * 1e3:>10.3f}')
+
+    def dump_json(self, filename: str = PROFILE_JSON) -> None:
+        with open(filename, 'w') as json_file:
+            json.dump({name: timing._asdict()
+                       for name, timing in self.report().items()},
+                      json_file, indent=2)
+
+    def dump_folded(self, filename: str = PROFILE_FOLDED) -> None:
+        """Save the self times in microseconds per call stack, in the
+        folded format of flamegraph.pl & speedscope."""
+        with open(filename, 'w') as folded_file:
+            for path, self_time in sorted(self.self_times.items()):
+                folded_file.write(f'{path} {round(self_time * 1e6)}\n')
+
+    def _patch(self, namespace, name: str, function: Callable) -> None:
+        self._patches.append((namespace, name, vars(namespace)[name]))
+        setattr(namespace, name, function)
+
+    def _patch_everywhere(self, original: Callable,
+                          function: Callable) -> None:
+        # Also replace the copies imported by other modules.
+        for module in list(sys.modules.values()):
+            for name, value in list(getattr(module, '__dict__', {}).items()):
+                if value is original:
+                    self._patch(module, name, function)
+
+
+def profile_render_all() -> Profiler:
+    """Render the site with profiling, print & save the timings."""
+    import render
+
+    with Profiler() as profiler:
+        render.render_all()
+
+    profiler.print_report()
+    profiler.dump_json()
+    profiler.dump_folded()
+
+    return profiler
+
+
+if __name__ == '__main__':
+    profile_render_all()
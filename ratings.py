@@ -0,0 +1,252 @@
+from math import sqrt
+from typing import Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from scipy.special import log_ndtr, ndtr
+from trueskill import Rating, TrueSkill
+
+
+class RatingStore(object):
+    """Ratings of players in contiguous mu & sigma arrays.
+
+    Names are interned to array indices on first use, and get the default
+    rating like a defaultdict. Reads & writes of single ratings go through
+    trueskill.Rating objects, which are kept in a dict so that per-game
+    lookups cost no more than with a plain dict of ratings."""
+
+    def __init__(self, mu: float, sigma: float, capacity: int = 256) -> None:
+        super().__init__()
+
+        self.default_mu = mu
+        self.default_sigma = sigma
+
+        self.indices: Dict[str, int] = {}
+        self.names: List[str] = []
+        self._mu = np.empty(capacity)
+        self._sigma = np.empty(capacity)
+        # name => Rating, for the names read or written one by one since
+        # their last batch write.
+        self._ratings: Dict[str, Rating] = {}
+        # Indices written since the last pop_written(), None if all of them
+        # may have been.
+        self._written: Optional[Set[int]] = set()
+        # Whether the arrays & names are shared with a fork, and must be
+        # copied before writing.
+        self._shared = False
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.indices
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, name: str) -> Rating:
+        rating = self._ratings.get(name)
+        if rating is None:
+            i = self.index(name)
+            rating = Rating(mu=self._mu[i].item(),
+                            sigma=self._sigma[i].item())
+            self._ratings[name] = rating
+        return rating
+
+    def __setitem__(self, name: str, rating: Rating) -> None:
+        i = self.index(name)
+        self._own()
+        self._mu[i] = rating.mu
+        self._sigma[i] = rating.sigma
+        self._ratings[name] = rating
+        if self._written is not None:
+            self._written.add(i)
+
+    @property
+    def mu(self) -> np.ndarray:
+        return self._mu[:len(self.names)]
+
+    @property
+    def sigma(self) -> np.ndarray:
+        return self._sigma[:len(self.names)]
+
+    def index(self, name: str) -> int:
+        """Return the index of a name, adding it if needed."""
+        i = self.indices.get(name)
+        if i is None:
+            self._own()
+            i = len(self.names)
+            if i == len(self._mu):
+                self._grow()
+
+            self.indices[name] = i
+            self.names.append(name)
+            self._mu[i] = self.default_mu
+            self._sigma[i] = self.default_sigma
+
+        return i
+
+    def set_many(self, indices: Sequence[int], mu: np.ndarray,
+                 sigma: np.ndarray) -> None:
+        """Set the ratings at many indices at once."""
+        self._own()
+        self._mu[indices] = mu
+        self._sigma[indices] = sigma
+        for i in indices:
+            self._ratings.pop(self.names[i], None)
+        if self._written is not None:
+            self._written.update(indices)
+
+    def mu_sigma_at(self, indices: Sequence[int]
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return copies of mu & sigma at the indices."""
+        return self._mu[indices], self._sigma[indices]
+
+    def indices_of(self, names: Iterable[str]) -> List[int]:
+        return [self.index(name) for name in names]
+
+    def sums(self, names: Iterable[str]) -> Tuple[float, float, int]:
+        """Return the sum of mu, the sum of sigma^2 & the number of
+        players."""
+        return self.sums_at(self.indices_of(names))
+
+    def sums_at(self, indices: List[int]) -> Tuple[float, float, int]:
+        sigma = self._sigma[indices]
+
+        return (self._mu[indices].sum().item(), (sigma**2).sum().item(),
+                len(indices))
+
+    def roster_sums(self, rosters: Sequence[Iterable[str]]
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the sums of mu & sigma^2 of each non-empty roster."""
+        indices = []
+        offsets = []
+
+        for roster in rosters:
+            offsets.append(len(indices))
+            indices.extend(self.index(name) for name in roster)
+
+        sigma = self._sigma[indices]
+
+        return (np.add.reduceat(self._mu[indices], offsets),
+                np.add.reduceat(sigma**2, offsets))
+
+    def snapshot(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Return copies of the mu & sigma arrays."""
+        return self.mu.copy(), self.sigma.copy()
+
+    def restore(self, snapshot: Tuple[np.ndarray, np.ndarray]) -> None:
+        """Restore the ratings of a snapshot. Names added since then keep
+        their current ratings."""
+        mu, sigma = snapshot
+        self._own()
+        self._mu[:len(mu)] = mu
+        self._sigma[:len(sigma)] = sigma
+        self._ratings = {}
+        self._written = None
+
+    def pop_written(self) -> Optional[Set[int]]:
+        """Return the indices written since the last call, or None if all
+        the ratings may have been, e.g. by restore()."""
+        written = self._written
+        self._written = set()
+        return written
+
+    def fork(self) -> 'RatingStore':
+        """Return a copy sharing the arrays & names until either side
+        writes."""
+        store = RatingStore.__new__(RatingStore)
+        store.__dict__.update(self.__dict__)
+        # Ratings rebuilt from the arrays would round sigma through pi, so
+        # keep the cached ones to rate like this store does.
+        store._ratings = self._ratings.copy()
+        store._written = set()
+        self._shared = store._shared = True
+
+        return store
+
+    def _own(self) -> None:
+        if self._shared:
+            self.indices = self.indices.copy()
+            self.names = self.names.copy()
+            self._mu = self._mu.copy()
+            self._sigma = self._sigma.copy()
+            self._shared = False
+
+    def _grow(self) -> None:
+        capacity = 2 * len(self._mu)
+        self._mu = np.resize(self._mu, capacity)
+        self._sigma = np.resize(self._sigma, capacity)
+
+
+def _pdf(x: np.ndarray) -> np.ndarray:
+    return np.exp(-0.5 * x**2) / np.sqrt(2.0 * np.pi)
+
+
+def v_w_win(diff: np.ndarray,
+            draw_margin: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized TrueSkill v & w for a win, seen from the winner."""
+    x = diff - draw_margin
+    v = np.exp(-0.5 * x**2 - 0.5 * np.log(2.0 * np.pi) - log_ndtr(x))
+    w = np.clip(v * (v + x), 1e-12, 1.0 - 1e-12)
+
+    return v, w
+
+
+def v_w_draw(diff: np.ndarray,
+             draw_margin: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized TrueSkill v & w for a draw."""
+    abs_diff = np.abs(diff)
+    a = draw_margin - abs_diff
+    b = -draw_margin - abs_diff
+    denom = ndtr(a) - ndtr(b)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        v = np.where(denom > 0, (_pdf(b) - _pdf(a)) / denom, a)
+        w = np.where(denom > 0,
+                     v**2 + (a * _pdf(a) - b * _pdf(b)) / denom, 1.0)
+
+    return np.where(diff < 0, -v, v), np.clip(w, 1e-12, 1.0 - 1e-12)
+
+
+def rate_two_teams(store: RatingStore, names1: Sequence[str],
+                   names2: Sequence[str], ranks: Sequence[int], env: TrueSkill,
+                   draw_margin: float) -> None:
+    """Update the ratings of two teams after a game in place, the same as
+    env.rate() with ranks but in closed form.
+
+    The ratings agree with env.rate() to about 1e-15 relative after a game.
+    The rounding differences add up over many games, to about 1e-10
+    relative after all the games so far."""
+    rate_two_teams_at(store, store.indices_of(names1),
+                      store.indices_of(names2), ranks=ranks, env=env,
+                      draw_margin=draw_margin)
+
+
+def rate_two_teams_at(store: RatingStore, indices1: List[int],
+                      indices2: List[int], ranks: Sequence[int],
+                      env: TrueSkill, draw_margin: float) -> None:
+    """Same as rate_two_teams(), given the indices of the players."""
+    indices = indices1 + indices2
+    mu, sigma = store.mu_sigma_at(indices)
+    sigma2 = sigma**2 + env.tau**2
+    c2 = sigma2.sum() + len(indices) * env.beta**2
+    c = sqrt(c2)
+
+    # Team 1 moves up along the performance difference, team 2 moves down.
+    signs = np.ones(len(indices))
+    signs[len(indices1):] = -1.0
+    diff = (signs @ mu).item() / c
+
+    if ranks[0] == ranks[1]:
+        v = env.v_draw(diff, draw_margin / c)
+        w = env.w_draw(diff, draw_margin / c)
+    else:
+        if ranks[0] > ranks[1]:
+            # Team 2 wins, look from its side.
+            signs = -signs
+            diff = -diff
+        v = env.v_win(diff, draw_margin / c)
+        w = env.w_win(diff, draw_margin / c)
+
+    store.set_many(indices, mu + signs * sigma2 / c * v,
+                   np.sqrt(sigma2 * (1.0 - sigma2 / c2 * w)))
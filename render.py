@@ -89,7 +89,7 @@ def p_to_sort_key(p):
 
 class MatchCard(object):
     def __init__(self, predictor: Predictor, match: Game, use_date=False,
-                 first_team=None) -> None:
+                 first_team=None, prediction=None) -> None:
 
         self.match = match
         self.use_date = use_date
@@ -108,7 +108,9 @@ class MatchCard(object):
         self.date_str = match.start_time.strftime('%A, %B %d').replace(' 0',
                                                                        ' ')
 
-        p_win, e_diff = predictor.predict_match(match)
+        if prediction is None:
+            prediction = predictor.predict_match(match)
+        p_win, e_diff = prediction
         win = round(p_win * 100)
 
         classes1 = ['win' if win > 50 else 'loss']
@@ -218,7 +220,8 @@ def render_team_logo(team, width=30) -> str:
 
 def render_team_link(predictor, team, full_roster=None) -> str:
     if full_roster is None:
-        rating = predictor.ratings[team]
+        rating = predictor.team_ratings.get(
+            team, predictor.env_drawable.create_rating())
     else:
         roster = predictor._best_roster(team, full_roster)
         rating = predictor._roster_rating(roster)
@@ -422,9 +425,12 @@ def render_match_cards(predictor, past_games, future_matches):
                                      match=match))
         predictor.train_games(games)
 
-    for match in future_matches:
+    predictions = predictor.predict_matches(future_matches)
+
+    for match, prediction in zip(future_matches, predictions):
         match_cards.append(MatchCard(predictor=predictor,
-                                     match=match))
+                                     match=match,
+                                     prediction=prediction))
 
     return match_cards
 
@@ -713,7 +719,8 @@ def render_all():
 
     predictor = PlayerTrueSkillPredictor()
     match_cards = render_match_cards(predictor, past_games, future_matches)
-    predictor.save_ratings_history()
+    # ratings.csv is tracked, so keep it up to date.
+    predictor.save_ratings_history(wide=True)
 
     render_index(predictor, future_matches)
     render_matches(match_cards)
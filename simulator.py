@@ -0,0 +1,925 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import combinations, groupby, permutations, product
+from math import factorial
+from typing import Collection, Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+from scipy.special import ndtr
+
+from game import Game, TEAMS, TEAM_DIVISIONS
+from ratings import v_w_draw, v_w_win
+
+
+# A fixed team order, shared by all the team x team matrices.
+TEAM_ORDER = sorted(TEAMS)
+TEAM_INDICES = {team: i for i, team in enumerate(TEAM_ORDER)}
+
+# Shift match wins above map diffs in the composite standings key.
+WINS_SHIFT = 1 << 16
+# Bits of the random noise that shuffles teams with the same standings key.
+SHUFFLE_BITS = 16
+# Bits reserved for head-to-head map diffs among tied teams, which stay far
+# below ±512 in a stage.
+TIE_BITS = 10
+# Bits reserved for team indices, positions & tie-breaker wins, which are
+# packed below the sort keys.
+TEAM_BITS = 5
+TEAM_MASK = (1 << TEAM_BITS) - 1
+# Grid of the normal tables of the dynamic simulation, over [-limit, limit].
+# Beyond it ndtr is within 1e-57 of 0 or 1, so arguments are clipped.
+NORMAL_TABLE_LIMIT = 16.0
+NORMAL_TABLE_STEP = 1.0 / 1024
+# Iterations simulated together by the dynamic simulation.
+DYNAMIC_CHUNK_SIZE = 4096
+# Fewest iterations per worker process. Starting a worker costs about 10ms,
+# and 4 workers were slower than 1 for 200000 iterations.
+MIN_WORKER_ITERS = 100000
+
+
+def _normal_tables() -> np.ndarray:
+    """Return the values & slopes of ndtr, and of v & w of a win, over the
+    grid, as a (3, 2, points) array."""
+    n_steps = round(2 * NORMAL_TABLE_LIMIT / NORMAL_TABLE_STEP)
+    # One more point, so that the last step has a slope.
+    grid = np.arange(n_steps + 2) * NORMAL_TABLE_STEP - NORMAL_TABLE_LIMIT
+    values = np.stack([ndtr(grid), *v_w_win(grid, 0.0)])
+
+    return np.stack([values, np.diff(values, append=values[:, -1:])], axis=1)
+
+
+NORMAL_TABLES = _normal_tables()
+
+
+def _interpolate(x: np.ndarray, tables: np.ndarray) -> List[np.ndarray]:
+    """Linearly interpolate tables of NORMAL_TABLES at x."""
+    positions = x + NORMAL_TABLE_LIMIT
+    positions *= 1.0 / NORMAL_TABLE_STEP
+    np.clip(positions, 0.0, tables.shape[-1] - 2, out=positions)
+    indices = positions.astype(np.intp)
+    positions -= indices
+
+    results = []
+    for values, slopes in tables:
+        result = slopes[indices]
+        result *= positions
+        result += values[indices]
+        results.append(result)
+
+    return results
+
+
+def p_matrix(p_wins: Dict[Tuple[str, str], float]) -> np.ndarray:
+    """Convert {(team1, team2): p} to a team x team matrix."""
+    matrix = np.zeros((len(TEAM_ORDER), len(TEAM_ORDER)))
+
+    for (team1, team2), p in p_wins.items():
+        matrix[TEAM_INDICES[team1], TEAM_INDICES[team2]] = p
+
+    return matrix
+
+
+class RatingDynamics(NamedTuple):
+    """Team-level TrueSkill state of the teams in TEAM_ORDER, for simulations
+    which update the ratings along the sampled results.
+
+    Each team is the sum of its roster: the sum of mu, the sum of sigma^2
+    & the number of players. draw_margins maps (total number of players,
+    drawable) to the draw margin, and match_formats gives the drawable flags
+    of the maps & the wins needed of each remaining match."""
+    sum_mu: np.ndarray
+    sum_sigma2: np.ndarray
+    sizes: np.ndarray
+    beta: float
+    tau: float
+    draw_margins: Dict[Tuple[int, bool], float]
+    match_formats: List[Tuple[Tuple[bool, ...], int]]
+
+
+class StageCounts(NamedTuple):
+    """Title & top 1 counts of teams in TEAM_ORDER over some iterations."""
+    iters: int
+    title_count: np.ndarray
+    top1_count: np.ndarray
+
+    def merge(self, other: 'StageCounts') -> 'StageCounts':
+        return StageCounts(iters=self.iters + other.iters,
+                           title_count=self.title_count + other.title_count,
+                           top1_count=self.top1_count + other.top1_count)
+
+    def probabilities(self) -> Dict[str, Tuple[float, float]]:
+        return {team: (self.title_count[i].item() / self.iters,
+                       self.top1_count[i].item() / self.iters)
+                for i, team in enumerate(TEAM_ORDER)}
+
+
+# The simulator of the current worker process.
+_worker_simulator = None
+
+
+def _init_worker(simulator: 'StageSimulator') -> None:
+    global _worker_simulator
+    _worker_simulator = simulator
+
+
+def _run_worker_batch(n: int, seed: np.random.SeedSequence) -> StageCounts:
+    return _worker_simulator.run_batch(n, seed)
+
+
+class DynamicRound(NamedTuple):
+    """Remaining matches of distinct teams, played at once by the dynamic
+    simulation. Per-match arrays are (matches, 1) columns, and per-map ones
+    are map-major, the last map being the tie-breaker."""
+    matches: np.ndarray
+    teams1: np.ndarray
+    teams2: np.ndarray
+    # Team sizes * tau^2, and the inverses of the team sizes.
+    tau2_sizes1: np.ndarray
+    tau2_sizes2: np.ndarray
+    inv_sizes1: np.ndarray
+    inv_sizes2: np.ndarray
+    # size * beta^2 of each match.
+    size_beta2s: np.ndarray
+    max_wins: np.ndarray
+    # Whether each match plays each map, whether every iteration does, and
+    # whether the map can be drawn.
+    played: np.ndarray
+    always_played: List[bool]
+    drawables: np.ndarray
+    draw_margins: np.ndarray
+
+
+class StageSimulator(object):
+    """Vectorized Monte Carlo simulator of the rest of a stage.
+
+    Every batch samples the scores of all the remaining matches for all its
+    iterations at once, then resolves standings, seeds and the title matches
+    as array operations."""
+
+    def __init__(self, wins: Dict[str, int], map_diffs: Dict[str, int],
+                 head_to_head_map_diffs: Dict[Tuple[str, str], int],
+                 matches: Sequence[Game],
+                 scores_list: List[List[Tuple[int, int]]],
+                 cum_weights_list: List[List[float]],
+                 p_wins_regular: Dict[Tuple[str, str], float],
+                 p_wins_ft3: Dict[Tuple[str, str], float],
+                 p_wins_ft4: Dict[Tuple[str, str], float],
+                 batch_size: int = 20000,
+                 dynamics: RatingDynamics = None) -> None:
+        super().__init__()
+
+        n_teams = len(TEAM_ORDER)
+        n_matches = len(matches)
+        self.batch_size = batch_size
+        # If given, sample the remaining matches map by map from ratings
+        # updated along the results, instead of the fixed distributions.
+        self.dynamics = dynamics
+        self.dynamic_rounds = []
+
+        # Current standings, as composite keys of wins & map diffs.
+        self.keys = np.array([wins.get(team, 0) * WINS_SHIFT +
+                              map_diffs.get(team, 0) for team in TEAM_ORDER],
+                             dtype=np.int64)
+        self.head_to_head_map_diffs = np.array(
+            [[head_to_head_map_diffs.get((team1, team2), 0)
+              for team2 in TEAM_ORDER] for team1 in TEAM_ORDER], dtype=int)
+        divisions = sorted(set(TEAM_DIVISIONS.values()))
+        self.divisions = np.array([divisions.index(TEAM_DIVISIONS[team])
+                                   for team in TEAM_ORDER])
+
+        # Remaining matches. Each team pair with remaining matches gets a
+        # row of head-to-head map diffs, the extra last row stays 0.
+        self.pair_ids = np.zeros((n_teams, n_teams), dtype=int)
+        self.pair_signs = np.zeros((n_teams, n_teams), dtype=int)
+        pairs = {}
+
+        for match in matches:
+            team1, team2 = (TEAM_INDICES[team] for team in match.teams)
+            if (team1, team2) not in pairs and (team2, team1) not in pairs:
+                pairs[(team1, team2)] = len(pairs)
+
+        self.n_pairs = len(pairs)
+        self.pair_ids[:] = self.n_pairs
+        for (team1, team2), pair_id in pairs.items():
+            self.pair_ids[team1, team2] = self.pair_ids[team2, team1] = pair_id
+            self.pair_signs[team1, team2] = 1
+            self.pair_signs[team2, team1] = -1
+
+        # Score distributions of the remaining matches, padded to the same
+        # number of scores. Thresholds of the padded scores are never hit.
+        # Each score is stored as its deltas to the keys of both teams and
+        # to their head-to-head map diffs.
+        n_scores = max((len(scores) for scores in scores_list), default=1)
+        self.key_deltas1 = np.zeros((n_matches, n_scores), dtype=np.int32)
+        self.key_deltas2 = np.zeros((n_matches, n_scores), dtype=np.int32)
+        self.pair_deltas = np.zeros((n_matches, n_scores), dtype=np.int32)
+        self.thresholds = np.full((n_scores - 1, n_matches, 1), 2.0,
+                                  dtype=np.float32)
+        self.match_indices = []
+
+        for i, (match, scores, cum_weights) in enumerate(
+                zip(matches, scores_list, cum_weights_list)):
+            team1, team2 = (TEAM_INDICES[team] for team in match.teams)
+            pair_id = self.pair_ids[team1, team2]
+            pair_sign = self.pair_signs[team1, team2]
+            self.match_indices.append((team1, team2, pair_id))
+
+            for j, (score1, score2) in enumerate(scores):
+                self.key_deltas1[i, j] = ((score1 > score2) * WINS_SHIFT +
+                                          score1 - score2)
+                self.key_deltas2[i, j] = ((score1 < score2) * WINS_SHIFT +
+                                          score2 - score1)
+                self.pair_deltas[i, j] = pair_sign * (score1 - score2)
+
+            self.thresholds[:len(scores) - 1, i, 0] = (
+                np.array(cum_weights[:-1]) / cum_weights[-1])
+
+        self.p_wins_regular = p_matrix(p_wins_regular)
+        self.p_wins_ft3 = p_matrix(p_wins_ft3)
+        self.p_wins_ft4 = p_matrix(p_wins_ft4)
+
+        if dynamics is not None:
+            self.dynamic_rounds = self._dynamic_rounds()
+
+    def _dynamic_rounds(self) -> List[DynamicRound]:
+        """Group the remaining matches into rounds of distinct teams, each
+        team playing its matches in order."""
+        dynamics = self.dynamics
+        rounds = []
+        last_rounds = {}
+
+        for i, (team1, team2, _) in enumerate(self.match_indices):
+            round_index = max(last_rounds.get(team1, -1),
+                              last_rounds.get(team2, -1)) + 1
+            if round_index == len(rounds):
+                rounds.append([])
+            rounds[round_index].append(i)
+            last_rounds[team1] = last_rounds[team2] = round_index
+
+        dynamic_rounds = []
+        for matches in rounds:
+            teams1 = np.array([self.match_indices[i][0] for i in matches])
+            teams2 = np.array([self.match_indices[i][1] for i in matches])
+            formats = [dynamics.match_formats[i] for i in matches]
+            sizes = (dynamics.sizes[teams1] + dynamics.sizes[teams2]).tolist()
+            n_maps = max(len(drawables) for drawables, _ in formats) + 1
+
+            played = np.zeros((n_maps, len(matches), 1), dtype=bool)
+            drawables = np.zeros((n_maps, len(matches), 1), dtype=bool)
+            draw_margins = np.zeros((n_maps, len(matches), 1))
+            for j, ((match_drawables, _), size) in enumerate(zip(formats,
+                                                                 sizes)):
+                # The tie-breaker is played by the tied rows only.
+                played[:len(match_drawables), j] = True
+                played[-1, j] = True
+                drawables[:len(match_drawables), j, 0] = match_drawables
+                for k in range(n_maps):
+                    draw_margins[k, j] = dynamics.draw_margins[
+                        (size, bool(drawables[k, j, 0]))]
+
+            sizes1 = dynamics.sizes[teams1, None].astype(float)
+            sizes2 = dynamics.sizes[teams2, None].astype(float)
+            max_wins = np.array([max_wins for _, max_wins in formats])
+            # No match can be over before max_wins maps, & the tie-breaker
+            # is only played when tied.
+            always_played = [bool(played[k].all()) and k < max_wins.min()
+                             for k in range(n_maps - 1)] + [False]
+
+            dynamic_rounds.append(DynamicRound(
+                matches=np.array(matches), teams1=teams1, teams2=teams2,
+                tau2_sizes1=sizes1 * dynamics.tau**2,
+                tau2_sizes2=sizes2 * dynamics.tau**2,
+                inv_sizes1=1.0 / sizes1, inv_sizes2=1.0 / sizes2,
+                size_beta2s=np.array(sizes, dtype=float)[:, None] *
+                dynamics.beta**2,
+                max_wins=max_wins[:, None], played=played,
+                always_played=always_played, drawables=drawables,
+                draw_margins=draw_margins))
+
+        return dynamic_rounds
+
+    def run(self, iters: int, seed=None, workers: int = 1,
+            half_width: float = None,
+            settled_teams: Collection[str] = ()) -> StageCounts:
+        """Simulate the stage iters times.
+
+        Iterations are split into batches, each with its own random stream
+        spawned from the seed. Batches are spread over worker processes when
+        workers > 1, but only as many as get MIN_WORKER_ITERS iterations
+        each, and the results don't depend on the number of workers.
+
+        If half_width is given, stop early once the confidence intervals of
+        the probabilities of all teams not in settled_teams are within
+        half_width, and iters is only the maximum. The intervals are checked
+        after every batch in seed order, so the stopping point doesn't
+        depend on the number of workers either."""
+        if iters <= 0:
+            raise ValueError(f'iters must be positive, not {iters}')
+
+        sizes = [min(self.batch_size, iters - start)
+                 for start in range(0, iters, self.batch_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        counts = self._empty_counts()
+        workers = min(workers, iters // MIN_WORKER_ITERS)
+
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers,
+                                           initializer=_init_worker,
+                                           initargs=(self,))
+        else:
+            executor = nullcontext()
+
+        # Batches of each round are run at once, then merged in order.
+        round_size = len(sizes) if half_width is None else max(workers, 1)
+
+        with executor:
+            for start in range(0, len(sizes), round_size):
+                round_ = slice(start, start + round_size)
+                if workers > 1:
+                    batch_counts = executor.map(_run_worker_batch,
+                                                sizes[round_], seeds[round_])
+                else:
+                    batch_counts = map(self.run_batch, sizes[round_],
+                                       seeds[round_])
+
+                for batch in batch_counts:
+                    counts = counts.merge(batch)
+                    if half_width is not None and self._converged(
+                            counts, half_width, settled_teams):
+                        return counts
+
+        return counts
+
+    @staticmethod
+    def _converged(counts: StageCounts, half_width: float,
+                   settled_teams: Collection[str], z: float = 1.96) -> bool:
+        """Whether the Wilson score intervals of all unsettled teams are
+        within half_width."""
+        unsettled = [TEAM_INDICES[team] for team in TEAM_ORDER
+                     if team not in settled_teams]
+        n = counts.iters
+        p = np.concatenate([counts.title_count[unsettled],
+                            counts.top1_count[unsettled]]) / n
+        widths = z / (1 + z ** 2 / n) * np.sqrt(
+            p * (1 - p) / n + z ** 2 / (4 * n ** 2))
+
+        return bool(np.all(widths <= half_width))
+
+    def run_batch(self, n: int, seed: np.random.SeedSequence) -> StageCounts:
+        """Simulate the stage n times with the given random stream."""
+        seeds, champions = self._simulate(n, np.random.default_rng(seed))
+        n_teams = len(TEAM_ORDER)
+
+        return StageCounts(iters=n,
+                           title_count=np.bincount(seeds.ravel(),
+                                                   minlength=n_teams),
+                           top1_count=np.bincount(champions,
+                                                  minlength=n_teams))
+
+    def _empty_counts(self) -> StageCounts:
+        return StageCounts(iters=0,
+                           title_count=np.zeros(len(TEAM_ORDER), dtype=int),
+                           top1_count=np.zeros(len(TEAM_ORDER), dtype=int))
+
+    def _simulate(self, n: int,
+                  rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the seeds & champions of n iterations."""
+        if self.dynamics is None:
+            scores = self._sample_scores(n, rng)
+            key_deltas1 = self.key_deltas1.ravel()[scores]
+            key_deltas2 = self.key_deltas2.ravel()[scores]
+            pair_deltas = self.pair_deltas.ravel()[scores]
+        else:
+            key_deltas1, key_deltas2, pair_deltas = \
+                self._sample_dynamic_deltas(n, rng)
+
+        # Accumulate the match results into team-major & pair-major arrays.
+        keys = np.repeat(self.keys[:, None], n, axis=1)
+        pair_diffs = np.zeros((self.n_pairs + 1, n), dtype=np.int64)
+
+        for i, (team1, team2, pair_id) in enumerate(self.match_indices):
+            keys[team1] += key_deltas1[i]
+            keys[team2] += key_deltas2[i]
+            pair_diffs[pair_id] += pair_deltas[i]
+
+        teams = self._standings(keys, pair_diffs, rng)
+        seeds = self._seeds(teams)
+
+        # Title matches.
+        teams = self._play_round(seeds, self.p_wins_ft3, rng)
+        teams = self._play_round(teams, self.p_wins_ft4, rng)
+        teams = self._play_round(teams, self.p_wins_ft4, rng)
+
+        return seeds, teams[:, 0]
+
+    def _sample_scores(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        """Sample n scores of every remaining match.
+        Return their flat indices in the score tables, match-major."""
+        n_matches, n_scores = self.key_deltas1.shape
+        uniforms = rng.random((n_matches, n), dtype=np.float32)
+
+        # Same as random.choices(): count the cum weights <= the samples.
+        indices = np.zeros((n_matches, n), dtype=np.int8)
+        for thresholds in self.thresholds:
+            indices += thresholds <= uniforms
+
+        return indices + np.arange(0, n_matches * n_scores, n_scores)[:, None]
+
+    def _sample_dynamic_deltas(
+            self, n: int, rng: np.random.Generator
+            ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Play the remaining matches n times in order, map by map, updating
+        the team ratings of each iteration after every map. Return the key
+        deltas of both teams & the head-to-head deltas, match-major.
+
+        Each round of matches of distinct teams is played at once on
+        (matches, n) arrays, and ndtr, v & w of wins are interpolated from
+        NORMAL_TABLES. Draws get the exact v & w. Over 36 matches left in
+        a stage, 100k iterations of the dynamic mode take about 1.5 s,
+        against 0.3 s for the static one."""
+        n_matches = len(self.match_indices)
+        key_deltas1 = np.zeros((n_matches, n), dtype=np.int32)
+        key_deltas2 = np.zeros((n_matches, n), dtype=np.int32)
+        pair_deltas = np.zeros((n_matches, n), dtype=np.int32)
+
+        # In chunks of iterations, whose arrays stay in the cache.
+        for start in range(0, n, DYNAMIC_CHUNK_SIZE):
+            chunk = slice(start, min(start + DYNAMIC_CHUNK_SIZE, n))
+            self._sample_dynamic_chunk(key_deltas1[:, chunk],
+                                       key_deltas2[:, chunk],
+                                       pair_deltas[:, chunk], rng)
+
+        return key_deltas1, key_deltas2, pair_deltas
+
+    def _sample_dynamic_chunk(self, key_deltas1: np.ndarray,
+                              key_deltas2: np.ndarray,
+                              pair_deltas: np.ndarray,
+                              rng: np.random.Generator) -> None:
+        """Fill the deltas of a chunk of iterations in place."""
+        dynamics = self.dynamics
+        n = key_deltas1.shape[1]
+        sum_mu = np.repeat(dynamics.sum_mu[:, None].astype(float), n, axis=1)
+        sum_sigma2 = np.repeat(dynamics.sum_sigma2[:, None].astype(float), n,
+                               axis=1)
+
+        for round_ in self.dynamic_rounds:
+            ratings = (sum_mu[round_.teams1], sum_mu[round_.teams2],
+                       sum_sigma2[round_.teams1], sum_sigma2[round_.teams2])
+            score1 = np.zeros((len(round_.matches), n), dtype=np.int32)
+            score2 = np.zeros((len(round_.matches), n), dtype=np.int32)
+
+            for k, played in enumerate(round_.played):
+                if round_.always_played[k]:
+                    rows = None
+                elif k < len(round_.played) - 1:
+                    rows = ((score1 < round_.max_wins) &
+                            (score2 < round_.max_wins) & played)
+                else:
+                    rows = (score1 == score2) & played
+                    if not rows.any():
+                        break
+
+                win1, win2 = self._play_dynamic_map(
+                    ratings, round_, k, rows, rng)
+                score1 += win1
+                score2 += win2
+
+            sum_mu[round_.teams1], sum_mu[round_.teams2] = ratings[:2]
+            sum_sigma2[round_.teams1], sum_sigma2[round_.teams2] = ratings[2:]
+
+            diffs = score1 - score2
+            key_deltas1[round_.matches] = (diffs > 0) * WINS_SHIFT + diffs
+            key_deltas2[round_.matches] = (diffs < 0) * WINS_SHIFT - diffs
+            pair_deltas[round_.matches] = (
+                self.pair_signs[round_.teams1, round_.teams2][:, None] * diffs)
+
+    def _play_dynamic_map(self, ratings: Tuple[np.ndarray, ...],
+                          round_: DynamicRound, k: int, rows: np.ndarray,
+                          rng: np.random.Generator
+                          ) -> Tuple[np.ndarray, np.ndarray]:
+        """Play the k-th map of a round in the given rows, or in all of them
+        if rows is None, and update the (mu1, mu2, sigma2_1, sigma2_2) sums
+        in place. Return the wins of both teams."""
+        mu1, mu2, sigma2_1, sigma2_2 = ratings
+        draw_margin = round_.draw_margins[k]
+
+        # Win/draw probabilities, the same as predict().
+        delta_mu = mu1 - mu2
+        denom = sigma2_1 + sigma2_2
+        denom += round_.size_beta2s
+        np.sqrt(denom, out=denom)
+        x = delta_mu - draw_margin
+        x /= denom
+        p_win, = _interpolate(x, NORMAL_TABLES[:1])
+        uniforms = rng.random(delta_mu.shape)
+        win1 = uniforms < p_win
+        win2 = ~win1
+        if rows is not None:
+            win1 &= rows
+            win2 &= rows
+        draw = None
+        if round_.drawables[k].any():
+            np.add(delta_mu, draw_margin, out=x)
+            x /= denom
+            p_not_loss, = _interpolate(x, NORMAL_TABLES[:1])
+            draw = uniforms < p_not_loss
+            draw &= win2
+            draw &= round_.drawables[k]
+            win2 &= ~draw
+
+        # The closed-form update of rate_two_teams(), on the sums.
+        prior1 = sigma2_1 + round_.tau2_sizes1
+        prior2 = sigma2_2 + round_.tau2_sizes2
+        c2 = prior1 + prior2
+        c2 += round_.size_beta2s
+        c = np.sqrt(c2)
+        signs = win2 * -2.0
+        signs += 1.0
+        np.multiply(signs, delta_mu, out=x)
+        x -= draw_margin
+        x /= c
+        v, w = _interpolate(x, NORMAL_TABLES[1:])
+        if draw is not None and draw.any():
+            drawn = np.nonzero(draw)
+            v[drawn], w[drawn] = v_w_draw(
+                delta_mu[drawn] / c[drawn],
+                np.broadcast_to(draw_margin, c.shape)[drawn] / c[drawn])
+        if rows is not None:
+            v *= rows
+
+        v *= signs
+        v /= c
+        mu1 += prior1 * v
+        mu2 -= prior2 * v
+
+        # Assume the players of a team share its variance evenly.
+        w /= c2
+        for sigma2, prior, inv_sizes in ((sigma2_1, prior1, round_.inv_sizes1),
+                                         (sigma2_2, prior2,
+                                          round_.inv_sizes2)):
+            shrink = prior * w
+            shrink *= inv_sizes
+            shrink *= prior
+            if rows is None:
+                np.subtract(prior, shrink, out=sigma2)
+            else:
+                np.subtract(prior, shrink, out=sigma2, where=rows)
+
+        return win1, win2
+
+    def _standings(self, keys: np.ndarray, pair_diffs: np.ndarray,
+                   rng: np.random.Generator) -> np.ndarray:
+        """Sort teams by wins & map diffs, then break the ties by
+        head-to-head map diffs among the tied teams, and finally by virtual
+        matches with the regular win probabilities. Only ties that may affect
+        the seeds are resolved. Keys & pair diffs are team-major &
+        pair-major."""
+        n_teams, n = keys.shape
+
+        # Sort by the keys, randomly within ties. Team indices are packed in
+        # the lowest bits. Ties are resolved position by position, so work
+        # on position-major arrays.
+        packed = ((-keys.T << SHUFFLE_BITS) |
+                  rng.integers(0, 1 << SHUFFLE_BITS, size=(n, n_teams),
+                               dtype=np.uint16))
+        packed <<= TEAM_BITS
+        packed |= np.arange(n_teams)
+        packed.sort(axis=1)
+        teams = packed & TEAM_MASK
+        positions = teams.T.copy()
+        # Negated keys in ascending order. Positions i < j are tied iff their
+        # keys are equal.
+        sorted_keys = np.ascontiguousarray(
+            packed.T >> (SHUFFLE_BITS + TEAM_BITS))
+
+        # Seeds come from the top 9, or down to the best team of the other
+        # division. Resolve every tied group starting above that point.
+        divisions = self.divisions[positions]
+        last = np.maximum(np.argmax(divisions[1:] != divisions[0], axis=0) + 1,
+                          8)
+        last_keys = sorted_keys[last, np.arange(n)]
+        window = int((sorted_keys <= last_keys).sum(axis=0).max())
+
+        head_to_heads = np.zeros((window, n), dtype=np.int64)
+        tied_pairs = []
+
+        for i in range(window):
+            for j in range(i + 1, window):
+                rows = np.flatnonzero(sorted_keys[i] == sorted_keys[j])
+                if len(rows) == 0:
+                    break  # Groups are contiguous.
+
+                team1s = positions[i, rows]
+                team2s = positions[j, rows]
+                pair_ids = self.pair_ids[team1s, team2s]
+                diffs = (self.head_to_head_map_diffs[team1s, team2s] +
+                         self.pair_signs[team1s, team2s] *
+                         pair_diffs[pair_ids, rows])
+
+                head_to_heads[i, rows] += diffs
+                head_to_heads[j, rows] -= diffs
+                tied_pairs.append((i, j, rows, team1s, team2s))
+
+        # Teams still tied play a virtual match against each other.
+        tie_wins = np.zeros((window, n), dtype=np.int64)
+
+        for i, j, rows, team1s, team2s in tied_pairs:
+            tied = head_to_heads[i, rows] == head_to_heads[j, rows]
+            rows = rows[tied]
+            p_wins = self.p_wins_regular[team1s[tied], team2s[tied]]
+            first = rng.random(len(rows)) < p_wins
+
+            tie_wins[i, rows] += first
+            tie_wins[j, rows] += ~first
+
+        # Sort the window again, keep the random order for complete ties.
+        resolved = sorted_keys[:window] << TIE_BITS
+        resolved -= head_to_heads
+        resolved <<= TEAM_BITS
+        resolved -= tie_wins
+        resolved <<= TEAM_BITS
+        resolved += np.arange(window)[:, None]
+        resolved <<= TEAM_BITS
+        resolved += positions[:window]
+        resolved = np.ascontiguousarray(resolved.T)
+        resolved.sort(axis=1)
+        teams[:, :window] = resolved & TEAM_MASK
+
+        return teams
+
+    def _seeds(self, teams: np.ndarray) -> np.ndarray:
+        """Pick the 8 seeds from the standings."""
+        n = len(teams)
+        divisions = self.divisions[teams]
+
+        # Seed 0 and seed 1, the best team of the other division.
+        seed1s = np.argmax(divisions[:, 1:] != divisions[:, :1], axis=1) + 1
+
+        # Seed 2-7.
+        others = np.arange(1, 7)[None, :]
+        others = others + (others >= seed1s[:, None])
+
+        return np.concatenate([teams[:, :1],
+                               teams[np.arange(n), seed1s][:, None],
+                               np.take_along_axis(teams, others, axis=1)],
+                              axis=1)
+
+    def _play_round(self, teams: np.ndarray, p_wins: np.ndarray,
+                    rng: np.random.Generator) -> np.ndarray:
+        """Play the highest seed against the lowest one, and so on.
+        Return the winners in their seed order."""
+        half = teams.shape[1] // 2
+        highs = np.arange(half)
+        lows = teams.shape[1] - 1 - highs
+
+        first = rng.random((len(teams), half)) < p_wins[teams[:, highs],
+                                                        teams[:, lows]]
+        positions = np.where(first, highs, lows)
+        positions.sort(axis=1)
+
+        return np.take_along_axis(teams, positions, axis=1)
+
+
+class StageEnumerator(object):
+    """Exact distribution of the rest of a stage.
+
+    Walks the remaining matches one by one, merging the standings states
+    reached by different scores, then resolves the ties and the title
+    matches exactly with the same rules as StageSimulator."""
+
+    def __init__(self, wins: Dict[str, int], map_diffs: Dict[str, int],
+                 head_to_head_map_diffs: Dict[Tuple[str, str], int],
+                 matches: Sequence[Game],
+                 scores_list: List[List[Tuple[int, int]]],
+                 cum_weights_list: List[List[float]],
+                 p_wins_regular: Dict[Tuple[str, str], float],
+                 p_wins_ft3: Dict[Tuple[str, str], float],
+                 p_wins_ft4: Dict[Tuple[str, str], float]) -> None:
+        super().__init__()
+
+        self.keys = {team: wins.get(team, 0) * WINS_SHIFT +
+                     map_diffs.get(team, 0) for team in TEAM_ORDER}
+        self.head_to_head_map_diffs = head_to_head_map_diffs
+        self.p_wins_regular = p_wins_regular
+        self.p_wins_ft3 = p_wins_ft3
+        self.p_wins_ft4 = p_wins_ft4
+
+        # Teams & team pairs with remaining matches, and their score
+        # distributions.
+        self.teams = sorted({team for match in matches
+                             for team in match.teams})
+        self.pairs = []
+        self.match_deltas = []
+
+        for match, scores, cum_weights in zip(matches, scores_list,
+                                              cum_weights_list):
+            team1, team2 = match.teams
+            if (team2, team1) in self.pairs:
+                pair_id = self.pairs.index((team2, team1))
+                pair_sign = -1
+            else:
+                if (team1, team2) not in self.pairs:
+                    self.pairs.append((team1, team2))
+                pair_id = self.pairs.index((team1, team2))
+                pair_sign = 1
+
+            deltas = []
+            last_cum_weight = 0.0
+            for (score1, score2), cum_weight in zip(scores, cum_weights):
+                p = (cum_weight - last_cum_weight) / cum_weights[-1]
+                last_cum_weight = cum_weight
+                if p > 0:
+                    deltas.append(((score1 > score2) * WINS_SHIFT +
+                                   score1 - score2,
+                                   (score1 < score2) * WINS_SHIFT +
+                                   score2 - score1,
+                                   pair_sign * (score1 - score2), p))
+
+            self.match_deltas.append((self.teams.index(team1),
+                                      self.teams.index(team2), pair_id,
+                                      deltas))
+
+        self._group_orders_cache = {}
+        self._p_champions_cache = {}
+
+    def run(self) -> Dict[str, Tuple[float, float]]:
+        """Return {team: (p_title, p_top1)}."""
+        p_titles = {team: 0.0 for team in TEAM_ORDER}
+        p_top1s = {team: 0.0 for team in TEAM_ORDER}
+
+        for seeds, p in self._seeds_distribution().items():
+            for team in seeds:
+                p_titles[team] += p
+            for team, p_champion in self._p_champions(seeds).items():
+                p_top1s[team] += p * p_champion
+
+        return {team: (p_titles[team], p_top1s[team]) for team in TEAM_ORDER}
+
+    def _states(self) -> Dict[Tuple[Tuple[int, ...], Tuple[int, ...]], float]:
+        """Return {(keys, pair diffs): p} after all the remaining matches.
+        Keys are of self.teams and pair diffs of self.pairs."""
+        states = {(tuple(self.keys[team] for team in self.teams),
+                   (0,) * len(self.pairs)): 1.0}
+
+        for team1, team2, pair_id, deltas in self.match_deltas:
+            next_states = defaultdict(float)
+
+            for (keys, pair_diffs), p in states.items():
+                for delta1, delta2, pair_delta, p_score in deltas:
+                    next_keys = list(keys)
+                    next_keys[team1] += delta1
+                    next_keys[team2] += delta2
+                    next_pair_diffs = list(pair_diffs)
+                    next_pair_diffs[pair_id] += pair_delta
+                    next_states[(tuple(next_keys),
+                                 tuple(next_pair_diffs))] += p * p_score
+
+            states = next_states
+
+        return states
+
+    def _seeds_distribution(self) -> Dict[Tuple[str, ...], float]:
+        seeds_distribution = defaultdict(float)
+
+        for (keys, pair_diffs), p in self._states().items():
+            all_keys = self.keys.copy()
+            all_keys.update(zip(self.teams, keys))
+            all_pair_diffs = dict(zip(self.pairs, pair_diffs))
+
+            # Resolve tied groups from the top down to the point where the
+            # seeds are decided.
+            teams = sorted(TEAM_ORDER, key=all_keys.__getitem__, reverse=True)
+            standings_list = [((), p)]
+            divisions = set()
+            n_placed = 0
+
+            for _, group in groupby(teams, key=all_keys.__getitem__):
+                group = tuple(group)
+                if len(group) == 1:
+                    standings_list = [(standings + group, p_standings)
+                                      for standings, p_standings
+                                      in standings_list]
+                else:
+                    standings_list = [
+                        (standings + order, p_standings * p_order)
+                        for standings, p_standings in standings_list
+                        for order, p_order in self._group_orders(
+                            group, all_pair_diffs)]
+
+                divisions.update(TEAM_DIVISIONS[team] for team in group)
+                n_placed += len(group)
+                if n_placed >= 8 and len(divisions) > 1:
+                    break
+
+            for standings, p_standings in standings_list:
+                seeds_distribution[self._seeds(standings)] += p_standings
+
+        return seeds_distribution
+
+    def _group_orders(self, group: Tuple[str, ...],
+                      pair_diffs: Dict[Tuple[str, str], int]
+                      ) -> List[Tuple[Tuple[str, ...], float]]:
+        """Return all orders of a tied group with their probabilities."""
+        head_to_head_map_diffs = {}
+
+        for team1, team2 in combinations(group, 2):
+            diff = (self.head_to_head_map_diffs.get((team1, team2), 0) +
+                    pair_diffs.get((team1, team2), 0) -
+                    pair_diffs.get((team2, team1), 0))
+            head_to_head_map_diffs[(team1, team2)] = diff
+
+        cache_key = (group, tuple(head_to_head_map_diffs.values()))
+        if cache_key in self._group_orders_cache:
+            return self._group_orders_cache[cache_key]
+
+        head_to_heads = defaultdict(int)
+        for (team1, team2), diff in head_to_head_map_diffs.items():
+            head_to_heads[team1] += diff
+            head_to_heads[team2] -= diff
+
+        # Teams still tied play a virtual match against each other, in a
+        # random order like StageSimulator.
+        tied_pairs = [(team1, team2)
+                      for team1, team2 in combinations(group, 2)
+                      if head_to_heads[team1] == head_to_heads[team2]]
+        orders = defaultdict(float)
+
+        for firsts in product((True, False), repeat=len(tied_pairs)):
+            tie_wins = defaultdict(int)
+            p = 1.0
+
+            for (team1, team2), first in zip(tied_pairs, firsts):
+                p_win = (self.p_wins_regular[(team1, team2)] + 1 -
+                         self.p_wins_regular[(team2, team1)]) / 2
+                if first:
+                    tie_wins[team1] += 1
+                    p *= p_win
+                else:
+                    tie_wins[team2] += 1
+                    p *= 1 - p_win
+
+            # Complete ties are in a uniformly random order.
+            sub_groups = [tuple(sub_group) for _, sub_group in groupby(
+                sorted(group, key=lambda team: (-head_to_heads[team],
+                                                -tie_wins[team])),
+                key=lambda team: (head_to_heads[team], tie_wins[team]))]
+            for sub_group in sub_groups:
+                p /= factorial(len(sub_group))
+
+            for sub_orders in product(*(permutations(sub_group)
+                                        for sub_group in sub_groups)):
+                orders[sum(sub_orders, ())] += p
+
+        self._group_orders_cache[cache_key] = list(orders.items())
+
+        return self._group_orders_cache[cache_key]
+
+    @staticmethod
+    def _seeds(standings: Tuple[str, ...]) -> Tuple[str, ...]:
+        """Pick the 8 seeds from the standings."""
+        division = TEAM_DIVISIONS[standings[0]]
+        seed1 = next(team for team in standings
+                     if TEAM_DIVISIONS[team] != division)
+        others = [team for team in standings[1:] if team != seed1][:6]
+
+        return (standings[0], seed1, *others)
+
+    def _p_champions(self, seeds: Tuple[str, ...]) -> Dict[str, float]:
+        """Return {team: p} of winning the title matches from the seeds."""
+        if seeds in self._p_champions_cache:
+            return self._p_champions_cache[seeds]
+
+        # Bracket => p, with teams in their seed order.
+        brackets = {seeds: 1.0}
+
+        for p_wins in (self.p_wins_ft3, self.p_wins_ft4, self.p_wins_ft4):
+            next_brackets = defaultdict(float)
+
+            for teams, p in brackets.items():
+                half = len(teams) // 2
+
+                for firsts in product((True, False), repeat=half):
+                    positions = []
+                    p_winners = p
+
+                    for high, first in enumerate(firsts):
+                        low = len(teams) - 1 - high
+                        p_win = p_wins[(teams[high], teams[low])]
+
+                        if first:
+                            positions.append(high)
+                            p_winners *= p_win
+                        else:
+                            positions.append(low)
+                            p_winners *= 1 - p_win
+
+                    winners = tuple(teams[i] for i in sorted(positions))
+                    next_brackets[winners] += p_winners
+
+            brackets = next_brackets
+
+        p_champions = {champion: p for (champion,), p in brackets.items()}
+        self._p_champions_cache[seeds] = p_champions
+
+        return p_champions
@@ -0,0 +1,144 @@
+from collections import deque
+from collections.abc import Mapping
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+sys.path.insert(0, ROOT)
+
+
+def load_data(filename: str):
+    with open(os.path.join(DATA_DIR, filename)) as data_file:
+        return json.load(data_file)
+
+
+def route_key(path: str, params: dict = None) -> str:
+    query = urlencode(sorted((params or {}).items()))
+    return path + '?' + query if query else path
+
+
+def plain_state(predictor) -> dict:
+    """Return the whole state of a predictor but its caches as plain values,
+    keeping the types & orders of its mappings."""
+    from ratings import RatingStore
+    from trueskill import Rating
+
+    def plain(value):
+        if isinstance(value, RatingStore):
+            return (value.names, value.mu.tolist(), value.sigma.tolist())
+        elif isinstance(value, Rating):
+            return (value.mu, value.sigma)
+        elif isinstance(value, Mapping):
+            return (type(value).__name__,
+                    [(plain(key), plain(item)) for key, item in value.items()])
+        elif isinstance(value, deque):
+            return ('deque', value.maxlen, [plain(item) for item in value])
+        elif isinstance(value, (list, tuple)):
+            return [plain(item) for item in value]
+        elif isinstance(value, (set, frozenset)):
+            return sorted(value)
+        return value
+
+    return {name: plain(value)
+            for name, value in predictor.__getstate__().items()
+            if name not in ('prediction_cache', 'prediction_cache_keys')}
+
+
+class StubAPI(object):
+    """A local server answering recorded JSON bodies with ETags.
+
+    Statuses queued in failures are answered first, one per request."""
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.routes = {}
+        self.failures = []
+        # (route, status) of every request, in order.
+        self.requests = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.base_url = f'http://127.0.0.1:{self._server.server_port}/'
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever,
+                         kwargs={'poll_interval': 0.01}, daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_matches(self, raw_matches: list, page_size: int) -> None:
+        """Serve the match list in pages, and the details of each match."""
+        pages = [raw_matches[start:start + page_size]
+                 for start in range(0, len(raw_matches), page_size)] or [[]]
+        for page, content in enumerate(pages):
+            body = {'content': content, 'totalPages': len(pages)}
+            self.routes[route_key('match', {'size': page_size})
+                        if page == 0 else
+                        route_key('match', {'page': page,
+                                            'size': page_size})] = body
+        for raw_match in raw_matches:
+            self.routes[f'match/{raw_match["id"]}'] = raw_match
+
+    def requested(self, status: int = 200) -> list:
+        return [route for route, route_status in self.requests
+                if route_status == status]
+
+    def _respond(self, route: str, etag: str) -> tuple:
+        with self._lock:
+            if self.failures:
+                status = self.failures.pop(0)
+            elif route not in self.routes:
+                status = 404
+            else:
+                body = json.dumps(self.routes[route]).encode()
+                digest = f'"{sha1(body).hexdigest()}"'
+                status = 304 if etag == digest else 200
+            self.requests.append((route, status))
+
+        if status != 200:
+            return status, {}, b''
+        return status, {'ETag': digest,
+                        'Content-Type': 'application/json'}, body
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                url = urlsplit(self.path)
+                route = route_key(url.path.lstrip('/'),
+                                  dict(parse_qsl(url.query)))
+                status, headers, body = api._respond(
+                    route, self.headers.get('If-None-Match'))
+
+                self.send_response(status)
+                if status == 429:
+                    self.send_header('Retry-After', '0')
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+@pytest.fixture
+def api():
+    stub_api = StubAPI()
+    stub_api.start()
+    yield stub_api
+    stub_api.stop()
@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from checkpoint import load_checkpoint, resume
+from conftest import plain_state, ROOT
+from fetcher import load_games
+from predictor import PlayerTrueSkillPredictor
+
+N_PREFIX = 250
+
+
+@pytest.fixture(scope='module')
+def games():
+    past_games, _ = load_games(os.path.join(ROOT, 'games.csv'),
+                               use_cache=False)
+    return past_games
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(ROOT, 'initial_ratings.json'), tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def trained_games(monkeypatch):
+    """The numbers of games passed to train_games."""
+    counts = []
+    train_games = PlayerTrueSkillPredictor.train_games
+
+    def counting_train_games(self, games):
+        counts.append(len(games))
+        return train_games(self, games)
+
+    monkeypatch.setattr(PlayerTrueSkillPredictor, 'train_games',
+                        counting_train_games)
+    return counts
+
+
+def test_resume_from_prefix_equals_full_replay(workdir, games,
+                                               trained_games):
+    n_prefix = len(games) // 2
+    resume(PlayerTrueSkillPredictor, games[:n_prefix])
+    predictor = resume(PlayerTrueSkillPredictor, games)
+    assert trained_games == [n_prefix, len(games) - n_prefix]
+
+    expected = PlayerTrueSkillPredictor()
+    expected.train_games(games)
+    assert plain_state(predictor) == plain_state(expected)
+
+    header, _ = load_checkpoint()
+    assert (header.n_games, header.last_game_id) == (len(games),
+                                                     games[-1].game_id)
+
+
+def test_resume_replays_other_games(workdir, games, trained_games):
+    resume(PlayerTrueSkillPredictor, games[:N_PREFIX])
+    changed_game = games[N_PREFIX - 1]._replace(score=(0, 3))
+    changed_games = games[:N_PREFIX - 1] + [changed_game]
+
+    resume(PlayerTrueSkillPredictor, changed_games)
+    assert trained_games == [N_PREFIX, N_PREFIX]
+
+
+def test_resume_replays_other_initial_ratings(workdir, games, trained_games,
+                                              monkeypatch):
+    resume(PlayerTrueSkillPredictor, games[:N_PREFIX])
+
+    with open('initial_ratings.json') as ratings_file:
+        ratings = json.load(ratings_file)
+    for rating in ratings.values():
+        rating['mu'] += 100
+    with open('other_ratings.json', 'w') as ratings_file:
+        json.dump(ratings, ratings_file)
+    monkeypatch.setattr(PlayerTrueSkillPredictor, 'INITIAL_RATINGS_FILENAME',
+                        'other_ratings.json')
+
+    predictor = resume(PlayerTrueSkillPredictor, games[:N_PREFIX])
+    assert trained_games == [N_PREFIX, N_PREFIX]
+
+    expected = PlayerTrueSkillPredictor()
+    expected.train_games(games[:N_PREFIX])
+    assert plain_state(predictor) == plain_state(expected)
@@ -0,0 +1,81 @@
+import pytest
+import requests
+
+from fetcher import FetchClient, fetch_match_details, fetch_raw_matches
+
+
+def make_client(api, tmp_path, **kws) -> FetchClient:
+    return FetchClient(base_url=api.base_url, backoff_factor=0,
+                       cache_dir=str(tmp_path / 'http_cache'), **kws)
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_get_retries_transient_statuses(api, tmp_path, status):
+    api.routes['match/1'] = {'id': 1}
+    api.failures = [status, status]
+
+    with make_client(api, tmp_path) as client:
+        assert client.get('match/1') == {'id': 1}
+
+    assert api.requests == [('match/1', status), ('match/1', status),
+                            ('match/1', 200)]
+
+
+def test_get_gives_up_after_retries(api, tmp_path):
+    api.routes['match/1'] = {'id': 1}
+    api.failures = [503] * 3
+
+    with make_client(api, tmp_path, retries=2) as client:
+        with pytest.raises(requests.RequestException):
+            client.get('match/1')
+
+    assert len(api.requests) == 3
+
+
+def test_get_uses_cache_on_304(api, tmp_path):
+    api.routes['match/1'] = {'id': 1}
+
+    with make_client(api, tmp_path) as client:
+        assert client.get('match/1') == {'id': 1}
+    with make_client(api, tmp_path) as client:
+        assert client.get('match/1') == {'id': 1}
+
+    assert api.requests == [('match/1', 200), ('match/1', 304)]
+
+    api.routes['match/1'] = {'id': 1, 'state': 'CONCLUDED'}
+    with make_client(api, tmp_path) as client:
+        assert client.get('match/1') == {'id': 1, 'state': 'CONCLUDED'}
+
+    assert api.requests[-1] == ('match/1', 200)
+
+
+def test_get_without_cache(api, tmp_path):
+    api.routes['match/1'] = {'id': 1}
+
+    with FetchClient(base_url=api.base_url, cache_dir=None) as client:
+        client.get('match/1')
+        client.get('match/1')
+
+    assert api.requested(200) == ['match/1', 'match/1']
+    assert not (tmp_path / 'http_cache').exists()
+
+
+def test_fetch_raw_matches_reads_all_pages(api, tmp_path):
+    raw_matches = [{'id': match_id} for match_id in range(25)]
+    api.serve_matches(raw_matches, page_size=10)
+    api.failures = [503]
+
+    with make_client(api, tmp_path) as client:
+        assert fetch_raw_matches(client, page_size=10) == raw_matches
+
+    assert sorted(api.requested(200)) == [
+        'match?page=1&size=10', 'match?page=2&size=10', 'match?size=10']
+
+
+def test_fetch_match_details_keeps_order(api, tmp_path):
+    raw_matches = [{'id': match_id} for match_id in range(10)]
+    api.serve_matches(raw_matches, page_size=10)
+
+    with make_client(api, tmp_path, max_workers=4) as client:
+        assert fetch_match_details([7, 2, 5], client) == [
+            {'id': 7}, {'id': 2}, {'id': 5}]
@@ -0,0 +1,119 @@
+import os
+
+from fetcher import (games_cache_key, GAMES_CACHE_SUFFIX, load_games,
+                     parse_games, write_games_cache)
+from game_store import CSVGame, GameStore
+
+ROSTER1 = 'a1|a2|a3|a4|a5|a6'
+ROSTER2 = 'b1|b2|b3|b4|b5|b6'
+
+
+def unplayed(match_id: int, start_time: str) -> CSVGame:
+    return CSVGame(match_id=str(match_id), stage='Stage 1',
+                   start_time=start_time, team1='ATL', team2='BOS',
+                   match_format='regular', game_id='', game_number='',
+                   map_name='', score1='', score2='', roster1='', roster2='',
+                   full_roster1=ROSTER1, full_roster2=ROSTER2)
+
+
+def played(match_id: int, start_time: str, game_number: int,
+           score: tuple = (2, 1)) -> CSVGame:
+    return unplayed(match_id, start_time)._replace(
+        game_id=str(match_id * 10 + game_number),
+        game_number=str(game_number), map_name='ilios',
+        score1=str(score[0]), score2=str(score[1]), roster1=ROSTER1,
+        roster2=ROSTER2)
+
+
+def make_store(tmp_path, csv_games, **kws) -> GameStore:
+    store = GameStore(str(tmp_path / 'games.csv'), **kws)
+    store.rewrite(csv_games)
+    return store
+
+
+def test_csv_games_merges_journal(tmp_path):
+    store = make_store(tmp_path, [
+        played(1, '2019-02-14 16:00:00', 1),
+        unplayed(2, '2019-02-15 16:00:00'),
+        unplayed(3, '2019-02-16 16:00:00'),
+    ])
+    store.append([
+        played(2, '2019-02-15 16:00:00', 2),
+        played(2, '2019-02-15 16:00:00', 1),
+        played(1, '2019-02-14 16:00:00', 1, score=(3, 2)),
+    ])
+
+    assert list(store.csv_games()) == [
+        played(1, '2019-02-14 16:00:00', 1, score=(3, 2)),
+        played(2, '2019-02-15 16:00:00', 1),
+        played(2, '2019-02-15 16:00:00', 2),
+        unplayed(3, '2019-02-16 16:00:00'),
+    ]
+    assert [game.score for game in store.past_games()] == [
+        (3, 2), (2, 1), (2, 1)]
+    assert [game.match_id for game in store.future_games()] == [3]
+
+
+def test_append_counts_journal_rows_once(tmp_path, monkeypatch):
+    store = make_store(tmp_path, [unplayed(1, '2019-02-14 16:00:00')])
+    store.append([played(1, '2019-02-14 16:00:00', 1)])
+    assert GameStore(store.csv_filename).journal_rows == 1
+
+    def read_journal():
+        raise AssertionError('The journal was read again.')
+
+    monkeypatch.setattr(store, '_journal', read_journal)
+    store.append([played(1, '2019-02-14 16:00:00', 2),
+                  played(1, '2019-02-14 16:00:00', 3)])
+    assert store.journal_rows == 3
+
+
+def test_append_compacts_journal(tmp_path):
+    store = make_store(tmp_path, [unplayed(1, '2019-02-14 16:00:00')],
+                       compact_every=3)
+    journal_inode = os.stat(store.journal_filename).st_ino
+
+    store.append([played(1, '2019-02-14 16:00:00', 1),
+                  played(1, '2019-02-14 16:00:00', 2)])
+    assert store.journal_rows == 2
+    assert len(store._journal()) == 2
+
+    merged = [played(1, '2019-02-14 16:00:00', number)
+              for number in (1, 2, 3)]
+    store.append(merged[2:])
+    assert store.journal_rows == 0
+    assert os.path.getsize(store.journal_filename) == 0
+    assert os.stat(store.journal_filename).st_ino != journal_inode
+    assert list(store._csv_rows()) == merged
+    assert list(store.csv_games()) == merged
+
+
+def test_load_games_reads_journal(tmp_path):
+    store = make_store(tmp_path, [unplayed(1, '2019-02-14 16:00:00')])
+    past_games, future_games = load_games(store.csv_filename)
+    assert (len(past_games), len(future_games)) == (0, 1)
+
+    store.append([played(1, '2019-02-14 16:00:00', 1)])
+    past_games, future_games = load_games(store.csv_filename)
+    assert (len(past_games), len(future_games)) == (1, 0)
+    assert past_games[0].rosters == (tuple(ROSTER1.split('|')),
+                                     tuple(ROSTER2.split('|')))
+
+
+def test_load_games_ignores_caches_of_set_full_rosters(tmp_path):
+    store = make_store(tmp_path, [played(1, '2019-02-14 16:00:00', 1)])
+    past_games, future_games = parse_games(store.csv_filename)
+    # Caches before version 3 held full rosters as sets.
+    old_games = [game._replace(full_rosters=tuple(
+        set(full_roster) for full_roster in game.full_rosters))
+        for game in past_games]
+    write_games_cache(store.csv_filename + GAMES_CACHE_SUFFIX,
+                      (2,) + games_cache_key(store.csv_filename)[1:],
+                      (old_games, future_games))
+
+    past_games, _ = load_games(store.csv_filename)
+    assert past_games[0].full_rosters == (frozenset(ROSTER1.split('|')),
+                                          frozenset(ROSTER2.split('|')))
+    assert all(type(full_roster) is frozenset
+               for full_roster in past_games[0].full_rosters)
+    hash(past_games[0])
@@ -0,0 +1,324 @@
+from collections import defaultdict
+from itertools import permutations, product
+import os
+
+import numpy as np
+import pytest
+
+from compiled import CompiledGames
+from cow import CowDict
+from conftest import plain_state, ROOT
+from fetcher import load_games
+from game import Game
+from predictor import bo_score_grid, MATCH_FORMATS, PlayerTrueSkillPredictor
+
+N_TRAINED = 300
+
+
+@pytest.fixture(scope='module')
+def games():
+    past_games, _ = load_games(os.path.join(ROOT, 'games.csv'),
+                               use_cache=False)
+    return past_games
+
+
+@pytest.fixture
+def predictor(games, monkeypatch):
+    monkeypatch.chdir(ROOT)
+    predictor = PlayerTrueSkillPredictor()
+    predictor.train_games(games[:N_TRAINED])
+    return predictor
+
+
+def old_bo_scores(p_undrawable, p_drawable, drawables, max_wins) -> dict:
+    """The best-of score distribution of the dict-based DP which
+    bo_score_grid() replaced."""
+    p_scores = defaultdict(float)
+    p_finished_scores = defaultdict(float)
+    p_scores[(0, 0)] = 1.0
+
+    for drawable in drawables:
+        p_win, p_draw = p_drawable if drawable else p_undrawable
+        p_loss = 1.0 - p_win - p_draw
+        new_p_scores = defaultdict(float)
+
+        for (score1, score2), p in p_scores.items():
+            if score1 + 1 == max_wins:
+                p_finished_scores[(score1 + 1, score2)] += p * p_win
+            else:
+                new_p_scores[(score1 + 1, score2)] += p * p_win
+            if score2 + 1 == max_wins:
+                p_finished_scores[(score1, score2 + 1)] += p * p_loss
+            else:
+                new_p_scores[(score1, score2 + 1)] += p * p_loss
+            if drawable:
+                new_p_scores[(score1, score2)] += p * p_draw
+
+        p_scores = new_p_scores
+
+    # Add a tie-breaker game if needed.
+    p_win, p_draw = p_undrawable
+    new_p_scores = defaultdict(float)
+
+    for (score1, score2), p in p_scores.items():
+        if score1 == score2:
+            new_p_scores[(score1 + 1, score2)] += p * p_win
+            new_p_scores[(score1, score2 + 1)] += p * p_loss
+        else:
+            new_p_scores[(score1, score2)] += p
+
+    for scores, p in p_finished_scores.items():
+        new_p_scores[scores] += p
+
+    return dict(new_p_scores)
+
+
+def old_best_roster(predictor, team, full_roster) -> tuple:
+    """The best roster of the sort of the roster queue which the roster
+    index replaced."""
+    rosters = list(predictor.roster_queues[team])
+    if rosters:
+        min_ratings = predictor._min_roster_ratings(rosters).tolist()
+        rosters = [rosters[i] for i in sorted(range(len(rosters)),
+                                              key=min_ratings.__getitem__,
+                                              reverse=True)]
+
+    for roster in rosters:
+        if all(name in full_roster for name in roster):
+            return roster
+
+    return tuple(sorted(sorted(full_roster), key=predictor._min_rating,
+                        reverse=True)[:6])
+
+
+def next_match(predictor, teams) -> Game:
+    return Game(teams=teams, match_format='regular',
+                full_rosters=tuple(predictor.last_full_rosters[team]
+                                   for team in teams))
+
+
+def played_game(predictor, teams, rosters=None) -> Game:
+    """Return a game won 2-0 by the first team, with the best rosters
+    unless given."""
+    if rosters is None:
+        rosters = tuple(predictor.best_rosters[team] for team in teams)
+    full_rosters = tuple(predictor.last_full_rosters[team] | set(roster)
+                         for team, roster in zip(teams, rosters))
+
+    return Game(teams=teams, match_format='regular', match_id=-1,
+                stage=predictor.stage, game_number=1, map_name='ilios',
+                score=(2, 0), rosters=rosters, full_rosters=full_rosters)
+
+
+def assert_fresh(predictor, match: Game) -> dict:
+    """Check the cached prediction of a match against a fresh one."""
+    cached = predictor.predict_match_score(match)
+    predictor.clear_predictions()
+    assert cached == predictor.predict_match_score(match)
+    return cached
+
+
+def test_train_ratings_drops_predictions(predictor, games):
+    match = next_match(predictor, games[N_TRAINED].teams)
+    before = predictor.predict_match_score(match)
+
+    predictor.train_ratings(CompiledGames.compile(
+        games[N_TRAINED:N_TRAINED + 200]))
+    assert assert_fresh(predictor, match) != before
+
+
+def test_restore_drops_predictions(predictor, games):
+    snapshot = predictor.ratings.snapshot()
+    predictor.train_games(games[N_TRAINED:N_TRAINED + 50])
+    match = next_match(predictor, games[N_TRAINED].teams)
+    before = predictor.predict_match_score(match)
+
+    predictor.ratings.restore(snapshot)
+    assert assert_fresh(predictor, match) != before
+
+
+def test_roster_move_drops_old_team_predictions(predictor):
+    match = next_match(predictor, ('ATL', 'BOS'))
+    before = predictor.predict_match_score(match)
+
+    # A player of ATL's best roster plays & wins for DAL.
+    name = predictor.best_rosters['ATL'][0]
+    roster = tuple(sorted((name,) + predictor.best_rosters['DAL'][1:]))
+    predictor.train(played_game(predictor, ('DAL', 'FLA'),
+                                rosters=(roster,
+                                         predictor.best_rosters['FLA'])))
+    assert assert_fresh(predictor, match) != before
+
+
+def test_p_wins_are_cached(predictor, monkeypatch):
+    full_rosters = predictor.last_full_rosters.copy()
+    predicted_pairs = []
+    predict_many = predictor.predict_many
+
+    def counting_predict_many(pairs, **kws):
+        predicted_pairs.extend(pairs)
+        return predict_many(pairs, **kws)
+
+    monkeypatch.setattr(predictor, 'predict_many', counting_predict_many)
+    before = predictor._p_wins(full_rosters, 'regular')
+    assert predicted_pairs
+
+    predicted_pairs.clear()
+    assert predictor._p_wins(full_rosters, 'regular') == before
+    assert predicted_pairs == []
+
+    predictor.train(played_game(predictor, ('ATL', 'BOS')))
+    p_wins = predictor._p_wins(full_rosters, 'regular')
+    # Each pair is predicted for both kinds of maps.
+    assert {('ATL', 'HOU'), ('HOU', 'BOS')} <= set(predicted_pairs)
+    assert ('DAL', 'HOU') not in predicted_pairs
+    assert p_wins != before
+
+    predictor.clear_predictions()
+    assert predictor._p_wins(full_rosters, 'regular') == p_wins
+
+
+def test_fork_trained_on_rest_equals_full_replay(predictor, games):
+    parent_state = plain_state(predictor)
+    fork = predictor.fork()
+    fork.train_games(games[N_TRAINED:])
+
+    expected = PlayerTrueSkillPredictor()
+    expected.train_games(games)
+    assert plain_state(fork) == plain_state(expected)
+    assert fork.points == expected.points
+
+    # The parent is untouched, and keeps plain dicts.
+    assert plain_state(predictor) == parent_state
+    assert not any(isinstance(value, CowDict)
+                   for value in vars(predictor).values())
+
+
+@pytest.mark.parametrize('match_format', sorted(MATCH_FORMATS))
+def test_bo_score_grid_equals_old_dp(match_format):
+    drawables, max_wins = MATCH_FORMATS[match_format]
+    # Multiples of 1/16 keep every sum & product exact, whatever the order
+    # of the operations.
+    ps = [(p_win / 16, p_draw / 16) for p_win, p_draw
+          in product(range(17), range(17)) if p_win + p_draw <= 16]
+    p_undrawables = [(p_win, 0.0) for p_win, _ in ps]
+
+    for p_undrawable, p_drawable in product(p_undrawables[::3], ps[::5]):
+        grid = bo_score_grid(p_undrawable, p_drawable, drawables,
+                             max_wins)[0]
+        old = old_bo_scores(p_undrawable, p_drawable, drawables, max_wins)
+        assert {score: grid[score] for score in old} == old
+        assert grid.sum() - sum(old.values()) == 0.0
+
+    # Other probabilities only differ by the order of the roundings.
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        p_win, p_draw = rng.dirichlet(np.ones(3))[:2]
+        p_undrawable = (rng.random(), 0.0)
+        grid = bo_score_grid(p_undrawable, (p_win, p_draw), drawables,
+                             max_wins)[0]
+        old = old_bo_scores(p_undrawable, (p_win, p_draw), drawables,
+                            max_wins)
+        np.testing.assert_allclose([grid[score] for score in old],
+                                   list(old.values()), rtol=1e-15, atol=0)
+
+
+@pytest.mark.parametrize('match_format', sorted(MATCH_FORMATS))
+def test_predict_match_score_equals_old_dp(predictor, match_format):
+    drawables, max_wins = MATCH_FORMATS[match_format]
+
+    for teams in (('ATL', 'BOS'), ('SEO', 'NYE'), ('SHD', 'LDN')):
+        match = next_match(predictor, teams)._replace(
+            match_format=match_format)
+        p_undrawable, p_drawable = (
+            predictor.predict(teams, full_rosters=match.full_rosters,
+                              drawable=drawable)
+            for drawable in (False, True))
+        old = old_bo_scores(p_undrawable, p_drawable, drawables, max_wins)
+
+        p_scores = predictor.predict_match_score(match)
+        assert p_scores.keys() == old.keys()
+        np.testing.assert_allclose([p_scores[score] for score in old],
+                                   list(old.values()), rtol=1e-15, atol=0)
+
+
+@pytest.mark.parametrize('drawable', [False, True])
+def test_predict_many_equals_predict(predictor, drawable):
+    pairs = list(permutations(sorted(predictor.best_rosters), 2))
+    full_rosters = [tuple(predictor.last_full_rosters[team] for team in teams)
+                    for teams in pairs]
+    rosters = [tuple(predictor.best_rosters[team] for team in teams)
+               for teams in pairs]
+
+    for kws in (dict(full_rosters=full_rosters), dict(rosters=rosters)):
+        many = predictor.predict_many(pairs, drawable=drawable, **kws)
+        expected = [predictor.predict(
+            teams, drawable=drawable,
+            **{name: value[i] for name, value in kws.items()})
+            for i, teams in enumerate(pairs)]
+        # predict() uses the erfc approximation of trueskill, within 1.2e-7.
+        np.testing.assert_allclose(many, expected, rtol=0, atol=2e-7)
+
+
+def test_best_roster_index_equals_old_sort(predictor, games):
+    for game in games[N_TRAINED:N_TRAINED + 300]:
+        for team, full_roster in zip(game.teams, game.full_rosters):
+            # Also without each player of the current best roster.
+            full_rosters = [full_roster] + [
+                full_roster - {name}
+                for name in predictor._best_roster(team, full_roster)]
+            for full_roster in full_rosters:
+                assert predictor._best_roster(team, full_roster) == \
+                    old_best_roster(predictor, team, full_roster)
+        predictor.train(game)
+
+
+def test_expected_draws_count_drawable_maps_only(predictor, games):
+    rest = games[N_TRAINED:N_TRAINED + 200]
+    assert {game.drawable for game in rest} == {False, True}
+    expected_draws = predictor.expected_draws
+
+    for game in rest:
+        if game.drawable:
+            _, p_draw = predictor.predict(game.teams, rosters=game.rosters,
+                                          drawable=True)
+            expected_draws += p_draw
+        predictor.train(game)
+    assert predictor.expected_draws == pytest.approx(expected_draws,
+                                                     rel=1e-12)
+
+    compiled = PlayerTrueSkillPredictor()
+    compiled.train_ratings(CompiledGames.compile(games[:N_TRAINED + 200]))
+    assert compiled.expected_draws == pytest.approx(expected_draws, rel=1e-12)
+
+
+def test_dynamic_stage_without_drift_equals_static(predictor, games):
+    # The middle of stage 2.
+    n_trained = next(i for i, game in enumerate(games)
+                     if game.stage == 'Stage 2') + 150
+    predictor.train_games(games[N_TRAINED:n_trained])
+
+    # No rating drift: no tau & (nearly) certain ratings.
+    predictor.tau = 0.0
+    predictor.env_drawable, predictor.env_undrawable = \
+        predictor._create_envs()
+    indices = list(range(len(predictor.ratings)))
+    predictor.ratings.set_many(indices, predictor.ratings.mu.copy(),
+                               np.full(len(indices), 1e-3))
+
+    matches = list({game.match_id: next_match(predictor, game.teams)
+                    for game in games[n_trained:]
+                    if game.stage == predictor.stage and
+                    game.match_format == 'regular'}.values())
+    assert len(matches) > 10
+    iters = 100000
+    static, dynamic = (predictor._predict_stage(matches, iters=iters, seed=1,
+                                                max_exact_states=0,
+                                                dynamic=dynamic)
+                       for dynamic in (False, True))
+
+    for team, probabilities in static.items():
+        for p, dynamic_p in zip(probabilities, dynamic[team]):
+            # 5 standard deviations of the difference of both estimates.
+            tolerance = 5 * np.sqrt(2 * max(p * (1 - p), 1e-3) / iters)
+            assert abs(dynamic_p - p) < tolerance, team
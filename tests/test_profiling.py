@@ -0,0 +1,41 @@
+import inspect
+import os
+
+import fetcher
+import predictor
+from conftest import ROOT
+from profiling import Profiler
+import render
+
+
+def namespaces() -> list:
+    """Return the modules & predictor classes which the profiler patches."""
+    return [fetcher, render, predictor] + [
+        value for value in vars(predictor).values()
+        if inspect.isclass(value) and value.__module__ == 'predictor']
+
+
+def test_disable_restores_originals(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    before = [dict(vars(namespace)) for namespace in namespaces()]
+    load_games = fetcher.load_games
+    train = predictor.Predictor.train
+    games, _ = fetcher.load_games(os.path.join(ROOT, 'games.csv'),
+                                  use_cache=False)
+
+    with Profiler() as profiler:
+        assert profiler.enabled
+        assert render.load_games is fetcher.load_games
+        assert fetcher.load_games is not load_games
+        assert predictor.Predictor.train is not train
+        predictor.PlayerTrueSkillPredictor().train_games(games[:20])
+
+    assert not profiler.enabled
+    for namespace, values in zip(namespaces(), before):
+        after = vars(namespace)
+        assert after.keys() == values.keys()
+        assert all(after[name] is value for name, value in values.items())
+
+    assert profiler.report()['Predictor.train'].calls == 20
+    assert profiler.self_times[
+        'Predictor.train;TrueSkillPredictor.predict_both'] > 0
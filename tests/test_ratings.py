@@ -0,0 +1,51 @@
+import os
+
+import numpy as np
+from trueskill import Rating
+
+from conftest import ROOT
+from fetcher import load_games
+from predictor import PlayerTrueSkillPredictor
+from ratings import rate_two_teams
+
+
+def test_rate_two_teams_matches_env_rate():
+    predictor = PlayerTrueSkillPredictor()
+    rng = np.random.default_rng(0)
+    names = [f'player{i}' for i in range(12)]
+
+    for drawable, ranks in ((False, [0, 1]), (False, [1, 0]),
+                            (True, [0, 1]), (True, [0, 0])):
+        env = (predictor.env_drawable if drawable
+               else predictor.env_undrawable)
+        for _ in range(50):
+            store = predictor._create_rating_jar()
+            for name in names:
+                store[name] = Rating(mu=rng.normal(2500.0, 300.0),
+                                     sigma=rng.uniform(100.0, 850.0))
+            expected = env.rate([[store[name] for name in names[:6]],
+                                 [store[name] for name in names[6:]]],
+                                ranks=ranks)
+
+            rate_two_teams(store, names[:6], names[6:], ranks=ranks,
+                           env=env,
+                           draw_margin=predictor._draw_margin(12, drawable))
+            expected = [rating for ratings in expected for rating in ratings]
+            np.testing.assert_allclose(
+                [(store[name].mu, store[name].sigma) for name in names],
+                [(rating.mu, rating.sigma) for rating in expected],
+                rtol=1e-14, atol=0)
+
+
+def test_native_engine_replays_like_trueskill():
+    games, _ = load_games(os.path.join(ROOT, 'games.csv'), use_cache=False)
+    predictors = [PlayerTrueSkillPredictor(rate_engine=rate_engine)
+                  for rate_engine in ('trueskill', 'native')]
+    for predictor in predictors:
+        predictor.train_games(games)
+
+    expected, native = (predictor.ratings for predictor in predictors)
+    assert native.names == expected.names
+    np.testing.assert_allclose(native.mu, expected.mu, rtol=1e-9, atol=0)
+    np.testing.assert_allclose(native.sigma, expected.sigma, rtol=1e-9,
+                               atol=0)
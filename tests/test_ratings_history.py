@@ -0,0 +1,90 @@
+from collections import OrderedDict
+import csv
+import os
+
+import pytest
+from trueskill import Rating
+
+import fetcher
+from fetcher import (append_ratings_history, load_ratings_long,
+                     RATINGS_LONG_STATE_SUFFIX, RoundedRating)
+
+
+def make_history(n_stages: int, n_matches: int, shift: float = 0.0):
+    history = OrderedDict()
+    for stage in range(1, n_stages + 1):
+        for match_number in range(1, n_matches + 1):
+            history[(f'Stage {stage}', match_number)] = {
+                name: Rating(mu=2500 + 100 * stage + 10 * match_number +
+                             len(name) + shift, sigma=800 - match_number)
+                for name in ('ATL', 'Daco', 'dafran')}
+    return history
+
+
+def read_rows(csv_filename: str) -> list:
+    with open(csv_filename, newline='') as csv_file:
+        return list(csv.reader(csv_file))[1:]
+
+
+@pytest.fixture
+def long_csv(tmp_path) -> str:
+    return str(tmp_path / 'ratings_long.csv')
+
+
+@pytest.fixture
+def no_read_back(monkeypatch):
+    def load_ratings_long(csv_filename):
+        raise AssertionError('The long csv file was read back.')
+
+    monkeypatch.setattr(fetcher, 'load_ratings_long', load_ratings_long)
+
+
+def expected_history(history) -> OrderedDict:
+    return OrderedDict(
+        (match_key, {name: RoundedRating(round(rating.mu),
+                                         round(rating.sigma))
+                     for name, rating in ratings.items()})
+        for match_key, ratings in history.items())
+
+
+def test_append_only_new_ratings(long_csv, no_read_back):
+    history = make_history(n_stages=2, n_matches=2)
+    assert append_ratings_history(history, long_csv) == 12
+    assert append_ratings_history(history, long_csv) == 0
+
+    history[('Stage 2', 2)]['Daco'] = Rating(mu=3000, sigma=500)
+    history[('Stage 2', 3)] = {'ATL': Rating(mu=2000, sigma=600)}
+    assert append_ratings_history(history, long_csv) == 2
+    assert read_rows(long_csv)[-2:] == [
+        ['Stage 2', '2', 'Daco', '3000', '500'],
+        ['Stage 2', '3', 'ATL', '2000', '600'],
+    ]
+
+    history[('Stage 3', 1)] = {'ATL': Rating(mu=2000, sigma=600)}
+    assert append_ratings_history(history, long_csv) == 1
+    assert append_ratings_history(history, long_csv) == 0
+
+
+def test_append_reads_back_when_out_of_sync(long_csv):
+    history = make_history(n_stages=2, n_matches=2)
+    append_ratings_history(history, long_csv)
+
+    # Earlier stages replayed with other ratings.
+    changed = make_history(n_stages=2, n_matches=2, shift=1)
+    assert append_ratings_history(changed, long_csv) == 12
+    assert load_ratings_long(long_csv) == expected_history(changed)
+
+    # A long csv file edited behind the sidecar's back.
+    with open(long_csv, 'a', newline='') as csv_file:
+        csv.writer(csv_file).writerow(('Stage 1', 1, 'Daco', 0, 0))
+    assert append_ratings_history(changed, long_csv) == 1
+    assert load_ratings_long(long_csv) == expected_history(changed)
+
+
+def test_append_without_sidecar(long_csv):
+    history = make_history(n_stages=2, n_matches=2)
+    append_ratings_history(history, long_csv)
+    os.remove(long_csv + RATINGS_LONG_STATE_SUFFIX)
+
+    assert append_ratings_history(history, long_csv) == 0
+    assert load_ratings_long(long_csv) == expected_history(history)
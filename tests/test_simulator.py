@@ -0,0 +1,252 @@
+from collections import defaultdict
+from functools import cmp_to_key
+from random import Random
+
+import numpy as np
+import pytest
+from scipy.special import ndtr
+
+from game import Game, TEAM_DIVISIONS
+from predictor import bo_score_grid
+from ratings import v_w_win
+import simulator as simulator_module
+from simulator import (_interpolate, NORMAL_TABLES, RatingDynamics,
+                       StageEnumerator, StageSimulator, TEAM_INDICES,
+                       TEAM_ORDER, WINS_SHIFT)
+
+REGULAR = ((True, False, True, False), 4)
+
+
+def make_stage(n_matches: int, seed: int = 0) -> dict:
+    """Return the StageSimulator arguments of a random stage, whose maps
+    are won with the probabilities of random team strengths."""
+    rng = np.random.default_rng(seed)
+    strengths = dict(zip(TEAM_ORDER,
+                         rng.normal(scale=0.5, size=len(TEAM_ORDER))))
+    wins = {team: int(rng.integers(0, 4)) for team in TEAM_ORDER}
+    map_diffs = {team: int(rng.integers(-6, 7)) for team in TEAM_ORDER}
+
+    matches = []
+    scores_list = []
+    cum_weights_list = []
+    for _ in range(n_matches):
+        teams = tuple(rng.choice(TEAM_ORDER, size=2, replace=False).tolist())
+        matches.append(Game(teams=teams, match_format='regular'))
+        p_win = ndtr(strengths[teams[0]] - strengths[teams[1]])
+        grid = bo_score_grid([p_win, 0.0],
+                             [0.9 * p_win, 0.1], *REGULAR)[0]
+        scores = list(zip(*(score.tolist() for score in np.nonzero(grid))))
+        scores_list.append(scores)
+        cum_weights_list.append(np.cumsum([grid[score]
+                                           for score in scores]).tolist())
+
+    def p_wins(scale: float) -> dict:
+        return {(team1, team2): ndtr(scale * (strengths[team1] -
+                                              strengths[team2]))
+                for team1 in TEAM_ORDER for team2 in TEAM_ORDER
+                if team1 != team2}
+
+    return dict(wins=wins, map_diffs=map_diffs, head_to_head_map_diffs={},
+                matches=matches, scores_list=scores_list,
+                cum_weights_list=cum_weights_list, p_wins_regular=p_wins(1.0),
+                p_wins_ft3=p_wins(1.2), p_wins_ft4=p_wins(1.4))
+
+
+def old_stage_probabilities(stage: dict, iters: int, seed: int) -> dict:
+    """The per-iteration simulation which StageSimulator replaced, with its
+    comparison-based standings."""
+    rng = Random(seed)
+    title_count = defaultdict(int)
+    top1_count = defaultdict(int)
+    p_wins_regular = stage['p_wins_regular']
+    p_wins_ft3 = stage['p_wins_ft3']
+    p_wins_ft4 = stage['p_wins_ft4']
+
+    for _ in range(iters):
+        wins = defaultdict(int, stage['wins'])
+        map_diffs = defaultdict(int, stage['map_diffs'])
+        head_to_head_map_diffs = defaultdict(
+            int, stage['head_to_head_map_diffs'])
+
+        for match, scores, cum_weights in zip(stage['matches'],
+                                              stage['scores_list'],
+                                              stage['cum_weights_list']):
+            team1, team2 = match.teams
+            score1, score2 = rng.choices(scores, cum_weights=cum_weights)[0]
+
+            if score1 > score2:
+                wins[team1] += 1
+            elif score1 < score2:
+                wins[team2] += 1
+
+            map_diff = score1 - score2
+            map_diffs[team1] += map_diff
+            map_diffs[team2] -= map_diff
+            head_to_head_map_diffs[(team1, team2)] += map_diff
+            head_to_head_map_diffs[(team2, team1)] -= map_diff
+
+        def cmp_team(team1, team2):
+            key1 = (wins[team1], map_diffs[team1])
+            key2 = (wins[team2], map_diffs[team2])
+            if key1 != key2:
+                return -1 if key1 < key2 else 1
+            elif head_to_head_map_diffs[(team1, team2)] != 0:
+                return -1 if head_to_head_map_diffs[(team1, team2)] < 0 else 1
+            return 1 if rng.random() < p_wins_regular[(team1, team2)] else -1
+
+        teams = sorted(TEAM_ORDER, key=cmp_to_key(cmp_team), reverse=True)
+
+        # The best team, the best of the other division & the next 6.
+        seeds = [teams.pop(0)]
+        for i, team in enumerate(teams):
+            if TEAM_DIVISIONS[team] != TEAM_DIVISIONS[seeds[0]]:
+                seeds.append(teams.pop(i))
+                break
+        seeds += teams[:6]
+        for team in seeds:
+            title_count[team] += 1
+
+        # The highest seed plays the lowest one, the winners keep their
+        # positions.
+        for p_wins in (p_wins_ft3, p_wins_ft4, p_wins_ft4):
+            for i in range(len(seeds) // 2):
+                if rng.random() < p_wins[(seeds[i], seeds[-1 - i])]:
+                    seeds[-1 - i] = None
+                else:
+                    seeds[i] = None
+            seeds = [team for team in seeds if team is not None]
+        top1_count[seeds[0]] += 1
+
+    return {team: (title_count[team] / iters, top1_count[team] / iters)
+            for team in TEAM_ORDER}
+
+
+def make_simulator(teams_list, sum_mus=None) -> StageSimulator:
+    matches = [Game(teams=teams, match_format='regular')
+               for teams in teams_list]
+    n_teams = len(TEAM_INDICES)
+    if sum_mus is None:
+        sum_mus = {}
+    dynamics = RatingDynamics(
+        sum_mu=np.array([sum_mus.get(team, 15000.0)
+                         for team in TEAM_INDICES]),
+        sum_sigma2=np.full(n_teams, 6 * 300.0**2), sizes=np.full(n_teams, 6),
+        beta=1250.0, tau=25.0,
+        draw_margins={(12, False): 0.0, (12, True): 300.0},
+        match_formats=[REGULAR] * len(matches))
+
+    return StageSimulator(
+        wins={}, map_diffs={}, head_to_head_map_diffs={}, matches=matches,
+        scores_list=[[(3, 1)]] * len(matches),
+        cum_weights_list=[[1.0]] * len(matches), p_wins_regular={},
+        p_wins_ft3={}, p_wins_ft4={}, dynamics=dynamics)
+
+
+def test_normal_tables_match_exact_values():
+    x = np.linspace(-8.0, 8.0, 100001)
+    p, = _interpolate(x, NORMAL_TABLES[:1])
+    v, w = _interpolate(x, NORMAL_TABLES[1:])
+    exact_v, exact_w = v_w_win(x, 0.0)
+
+    np.testing.assert_allclose(p, ndtr(x), rtol=0, atol=1e-7)
+    np.testing.assert_allclose(v, exact_v, rtol=1e-6, atol=1e-9)
+    np.testing.assert_allclose(w, exact_w, rtol=1e-6, atol=1e-9)
+
+
+def test_dynamic_rounds_keep_team_order():
+    teams_list = [('ATL', 'BOS'), ('FLA', 'HOU'), ('BOS', 'FLA'),
+                  ('DAL', 'GLA'), ('ATL', 'HOU'), ('BOS', 'DAL')]
+    simulator = make_simulator(teams_list)
+
+    rounds = [round_.matches.tolist() for round_ in simulator.dynamic_rounds]
+    assert rounds == [[0, 1, 3], [2, 4], [5]]
+    for round_ in simulator.dynamic_rounds:
+        teams = round_.teams1.tolist() + round_.teams2.tolist()
+        assert len(set(teams)) == len(teams)
+
+
+def test_dynamic_deltas_are_match_results():
+    simulator = make_simulator([('ATL', 'BOS'), ('BOS', 'FLA')],
+                               sum_mus={'ATL': 18000.0})
+    key_deltas1, key_deltas2, pair_deltas = simulator._sample_dynamic_deltas(
+        20000, np.random.default_rng(1))
+
+    diffs = np.where(key_deltas1 >= WINS_SHIFT // 2,
+                     key_deltas1 - WINS_SHIFT, key_deltas1)
+    # Tied matches go to a tie-breaker, so none ends in a draw.
+    assert set(np.unique(np.abs(diffs)).tolist()) <= {1, 2, 3, 4}
+    assert np.all(diffs != 0)
+    np.testing.assert_array_equal(key_deltas2,
+                                  (diffs < 0) * WINS_SHIFT - diffs)
+    np.testing.assert_array_equal(np.abs(pair_deltas), np.abs(diffs))
+
+    # ATL is far stronger than BOS, BOS & FLA are even.
+    p_wins = (diffs > 0).mean(axis=1)
+    assert p_wins[0] > 0.8
+    assert abs(p_wins[1] - 0.5) < 0.03
+
+
+def test_adaptive_counts_dont_depend_on_workers(monkeypatch):
+    monkeypatch.setattr(simulator_module, 'MIN_WORKER_ITERS', 1)
+    simulator = StageSimulator(**make_stage(30), batch_size=5000)
+
+    counts = [simulator.run(200000, seed=3, workers=workers,
+                            half_width=0.01)
+              for workers in (1, 4)]
+    # Within a round of 4 batches, which workers=4 runs at once.
+    assert counts[0].iters == 10000
+    assert counts[1].iters == counts[0].iters
+    np.testing.assert_array_equal(counts[1].title_count,
+                                  counts[0].title_count)
+    np.testing.assert_array_equal(counts[1].top1_count,
+                                  counts[0].top1_count)
+
+
+def test_few_iterations_run_in_process(monkeypatch):
+    def no_pool(*args, **kws):
+        raise AssertionError('A process pool was started.')
+
+    simulator = StageSimulator(**make_stage(30))
+    expected = simulator.run(150000, seed=3)
+    monkeypatch.setattr(simulator_module, 'ProcessPoolExecutor', no_pool)
+
+    counts = simulator.run(150000, seed=3, workers=4)
+    assert counts.iters == expected.iters
+    np.testing.assert_array_equal(counts.title_count, expected.title_count)
+    np.testing.assert_array_equal(counts.top1_count, expected.top1_count)
+
+
+def test_simulator_matches_old_simulation():
+    stage = make_stage(24, seed=5)
+    old_iters = 20000
+    expected = old_stage_probabilities(stage, old_iters, seed=5)
+
+    counts = StageSimulator(**stage).run(200000, seed=5)
+    for team, probabilities in counts.probabilities().items():
+        for p, old_p in zip(probabilities, expected[team]):
+            # 5 standard deviations of the old estimate.
+            tolerance = 5 * np.sqrt(max(old_p * (1 - old_p), 0.01) / old_iters)
+            assert abs(p - old_p) < tolerance, team
+
+
+def test_enumerator_matches_simulation():
+    stage = make_stage(3, seed=1)
+    # Ties broken by the head-to-heads of the stage so far.
+    stage['head_to_head_map_diffs'] = {('ATL', 'BOS'): 2, ('BOS', 'ATL'): -2}
+    iters = 400000
+    exact = StageEnumerator(**stage).run()
+    counts = StageSimulator(**stage).run(iters, seed=1)
+
+    assert sum(p_title for p_title, _ in exact.values()) == \
+        pytest.approx(8.0)
+    assert sum(p_top1 for _, p_top1 in exact.values()) == pytest.approx(1.0)
+    for team, probabilities in counts.probabilities().items():
+        for p, exact_p in zip(probabilities, exact[team]):
+            tolerance = 5 * np.sqrt(max(exact_p * (1 - exact_p), 1e-4) /
+                                    iters)
+            assert abs(p - exact_p) < tolerance, team
+
+
+def test_run_needs_iterations():
+    with pytest.raises(ValueError):
+        StageSimulator(**make_stage(3)).run(0)
@@ -0,0 +1,93 @@
+import os
+import shutil
+
+import pytest
+
+from conftest import DATA_DIR, load_data
+from fetcher import (fetch_games, FetchClient, load_fetch_state,
+                     MATCHES_PAGE_SIZE, sync_games, untyped_csv_game)
+from game_store import GameStore
+
+
+@pytest.fixture
+def matches(api, tmp_path, monkeypatch):
+    """The recorded matches, served as the first sync sees them."""
+    monkeypatch.chdir(tmp_path)
+    shutil.copy(os.path.join(DATA_DIR, 'availabilities.csv'), tmp_path)
+    matches = load_data('matches.json')
+    api.serve_matches(matches['first_sync'], MATCHES_PAGE_SIZE)
+    return matches
+
+
+def sync(api, **kws):
+    api.requests.clear()
+    with FetchClient(base_url=api.base_url, cache_dir=None) as client:
+        games = sync_games(client=client, **kws)
+
+    return games, sorted(route for route, _ in api.requests
+                         if route.startswith('match/'))
+
+
+def fetch_rows(api):
+    with FetchClient(base_url=api.base_url, cache_dir=None) as client:
+        return list(map(untyped_csv_game, fetch_games(client)))
+
+
+def test_sync_fetches_and_appends_changed_matches(api, matches):
+    store = GameStore()
+    games, details = sync(api)
+    assert details == ['match/101', 'match/102', 'match/103']
+    assert [game.game_id for game in games] == [1011, 1012, 1021, 1022, None]
+    first_rows = store._journal()
+
+    api.serve_matches(matches['second_sync'], MATCHES_PAGE_SIZE)
+    _, details = sync(api)
+    # 101 is unchanged, 102 has a corrected score, 103 was played & 104 is
+    # new.
+    assert details == ['match/102', 'match/103', 'match/104']
+    journal = store._journal()
+    assert journal[:len(first_rows)] == first_rows
+    assert [(row.match_id, row.game_id, row.score1, row.score2)
+            for row in journal[len(first_rows):]] == [
+        ('102', '1022', '2', '1'),
+        ('103', '1031', '2', '0'),
+        ('103', '1032', '1', '3'),
+        ('104', '', '', ''),
+    ]
+    assert list(store.csv_games()) == fetch_rows(api)
+
+    # Only the match which is not concluded is fetched again.
+    _, details = sync(api)
+    assert details == ['match/104']
+    assert store._journal() == journal
+    assert set(load_fetch_state()) == {101, 102, 103, 104}
+
+
+def test_sync_rewrites_rescheduled_match(api, matches):
+    store = GameStore()
+    sync(api)
+    matches['first_sync'][2]['startDate'] += 3600 * 1000
+    api.serve_matches(matches['first_sync'], MATCHES_PAGE_SIZE)
+
+    _, details = sync(api)
+    assert details == ['match/103']
+    assert GameStore().journal_rows == 0
+    assert list(store.csv_games()) == fetch_rows(api)
+
+
+def test_full_sync_fetches_everything(api, matches):
+    store = GameStore()
+    sync(api)
+    # A row the state does not know about, e.g. from an interrupted sync.
+    stale_row = store._journal()[0]._replace(score1='9')
+    store.append([stale_row])
+    _, details = sync(api)
+    assert details == ['match/103']
+    assert stale_row in store.csv_games()
+
+    api.serve_matches(matches['second_sync'], MATCHES_PAGE_SIZE)
+    _, details = sync(api, full=True)
+    assert details == ['match/101', 'match/102', 'match/103', 'match/104']
+    assert GameStore().journal_rows == 0
+    assert list(store.csv_games()) == fetch_rows(api)
+    assert stale_row not in store.csv_games()
@@ -0,0 +1,429 @@
+from concurrent.futures import ProcessPoolExecutor
+import inspect
+from itertools import product
+import os
+from typing import Callable, Dict, List, NamedTuple, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.special import ndtr, ndtri
+
+from compiled import CompiledGames, SharedGames
+from fetcher import load_games
+from game import TEAMS
+from predictor import (load_initial_ratings, PlayerTrueSkillPredictor,
+                       Predictor, TrueSkillPredictor)
+from ratings import v_w_draw, v_w_win
+
+
+# Constructor kwargs which only take integers.
+INTEGER_PARAMS = {'roster_queue_size'}
+# Constructor kwargs => valid (low, high), searches stay within them.
+PARAM_BOUNDS = {
+    'sigma': (1e-3, np.inf),
+    'beta': (1e-3, np.inf),
+    'tau': (1e-3, np.inf),
+    'draw_probability': (1e-6, 1.0 - 1e-6),
+    'roster_queue_size': (1, np.inf),
+}
+
+Params = Dict[str, Union[float, int]]
+
+
+def point_objective(predictor: Predictor, games: CompiledGames) -> float:
+    """Negative total prediction point, lower is better."""
+    return -predictor.train_ratings(games)
+
+
+def draw_objective(predictor: Predictor, games: CompiledGames) -> float:
+    """Squared difference between expected & real draws."""
+    predictor.train_ratings(games)
+    return (predictor.expected_draws - predictor.real_draws)**2
+
+
+OBJECTIVES = {
+    'point': point_objective,
+    'draws': draw_objective,
+}
+
+
+# Constructor kwargs of TrueSkillPredictor which PopulationTrainer varies.
+POPULATION_PARAMS = ('mu', 'sigma', 'beta', 'tau', 'draw_probability')
+
+
+class Evaluation(NamedTuple):
+    params: Params
+    value: float
+
+
+# The games of the current worker process, attached once.
+_worker_games = None
+
+
+def _init_worker(handle: SharedGames) -> None:
+    global _worker_games
+    _worker_games = CompiledGames.attach(handle)
+
+
+def _evaluate(class_: type, params: Params, fixed: Params,
+              objective: Union[str, Callable],
+              games: CompiledGames = None) -> float:
+    if games is None:
+        games = _worker_games
+    if isinstance(objective, str):
+        objective = OBJECTIVES[objective]
+
+    predictor = class_(**fixed, **params)
+    return objective(predictor, games)
+
+
+class PopulationTrainer(object):
+    """Train PlayerTrueSkillPredictor ratings for K params at once.
+
+    Player ratings are (K, players) arrays, and each game is rated for all
+    the K params together with the closed-form two-team update. Only the
+    ratings are trained, since the points, corrects & draws of games with
+    known rosters depend on nothing else."""
+
+    def __init__(self, params_list: Sequence[Params],
+                 players: Sequence[str],
+                 initial_ratings: Dict[str, Tuple[float, float]] = None
+                 ) -> None:
+        super().__init__()
+
+        defaults = inspect.signature(TrueSkillPredictor).parameters
+        for params in params_list:
+            unknown = set(params) - set(POPULATION_PARAMS)
+            if unknown:
+                raise ValueError(f'Unsupported params: {sorted(unknown)}')
+            for name, value in params.items():
+                low, high = PARAM_BOUNDS.get(name, (-np.inf, np.inf))
+                if not low <= value <= high:
+                    raise ValueError(f'{name} = {value} is out of bounds')
+        self.params_list = list(params_list)
+        for name in POPULATION_PARAMS:
+            setattr(self, name, np.array([
+                params.get(name, defaults[name].default)
+                for params in self.params_list], dtype=float)[:, None])
+
+        if initial_ratings is None:
+            initial_ratings = load_initial_ratings(
+                PlayerTrueSkillPredictor.INITIAL_RATINGS_FILENAME)
+        self.players = players
+        # Sigma^2 rather than sigma, saving square roots.
+        self.mu_array = np.repeat(self.mu, len(players), axis=1)
+        self.sigma2_array = np.repeat(self.sigma**2, len(players), axis=1)
+        for i, name in enumerate(players):
+            if name in initial_ratings and name not in TEAMS:
+                mu, sigma = initial_ratings[name]
+                self.mu_array[:, i] = mu
+                self.sigma2_array[:, i] = sigma**2
+
+        n = len(self.params_list)
+        self.points = np.zeros(n)
+        self.corrects = np.zeros(n, dtype=int)
+        self.expected_draws = np.zeros(n)
+        self.real_draws = 0.0
+
+    def train_games(self, games: CompiledGames) -> np.ndarray:
+        """Train on games compiled with the same players. Return the
+        prediction points of each params for all the games."""
+        points = np.zeros(len(self.params_list))
+        rosters = games.rosters.tolist()
+        scores = games.scores.tolist()
+        drawables = games.drawable.tolist()
+
+        beta2 = self.beta[:, 0]**2
+        tau2 = self.tau**2
+        # The draw margin of drawable maps, per player.
+        draw_margin_unit = ndtri((self.draw_probability[:, 0] + 1.0) / 2.0
+                                 ) * self.beta[:, 0]
+
+        for (roster1, roster2), (score1, score2), drawable in zip(
+                rosters, scores, drawables):
+            indices1 = [i for i in roster1 if i >= 0]
+            indices = indices1 + [i for i in roster2 if i >= 0]
+            size = len(indices)
+            signs = np.ones(size)
+            signs[len(indices1):] = -1.0
+
+            mu = self.mu_array[:, indices]
+            sigma2 = self.sigma2_array[:, indices]
+            delta_mu = mu @ signs
+            denom = np.sqrt(size * beta2 + sigma2.sum(axis=1))
+            draw_margin = draw_margin_unit * np.sqrt(size)
+
+            # Evaluate as if undrawable, like Predictor.evaluate().
+            if score1 != score2:
+                p_win = ndtr(delta_mu / denom)
+                p = p_win if score1 > score2 else 1.0 - p_win
+                point = np.log(2.0 * p)
+                points += point
+                self.points += point
+                self.corrects += p > 0.5
+            if drawable:
+                self.expected_draws += (
+                    ndtr((delta_mu + draw_margin) / denom) -
+                    ndtr((delta_mu - draw_margin) / denom))
+            else:
+                draw_margin = 0.0
+            if score1 == score2:
+                self.real_draws += 1.0
+
+            # The same update as rate_two_teams().
+            sigma2 = sigma2 + tau2
+            c2 = sigma2.sum(axis=1) + size * beta2
+            c = np.sqrt(c2)
+            if score1 == score2:
+                v, w = v_w_draw(delta_mu / c, draw_margin / c)
+            else:
+                if score1 < score2:
+                    signs = -signs
+                    delta_mu = -delta_mu
+                v, w = v_w_win(delta_mu / c, draw_margin / c)
+
+            self.mu_array[:, indices] = mu + (
+                signs * sigma2 * (v / c)[:, None])
+            self.sigma2_array[:, indices] = sigma2 * (
+                1.0 - sigma2 * (w / c2)[:, None])
+
+        return points
+
+
+class Tuner(object):
+    """Search predictor constructor kwargs minimizing an objective.
+
+    Candidates are evaluated concurrently in a process pool, whose workers
+    share one copy of the compiled games. With population, candidates of
+    PlayerTrueSkillPredictor are instead trained together in a
+    PopulationTrainer. Candidates are clipped into the bounds, which extend
+    PARAM_BOUNDS. Every evaluation is kept in the history."""
+
+    def __init__(self, class_: type = PlayerTrueSkillPredictor,
+                 objective: Union[str, Callable] = 'point',
+                 fixed: Params = None, workers: int = None,
+                 games: CompiledGames = None,
+                 population: bool = False,
+                 bounds: Dict[str, Tuple[float, float]] = None) -> None:
+        super().__init__()
+
+        self.bounds = dict(PARAM_BOUNDS)
+        if bounds is not None:
+            self.bounds.update(bounds)
+
+        if population and (class_ is not PlayerTrueSkillPredictor or
+                           objective not in OBJECTIVES):
+            raise ValueError('Population training only supports '
+                             'PlayerTrueSkillPredictor & named objectives')
+        self.population = population
+
+        if games is None:
+            games = CompiledGames.compile(load_games()[0])
+        self.games = games
+        self.shared_games = None
+
+        self.class_ = class_
+        self.objective = objective
+        self.fixed = {} if fixed is None else fixed
+        self.workers = os.cpu_count() if workers is None else workers
+        self.executor = None
+
+        self.history: List[Evaluation] = []
+        self.values: Dict[Tuple, float] = {}
+
+    def __enter__(self) -> 'Tuner':
+        if self.workers > 1 and not self.population:
+            self.shared_games = self.games.share()
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_worker,
+                initargs=(self.shared_games.handle,))
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shared_games is not None:
+            self.shared_games.close()
+            self.shared_games.unlink()
+            self.shared_games = None
+
+    def evaluate(self, params_list: Sequence[Params]) -> List[float]:
+        """Evaluate many params at once. Return their values."""
+        params_list = [self._normalize(params) for params in params_list]
+        keys = [tuple(sorted(params.items())) for params in params_list]
+        new = {key: params for key, params in zip(keys, params_list)
+               if key not in self.values}
+
+        args = ([self.class_] * len(new), list(new.values()),
+                [self.fixed] * len(new), [self.objective] * len(new))
+        if self.population:
+            values = self._evaluate_population(list(new.values()))
+        elif self.executor is not None:
+            values = list(self.executor.map(_evaluate, *args))
+        else:
+            values = [_evaluate(*arg, games=self.games)
+                      for arg in zip(*args)]
+
+        for (key, params), value in zip(new.items(), values):
+            self.values[key] = value
+            self.history.append(Evaluation(params=params, value=value))
+
+        return [self.values[key] for key in keys]
+
+    def grid(self, space: Dict[str, Sequence]) -> Evaluation:
+        """Evaluate every combination of the given values."""
+        names = list(space)
+        self.evaluate([dict(zip(names, values))
+                       for values in product(*space.values())])
+        return self.best()
+
+    def random(self, bounds: Dict[str, Tuple[float, float]], n: int,
+               seed=None) -> Evaluation:
+        """Evaluate n uniformly random points within the bounds."""
+        rng = np.random.default_rng(seed)
+        self.evaluate([{name: rng.uniform(low, high)
+                        for name, (low, high) in bounds.items()}
+                       for _ in range(n)])
+        return self.best()
+
+    def nelder_mead(self, x0: Params, steps: Params = None,
+                    max_evals: int = 100, xtol: float = 1e-4,
+                    ftol: float = 1e-4) -> Evaluation:
+        """Nelder-Mead from x0. The reflection, expansion & contraction
+        points of each iteration are evaluated at once, as are the points
+        of a shrink."""
+        names = list(x0)
+        if steps is None:
+            steps = {name: 0.05 * value if value != 0 else 0.00025
+                     for name, value in x0.items()}
+
+        lows, highs = np.array([self.bounds.get(name, (-np.inf, np.inf))
+                                for name in names], dtype=float).T
+
+        def to_params(x):
+            return dict(zip(names, x.tolist()))
+
+        def clip(x):
+            # Reflect points out of the bounds back into them.
+            x = np.where(x < lows, 2.0 * lows - x, x)
+            x = np.where(x > highs, 2.0 * highs - x, x)
+            return np.clip(x, lows, highs)
+
+        start = clip(np.array([x0[name] for name in names], dtype=float))
+        simplex = [start]
+        for i, name in enumerate(names):
+            vertex = start.copy()
+            vertex[i] += steps[name]
+            simplex.append(clip(vertex))
+        simplex = np.array(simplex)
+        values = np.array(self.evaluate([to_params(x) for x in simplex]))
+        n_evals = len(simplex)
+
+        while n_evals < max_evals:
+            order = np.argsort(values, kind='stable')
+            simplex = simplex[order]
+            values = values[order]
+
+            if (np.abs(simplex[1:] - simplex[0]).max() <= xtol and
+                    np.abs(values[1:] - values[0]).max() <= ftol):
+                break
+
+            centroid = simplex[:-1].mean(axis=0)
+            direction = centroid - simplex[-1]
+            candidates = [clip(centroid + direction),
+                          clip(centroid + 2.0 * direction),
+                          clip(centroid + 0.5 * direction),
+                          clip(centroid - 0.5 * direction)]
+            reflected, expanded, outside, inside = self.evaluate(
+                [to_params(x) for x in candidates])
+            n_evals += len(candidates)
+
+            if reflected < values[0]:
+                if expanded < reflected:
+                    simplex[-1], values[-1] = candidates[1], expanded
+                else:
+                    simplex[-1], values[-1] = candidates[0], reflected
+            elif reflected < values[-2]:
+                simplex[-1], values[-1] = candidates[0], reflected
+            elif reflected < values[-1] and outside <= reflected:
+                simplex[-1], values[-1] = candidates[2], outside
+            elif reflected >= values[-1] and inside < values[-1]:
+                simplex[-1], values[-1] = candidates[3], inside
+            else:
+                # Shrink towards the best vertex.
+                simplex[1:] = simplex[0] + 0.5 * (simplex[1:] - simplex[0])
+                values[1:] = self.evaluate([to_params(x)
+                                            for x in simplex[1:]])
+                n_evals += len(simplex) - 1
+
+        return self.best()
+
+    def best(self) -> Evaluation:
+        return min(self.history, key=lambda evaluation: evaluation.value)
+
+    def report(self) -> Evaluation:
+        """Print every evaluation, and return the best one."""
+        best = self.best()
+        names = sorted({name for evaluation in self.history
+                        for name in evaluation.params})
+
+        print('  '.join(f'{name:>18}' for name in names + ['value']))
+        for evaluation in self.history:
+            row = [evaluation.params.get(name, '') for name in names]
+            row.append(evaluation.value)
+            mark = ' *' if evaluation is best else ''
+            print('  '.join(f'{value:>18.6g}' if value != '' else ' ' * 18
+                            for value in row) + mark)
+
+        params = ', '.join(f'{name} = {value:.6g}'
+                           for name, value in best.params.items())
+        print(f'Best: {params}, value = {best.value:.6g}')
+
+        return best
+
+    def _evaluate_population(self, params_list: List[Params]) -> List[float]:
+        if not params_list:
+            return []
+
+        trainer = PopulationTrainer([{**self.fixed, **params}
+                                     for params in params_list],
+                                    players=self.games.players)
+        points = trainer.train_games(self.games)
+        if self.objective == 'draws':
+            values = (trainer.expected_draws - trainer.real_draws)**2
+        else:
+            values = -points
+
+        return values.tolist()
+
+    def _normalize(self, params: Params) -> Params:
+        normalized = {}
+        for name, value in params.items():
+            low, high = self.bounds.get(name, (-np.inf, np.inf))
+            value = min(max(float(value), low), high)
+            normalized[name] = (int(round(value)) if name in INTEGER_PARAMS
+                                else value)
+
+        return normalized
+
+
+def optimize_beta(class_=PlayerTrueSkillPredictor, maxfun=100,
+                  workers=None) -> None:
+    with Tuner(class_, objective='point', workers=workers) as tuner:
+        best = tuner.nelder_mead({'beta': 2500.0 / 6.0}, max_evals=maxfun)
+
+    avg_point = -best.value / len(tuner.games)
+    print(f'beta = {best.params["beta"]:.0f}, avg(point) = {avg_point:.4f}')
+
+
+def optimize_draw_probability(class_=PlayerTrueSkillPredictor, maxfun=100,
+                              workers=None) -> None:
+    with Tuner(class_, objective='draws', workers=workers) as tuner:
+        best = tuner.nelder_mead({'draw_probability': 0.06},
+                                 max_evals=maxfun)
+
+    print(f'draw_probability = {best.params["draw_probability"]:.3f}')
+
+
+if __name__ == '__main__':
+    optimize_beta()